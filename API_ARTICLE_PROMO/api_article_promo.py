@@ -25,16 +25,17 @@ if sys.platform == 'win32':
 
 # Ajouter le chemin du répertoire parent pour l'importation de utils
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler
+from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler, run_shops_parallel, get_cached_shop_info, PageFetcher, RecordSpool, get_http_session, stage, record_rows_out, ShopContextFilter
 
 # Désactiver les warnings SSL
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # Configuration du logging
 def setup_logging(log_dir, api_name):
-    # Désactiver tous les handlers existants pour éviter les conflits
     root_logger = logging.getLogger()
-    root_logger.handlers = []
+    if root_logger.handlers:
+        # Logging déjà configuré (orchestrateur run_api_extraction.py): ses handlers sont conservés
+        return logging.getLogger(__name__)
     
     log_file = os.path.join(log_dir, f"{api_name.lower().replace(' ', '_')}.log")
     
@@ -43,9 +44,11 @@ def setup_logging(log_dir, api_name):
     stream_handler = SafeStreamHandler()
     
     # Formatter
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - [%(shop)s] %(message)s')
     file_handler.setFormatter(formatter)
     stream_handler.setFormatter(formatter)
+    file_handler.addFilter(ShopContextFilter())
+    stream_handler.addFilter(ShopContextFilter())
     
     # Ajouter les handlers au root logger
     root_logger.addHandler(file_handler)
@@ -96,9 +99,7 @@ class ProsumaAPIArticlePromoExtractor:
             sys.exit(1)
         
         # Configuration de la session HTTP
-        self.session = requests.Session()
-        self.session.auth = (self.prosuma_user, self.prosuma_password)
-        self.session.verify = False
+        self.session = get_http_session(self.prosuma_user, self.prosuma_password)
         
         logger.info(f"Extracteur API Articles avec prix promo Prosuma initialisé pour {self.prosuma_user}")
         logger.info(f"Magasins configurés: {list(self.shops.keys())}")
@@ -153,7 +154,7 @@ class ProsumaAPIArticlePromoExtractor:
                     return shop_data
             
             # Si pas trouvé, chercher dans la liste paginée
-        url = f"{base_url}/api/shop/"
+            url = f"{base_url}/api/shop/"
             page = 1
             while True:
                 params = {'page': page, 'page_size': 100}
@@ -166,7 +167,7 @@ class ProsumaAPIArticlePromoExtractor:
                     for shop in shops:
                         if shop.get('reference') == shop_code:
                             logger.info(f"✅ Magasin {shop_code} trouvé: {shop.get('name', 'Nom inconnu')}")
-                    return shop
+                            return shop
                     
                     if not data.get('next'):
                         break
@@ -179,42 +180,26 @@ class ProsumaAPIArticlePromoExtractor:
             
         except Exception as e:
             logger.error(f"❌ Erreur lors de la récupération des informations du magasin: {e}")
-        return None
+            return None
 
     def get_articles_with_promo(self, base_url, shop_id):
         """Récupère tous les articles avec prix promo pour un magasin donné avec pagination."""
-        all_articles = []
-        page = 1
+        all_articles = RecordSpool()  # Écrit sur disque page par page (mémoire bornée)
         
         # Timeout augmenté pour les requêtes de produits (peuvent être lourdes)
         product_timeout = max(self.timeout * 2, 120)  # Au moins 120 secondes
         
-        # D'abord, récupérer le total d'articles avec prix promo
         url = f"{base_url}/api/product/"
         params = {
-            'page': 1,
-            'page_size': self.page_size,
             'shop': shop_id,
             'has_promo_price': 'true' # Filtre pour les articles avec prix promo
         }
+        fetcher = PageFetcher(self.session, url, params, page_size=self.page_size, timeout=product_timeout,
+                              checkpoint_name="ARTICLE_PROMO")
         
-        # Utiliser la session avec timeout augmenté
-        try:
-            response = self.session.get(url, params=params, timeout=product_timeout)
-            if response.status_code != 200:
-                logger.error(f"❌ Erreur HTTP {response.status_code} lors de la récupération des articles avec prix promo.")
-                return []
-            first_response = response.json()
-        except requests.exceptions.Timeout:
-            logger.error(f"❌ Timeout ({product_timeout}s) lors de la récupération des articles avec prix promo.")
-            logger.warning(f"⚠️ Le serveur met trop de temps à répondre. Essayez plus tard ou contactez l'administrateur.")
-            return []
-        except Exception as e:
-            logger.error(f"❌ Erreur lors de la récupération des articles avec prix promo: {e}")
-            return []
-        
-        total_articles = first_response.get('count', 0)
-        total_pages = (total_articles + self.page_size - 1) // self.page_size if total_articles > 0 else 0
+        # D'abord, récupérer le total d'articles avec prix promo (la page 1 est conservée)
+        total_articles = fetcher.count_records()
+        total_pages = (total_articles + fetcher.page_size - 1) // fetcher.page_size if total_articles > 0 else 0
         
         logger.info("=" * 60)
         logger.info("INFORMATIONS D'EXTRACTION")
@@ -224,68 +209,14 @@ class ProsumaAPIArticlePromoExtractor:
         logger.info(f"Timeout par requête: {product_timeout}s")
         logger.info("=" * 60)
 
-        # Traiter la première page déjà récupérée
-        if first_response:
-            results = first_response.get('results', [])
-            if results:
+        # Page 1 reprise du comptage, pages 2..N récupérées en parallèle
+        try:
+            for page, results in fetcher.iter_pages(total_articles):
                 all_articles.extend(results)
-                logger.info(f"   Page 1: {len(results)} articles avec prix promo récupérés (total: {len(all_articles):,}/{total_articles:,})")
-        
-        # Continuer avec les pages suivantes
-        page = 2
-        while page <= total_pages:
-            params = {
-                'page': page,
-                'page_size': self.page_size,
-                'shop': shop_id,
-                'has_promo_price': 'true' # Filtre pour les articles avec prix promo
-            }
-            
-            try:
-                response = self.session.get(url, params=params, timeout=product_timeout)
-
-                if response.status_code == 200:
-                    response_data = response.json()
-            results = response_data.get('results', [])
-                    
-            if not results:
-                        logger.info(f"   ✅ Dernière page atteinte (page {page}) - Aucun enregistrement retourné")
-                break
-
-            all_articles.extend(results)
-                    
-                    progress_percent = (page - 1) * 100 // total_pages if total_pages > 0 else 0
-                    logger.info(f"   Page {page}/{total_pages} ({progress_percent}%): {len(results)} articles avec prix promo récupérés (total: {len(all_articles):,}/{total_articles:,})")
-
-                    # Vérifier si on a récupéré tous les articles ou si on est à la dernière page
-                    if len(all_articles) >= total_articles:
-                        logger.info(f"   ✅ Tous les articles récupérés (page {page}/{total_pages})")
-                        break
-                    
-                    # Si on est à la dernière page calculée, on arrête
-                    if page >= total_pages:
-                        logger.info(f"   ✅ Dernière page atteinte (page {page}/{total_pages})")
-                        break
-                    
-                    page += 1
-                else:
-                    logger.error(f"❌ Erreur HTTP {response.status_code} pour la page {page}.")
-                    # Continuer avec la page suivante en cas d'erreur temporaire
-                    if response.status_code in [500, 503, 502]:
-                        logger.warning(f"⚠️ Erreur serveur, tentative de continuer...")
-                        page += 1
-                        continue
-                break
-                    
-            except requests.exceptions.Timeout:
-                logger.error(f"❌ Timeout ({product_timeout}s) pour la page {page}.")
-                logger.warning(f"⚠️ Le serveur met trop de temps à répondre. Passage à la page suivante...")
-                page += 1
-                continue
-            except Exception as e:
-                logger.error(f"❌ Erreur lors de la récupération de la page {page}: {e}")
-            page += 1
-                continue
+                progress_percent = page * 100 // fetcher.total_pages
+                logger.info(f"   Page {page}/{fetcher.total_pages} ({progress_percent}%): {len(results)} articles avec prix promo récupérés (total: {len(all_articles):,}/{total_articles:,})")
+        except Exception as e:
+            logger.error(f"❌ Erreur lors de la récupération des articles avec prix promo: {e}")
         
         logger.info("=" * 60)
         logger.info("RÉSUMÉ EXTRACTION")
@@ -397,7 +328,8 @@ class ProsumaAPIArticlePromoExtractor:
                     return local_filepath
             
             try:
-            shutil.copy2(local_filepath, network_filepath)
+                with stage('network_copy'):
+                    shutil.copy2(local_filepath, network_filepath)
                 
                 # Vérifier que la copie a réussi
                 if os.path.exists(network_filepath):
@@ -407,9 +339,9 @@ class ProsumaAPIArticlePromoExtractor:
                     logger.info(f"   📊 Taille: {file_size:,} octets")
                     
                     # Supprimer le fichier local après vérification
-            os.remove(local_filepath)
-            logger.info(f"🗑️ Fichier local supprimé")
-            return network_filepath
+                    os.remove(local_filepath)
+                    logger.info(f"🗑️ Fichier local supprimé")
+                    return network_filepath
                 else:
                     logger.error(f"❌❌❌ LE FICHIER N'EXISTE PAS APRÈS LA COPIE ❌❌❌")
                     logger.error(f"   Chemin attendu: {network_filepath}")
@@ -457,7 +389,7 @@ class ProsumaAPIArticlePromoExtractor:
 
         # Récupérer l'ID du magasin
         logger.info(f"Récupération des informations du magasin {shop_code}...")
-        shop_data = self.get_shop_info(base_url, shop_code)
+        shop_data = get_cached_shop_info(self.session, base_url, shop_code, self.get_shop_info)
         if not shop_data:
             logger.error(f"❌ Magasin {shop_code} non trouvé dans la liste ou erreur API.")
             return False
@@ -480,8 +412,10 @@ class ProsumaAPIArticlePromoExtractor:
         logger.info("=" * 60)
         logger.info(f"💾 EXPORT CSV - MAGASIN {shop_code}")
         logger.info("=" * 60)
-        csv_file = self.export_to_csv(articles, shop_code, shop_name)
+        with stage('csv'):
+            csv_file = self.export_to_csv(articles, shop_code, shop_name)
         if csv_file:
+            record_rows_out(len(articles))
             logger.info("=" * 60)
             logger.info(f"✅ MAGASIN {shop_code} TRAITÉ AVEC SUCCÈS")
             logger.info("=" * 60)
@@ -506,9 +440,19 @@ class ProsumaAPIArticlePromoExtractor:
         else:
             logger.warning("⚠️ Impossible de créer le dossier réseau")
 
+        # Magasins traités en parallèle (plafond de magasins simultanés par serveur)
+        results = run_shops_parallel(
+            list(self.shops.keys()), self.shops,
+            lambda shop_code: self.extract_shop(shop_code, self.shops[shop_code])
+        )
+        
         all_success = True
-        for shop_code, shop_info in self.shops.items():
-            if not self.extract_shop(shop_code, shop_info):
+        for shop_code in self.shops:
+            try:
+                if not results[shop_code].result():
+                    all_success = False
+            except Exception as e:
+                logger.error(f"❌ Erreur lors de l'extraction du magasin {shop_code}: {e}")
                 all_success = False
         
         if all_success:
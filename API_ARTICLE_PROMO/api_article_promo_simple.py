@@ -15,7 +15,7 @@ import sys
 
 # Ajouter le chemin du répertoire parent pour l'importation de utils
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler
+from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler, run_shops_parallel, get_cached_shop_info, shop_log_handlers
 
 # Désactiver les warnings SSL
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -42,11 +42,11 @@ class ProsumaAPIArticlePromoExtractor:
         log_file = os.path.join(self.log_dir, f'api_article_promo_{datetime.now().strftime("%Y%m%d")}.log')
         logging.basicConfig(
             level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[
+            format='%(asctime)s - %(levelname)s - [%(shop)s] %(message)s',
+            handlers=shop_log_handlers([
                 logging.FileHandler(log_file),
                 logging.StreamHandler(sys.stdout)
-            ]
+            ])
         )
         
         self.logger = logging.getLogger(__name__)
@@ -244,7 +244,7 @@ class ProsumaAPIArticlePromoExtractor:
 
         # Récupérer l'ID du magasin
         self.logger.info(f"Récupération des informations du magasin {shop_code}...")
-        shop_data = self.get_shop_info(base_url, shop_code)
+        shop_data = get_cached_shop_info(self.session, base_url, shop_code, self.get_shop_info)
         if not shop_data:
             self.logger.error(f"❌ Magasin {shop_code} non trouvé dans la liste ou erreur API.")
             return False
@@ -293,9 +293,19 @@ class ProsumaAPIArticlePromoExtractor:
         else:
             self.logger.warning("⚠️ Impossible de créer le dossier réseau")
 
+        # Magasins traités en parallèle (plafond de magasins simultanés par serveur)
+        results = run_shops_parallel(
+            list(self.shops.keys()), self.shops,
+            lambda shop_code: self.extract_shop(shop_code, self.shops[shop_code])
+        )
+        
         all_success = True
-        for shop_code, shop_info in self.shops.items():
-            if not self.extract_shop(shop_code, shop_info):
+        for shop_code in self.shops:
+            try:
+                if not results[shop_code].result():
+                    all_success = False
+            except Exception as e:
+                self.logger.error(f"❌ Erreur lors de l'extraction du magasin {shop_code}: {e}")
                 all_success = False
         
         if all_success:
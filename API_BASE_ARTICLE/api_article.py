@@ -4,7 +4,6 @@ Extracteur API Prosuma RPOS - Base Articles
 Récupère tous les articles/produits via l'API Prosuma avec pagination automatique
 """
 
-import requests
 import os
 import csv
 import json
@@ -18,7 +17,7 @@ import sys
 
 # Ajouter le répertoire parent au path pour importer utils
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler
+from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler, PageFetcher, run_shops_parallel, get_cached_shop_info, RecordSpool, get_http_session, stage, record_rows_out, shop_log_handlers
 
 # Désactiver les warnings SSL
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -47,9 +46,7 @@ class ProsumaAPIBaseArticleExtractor:
         self.setup_logging()
         
         # Configuration de la session
-        self.session = requests.Session()
-        self.session.auth = (self.username, self.password)
-        self.session.verify = False
+        self.session = get_http_session(self.username, self.password)
         
         print(f"Extracteur API Base Articles initialisé pour {self.username}")
         print(f"Magasins configurés: {self.shop_codes}")
@@ -68,11 +65,11 @@ class ProsumaAPIBaseArticleExtractor:
         # Configuration du logging
         logging.basicConfig(
             level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[
+            format='%(asctime)s - %(levelname)s - [%(shop)s] %(message)s',
+            handlers=shop_log_handlers([
                 logging.FileHandler(log_file, encoding='utf-8'),
                 SafeStreamHandler()
-            ]
+            ])
         )
         
         # Définir les permissions pour permettre à tous les utilisateurs d'écrire
@@ -159,35 +156,23 @@ class ProsumaAPIBaseArticleExtractor:
             logger.error(f"❌ Erreur lors de la récupération des informations du magasin: {e}")
             return None
 
-    def count_total_records(self, base_url, shop_id, page_size=1000):
-        """Compte le nombre total d'articles disponibles"""
-        try:
-            url = f"{base_url}/api/product/"
-            params = {
-                'shop': shop_id,
-                'page_size': page_size,
-                'page': 1
-            }
-            
-            response = self.session.get(url, params=params, timeout=30)
-            
-            if response.status_code == 200:
-                data = response.json()
-                total_count = data.get('count', 0)
-                return total_count
-            else:
-                logger.error(f"❌ Erreur lors du comptage: {response.status_code}")
-                return 0
-                
-        except Exception as e:
-            logger.error(f"❌ Erreur lors du comptage: {e}")
-            return 0
+    def create_page_fetcher(self, base_url, shop_id, page_size=1000):
+        """Prépare la pagination de l'endpoint (URL, filtres, taille de page)"""
+        url = f"{base_url}/api/product/"
+        params = {
+            'shop': shop_id,
+            'page_size': page_size
+        }
+        
+        return PageFetcher(self.session, url, params, page_size=page_size, timeout=30,
+                           checkpoint_name="BASE_ARTICLE", snapshot=True)
 
     def get_articles(self, base_url, shop_id, page_size=1000):
         """Récupère les articles avec pagination complète"""
         # D'abord, compter le nombre total d'articles
         logger.info("🔍 Comptage du nombre total d'articles...")
-        total_records = self.count_total_records(base_url, shop_id, page_size)
+        fetcher = self.create_page_fetcher(base_url, shop_id, page_size)
+        total_records = fetcher.count_records()
         
         if total_records == 0:
             logger.warning("⚠️ Aucun article trouvé")
@@ -201,56 +186,14 @@ class ProsumaAPIBaseArticleExtractor:
         logger.info(f"🏪 Magasin: {shop_id}")
         logger.info("=" * 60)
         
-        all_articles = []
-        page = 1
-        total_pages = (total_records + page_size - 1) // page_size  # Calcul du nombre total de pages
+        all_articles = RecordSpool()  # Écrit sur disque page par page (mémoire bornée)
         
         try:
-            while page <= total_pages:
-                url = f"{base_url}/api/product/"
-                params = {
-                    'shop': shop_id,
-                    'page_size': page_size,
-                    'page': page
-                }
-                
-                # Afficher la progression
-                progress_percent = (page - 1) * 100 // total_pages if total_pages > 0 else 0
-                logger.info(f"📄 Récupération page {page}/{total_pages} ({progress_percent}%) - {len(all_articles):,}/{total_records:,} articles...")
-                
-                response = self.session.get(url, params=params, timeout=30)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    articles = data.get('results', [])
-                    
-                    if not articles:
-                        logger.info(f"  ✅ Dernière page atteinte (page {page}) - Aucun article retourné")
-                        break
-                    
-                    all_articles.extend(articles)
-                    logger.info(f"  ✅ Page {page}: {len(articles)} articles récupérés (total: {len(all_articles):,}/{total_records:,})")
-                    
-                    # Vérifier si on a récupéré tous les articles ou si on est à la dernière page
-                    if len(all_articles) >= total_records:
-                        logger.info(f"  ✅ Tous les articles récupérés (page {page}/{total_pages})")
-                        break
-                    
-                    # Si on est à la dernière page calculée, on arrête
-                    if page >= total_pages:
-                        logger.info(f"  ✅ Dernière page atteinte (page {page}/{total_pages})")
-                        break
-                    
-                    # Continuer avec la page suivante
-                    page += 1
-                else:
-                    logger.error(f"❌ Erreur lors de la récupération des articles: {response.status_code}")
-                    # Continuer avec la page suivante en cas d'erreur temporaire
-                    if response.status_code == 500 or response.status_code == 503:
-                        logger.warning(f"⚠️ Erreur serveur, tentative de continuer...")
-                        page += 1
-                        continue
-                    break
+            # Page 1 reprise du comptage, pages 2..N récupérées en parallèle
+            for page, articles in fetcher.iter_pages(total_records):
+                all_articles.extend(articles)
+                progress_percent = page * 100 // fetcher.total_pages
+                logger.info(f"  ✅ Page {page}/{fetcher.total_pages} ({progress_percent}%): {len(articles)} articles récupérés (total: {len(all_articles):,}/{total_records:,})")
                     
         except Exception as e:
             logger.error(f"❌ Erreur lors de la récupération des articles: {e}")
@@ -338,7 +281,8 @@ class ProsumaAPIBaseArticleExtractor:
             
             # Copier vers le réseau et supprimer le fichier local
             network_filepath = os.path.join(network_path, filename)
-            shutil.copy2(local_filepath, network_filepath)
+            with stage('network_copy'):
+                shutil.copy2(local_filepath, network_filepath)
             logger.info(f"✅ Fichier copié sur le réseau: {network_filepath}")
             
             # Supprimer le fichier local
@@ -374,7 +318,7 @@ class ProsumaAPIBaseArticleExtractor:
         
         # Récupérer les informations du magasin
         logger.info(f"Récupération des informations du magasin {shop_code}...")
-        shop_data = self.get_shop_info(base_url, shop_code)
+        shop_data = get_cached_shop_info(self.session, base_url, shop_code, self.get_shop_info)
         if not shop_data:
             logger.error(f"❌ Impossible de récupérer les informations du magasin {shop_code}")
             return False
@@ -398,8 +342,10 @@ class ProsumaAPIBaseArticleExtractor:
         logger.info("=" * 60)
         logger.info(f"💾 EXPORT CSV - MAGASIN {shop_code}")
         logger.info("=" * 60)
-        csv_file = self.export_to_csv(articles, shop_code, shop_name)
+        with stage('csv'):
+            csv_file = self.export_to_csv(articles, shop_code, shop_name)
         if csv_file:
+            record_rows_out(len(articles))
             logger.info("=" * 60)
             logger.info(f"✅ MAGASIN {shop_code} TRAITÉ AVEC SUCCÈS")
             logger.info("=" * 60)
@@ -428,13 +374,12 @@ class ProsumaAPIBaseArticleExtractor:
         total_shops = len(self.shop_codes)
         failed_shops = []  # Liste des magasins en échec avec leur nom
         
+        # Magasins traités en parallèle (plafond de magasins simultanés par serveur)
+        results = run_shops_parallel(self.shop_codes, self.shop_config, self.extract_shop)
+        
         for shop_code in self.shop_codes:
             try:
-                logger.info(f"\n{'='*60}")
-                logger.info(f"TRAITEMENT MAGASIN {shop_code}")
-                logger.info(f"{'='*60}")
-                
-                if self.extract_shop(shop_code):
+                if results[shop_code].result():
                     successful_shops += 1
                 else:
                     # Extraction échouée
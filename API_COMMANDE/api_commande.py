@@ -4,7 +4,6 @@ Extracteur API Prosuma RPOS - Commandes Fournisseurs
 Récupère toutes les commandes fournisseurs via l'API Prosuma avec pagination automatique
 """
 
-import requests
 import os
 import csv
 import json
@@ -17,7 +16,7 @@ import sys
 
 # Ajouter le répertoire parent au path pour importer utils
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler
+from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler, PageFetcher, run_shops_parallel, get_cached_shop_info, RecordSpool, apply_high_water_mark, save_high_water_mark, get_http_session, stage, record_rows_out, shop_log_handlers
 
 # Désactiver les warnings SSL
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -50,9 +49,7 @@ class ProsumaAPICommandeExtractor:
         self.setup_logging()
         
         # Configuration de la session
-        self.session = requests.Session()
-        self.session.auth = (self.username, self.password)
-        self.session.verify = False
+        self.session = get_http_session(self.username, self.password)
         
         print(f"Extracteur API Commandes initialisé pour {self.username}")
         print(f"Magasins configurés: {self.shop_codes}")
@@ -73,11 +70,11 @@ class ProsumaAPICommandeExtractor:
         # Configuration du logging
         logging.basicConfig(
             level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[
+            format='%(asctime)s - %(levelname)s - [%(shop)s] %(message)s',
+            handlers=shop_log_handlers([
                 logging.FileHandler(log_file, encoding='utf-8'),
                 SafeStreamHandler()
-            ]
+            ])
         )
         
         # Définir les permissions pour permettre à tous les utilisateurs d'écrire
@@ -199,42 +196,39 @@ class ProsumaAPICommandeExtractor:
             logger.error(f"❌ Erreur lors de la récupération des informations du magasin: {e}")
             return None
 
-    def count_total_records(self, base_url, shop_id, page_size=1000):
-        """Compte le nombre total de commandes disponibles"""
-        try:
-            url = f"{base_url}/api/supplier_order/"
-            params = {
-                'shop': shop_id,
-                'page_size': page_size,
-                'page': 1,
-                'date_0': self.start_date.strftime('%Y-%m-%dT00:00:00'),
-                'date_1': self.end_date.strftime('%Y-%m-%dT23:59:59'),
-                'is_deleted': 'false'
-            }
-            
-            # Ajouter le filtre de statut si spécifié
-            if self.status_filter and self.status_filter.lower() == 'en attente de livraison':
+    def create_page_fetcher(self, base_url, shop_id, page_size=1000):
+        """Prépare la pagination de l'endpoint (URL, filtres, taille de page)"""
+        url = f"{base_url}/api/supplier_order/"
+        params = {
+            'shop': shop_id,
+            'page_size': page_size,
+            'date_0': self.start_date.strftime('%Y-%m-%dT00:00:00'),
+            'date_1': self.end_date.strftime('%Y-%m-%dT23:59:59'),
+            'is_deleted': 'false'
+        }
+        
+        # Ajouter le filtre de statut si spécifié
+        if self.status_filter:
+            if self.status_filter.lower() == 'en attente de livraison':
                 params['is_awaiting_delivery'] = 'true'
-            
-            response = self.session.get(url, params=params, timeout=30)
-            
-            if response.status_code == 200:
-                data = response.json()
-                total_count = data.get('count', 0)
-                return total_count
+                logger.info(f"Filtre API: is_awaiting_delivery=true")
             else:
-                logger.error(f"❌ Erreur lors du comptage: {response.status_code}")
-                return 0
-                
-        except Exception as e:
-            logger.error(f"❌ Erreur lors du comptage: {e}")
-            return 0
+                logger.info(f"Filtre de statut: '{self.status_filter}' (filtrage post-récupération)")
+        else:
+            logger.info("Aucun filtre de statut - récupération de toutes les commandes")
+        
+        # Mode incrémental: ne demander que les enregistrements après le dernier export
+        apply_high_water_mark(params, "COMMANDE", base_url, shop_id)
+        
+        return PageFetcher(self.session, url, params, page_size=page_size, timeout=60,
+                           checkpoint_name="COMMANDE")
 
     def get_orders(self, base_url, shop_id, page_size=1000):
         """Récupère les commandes avec pagination complète"""
         # D'abord, compter le nombre total de commandes
         logger.info("🔍 Comptage du nombre total de commandes...")
-        total_records = self.count_total_records(base_url, shop_id, page_size)
+        fetcher = self.create_page_fetcher(base_url, shop_id, page_size)
+        total_records = fetcher.count_records()
         
         if total_records == 0:
             logger.warning("⚠️ Aucune commande trouvée")
@@ -250,60 +244,14 @@ class ProsumaAPICommandeExtractor:
         logger.info("=" * 60)
         
         try:
-            url = f"{base_url}/api/supplier_order/"
-            params = {
-                'shop': shop_id,
-                'page_size': page_size,
-                'date_0': self.start_date.strftime('%Y-%m-%dT00:00:00'),
-                'date_1': self.end_date.strftime('%Y-%m-%dT23:59:59'),
-                'is_deleted': 'false'
-            }
-            
-            # Ajouter le filtre de statut si spécifié
-            if self.status_filter:
-                if self.status_filter.lower() == 'en attente de livraison':
-                    params['is_awaiting_delivery'] = 'true'
-                    logger.info(f"Filtre API: is_awaiting_delivery=true")
-                else:
-                    logger.info(f"Filtre de statut: '{self.status_filter}' (filtrage post-récupération)")
-            else:
-                logger.info("Aucun filtre de statut - récupération de toutes les commandes")
-            
-            all_orders = []
-            page = 1
-            total_pages = (total_records + page_size - 1) // page_size
-            
-            while page <= total_pages:
-                # Afficher la progression
-                progress_percent = (page - 1) * 100 // total_pages if total_pages > 0 else 0
-                logger.info(f"📄 Récupération page {page}/{total_pages} ({progress_percent}%) - {len(all_orders):,}/{total_records:,} commandes...")
-                
-                params['page'] = page
-                
-                response = self.session.get(url, params=params, timeout=60)
-                response.raise_for_status()
-                data = response.json()
-                
-                orders_on_page = data.get('results', [])
+            all_orders = RecordSpool()  # Écrit sur disque page par page (mémoire bornée)
+            # Page 1 reprise du comptage, pages 2..N récupérées en parallèle
+            for page, orders_on_page in fetcher.iter_pages(total_records):
                 all_orders.extend(orders_on_page)
-                
-                logger.info(f"  ✅ Page {page}: {len(orders_on_page)} commandes récupérées (total: {len(all_orders):,}/{total_records:,})")
-                
-                # Vérifier s'il y a une page suivante
-                if not data.get('next'):
-                    logger.info(f"  ✅ Dernière page atteinte (page {page})")
-                    break
-                
-                page += 1
+                progress_percent = page * 100 // fetcher.total_pages
+                logger.info(f"  ✅ Page {page}/{fetcher.total_pages} ({progress_percent}%): {len(orders_on_page)} commandes récupérées (total: {len(all_orders):,}/{total_records:,})")
             
-            # Filtrage post-récupération si nécessaire
-            if self.status_filter and self.status_filter.lower() != 'en attente de livraison':
-                logger.info(f"Filtrage post-récupération pour le statut: '{self.status_filter}'")
-                original_count = len(all_orders)
-                all_orders = [order for order in all_orders 
-                            if order.get('status', '').lower() == self.status_filter.lower()]
-                filtered_count = len(all_orders)
-                logger.info(f"Filtrage: {original_count} -> {filtered_count} commandes")
+            all_orders = self.filter_orders(all_orders)
             
             # Afficher le résumé final
             logger.info("=" * 60)
@@ -321,6 +269,21 @@ class ProsumaAPICommandeExtractor:
             logger.error(f"❌ Erreur lors de la récupération des commandes: {e}")
             return []
 
+    def matches_api_filters(self, order):
+        """Équivalent local des filtres API (is_deleted=false), pour le mode commandes groupées"""
+        return not order.get('is_deleted')
+
+    def filter_orders(self, all_orders):
+        """Filtrage post-récupération (statut)"""
+        if self.status_filter and self.status_filter.lower() != 'en attente de livraison':
+            logger.info(f"Filtrage post-récupération pour le statut: '{self.status_filter}'")
+            original_count = len(all_orders)
+            all_orders = RecordSpool(order for order in all_orders 
+                        if order.get('status', '').lower() == self.status_filter.lower())
+            filtered_count = len(all_orders)
+            logger.info(f"Filtrage: {original_count} -> {filtered_count} commandes")
+        return all_orders
+
     def export_to_csv(self, orders, shop_code, shop_name):
         """Exporte les commandes vers un fichier CSV"""
         if not orders:
@@ -395,7 +358,8 @@ class ProsumaAPICommandeExtractor:
             
             # Copier vers le réseau et supprimer le fichier local
             network_filepath = os.path.join(network_path, filename)
-            shutil.copy2(local_filepath, network_filepath)
+            with stage('network_copy'):
+                shutil.copy2(local_filepath, network_filepath)
             logger.info(f"✅ Fichier copié sur le réseau: {network_filepath}")
             
             # Supprimer le fichier local
@@ -431,7 +395,7 @@ class ProsumaAPICommandeExtractor:
         
         # Récupérer les informations du magasin
         logger.info(f"Récupération des informations du magasin {shop_code}...")
-        shop_data = self.get_shop_info(base_url, shop_code)
+        shop_data = get_cached_shop_info(self.session, base_url, shop_code, self.get_shop_info)
         if not shop_data:
             logger.error(f"❌ Impossible de récupérer les informations du magasin {shop_code}")
             return False
@@ -455,8 +419,11 @@ class ProsumaAPICommandeExtractor:
         logger.info("=" * 60)
         logger.info(f"💾 EXPORT CSV - MAGASIN {shop_code}")
         logger.info("=" * 60)
-        csv_file = self.export_to_csv(orders, shop_code, shop_name)
+        with stage('csv'):
+            csv_file = self.export_to_csv(orders, shop_code, shop_name)
         if csv_file:
+            record_rows_out(len(orders))
+            save_high_water_mark("COMMANDE", base_url, shop_id, orders)
             logger.info("=" * 60)
             logger.info(f"✅ MAGASIN {shop_code} TRAITÉ AVEC SUCCÈS")
             logger.info("=" * 60)
@@ -485,13 +452,12 @@ class ProsumaAPICommandeExtractor:
         total_shops = len(self.shop_codes)
         failed_shops = []  # Liste des magasins en échec avec leur nom
         
+        # Magasins traités en parallèle (plafond de magasins simultanés par serveur)
+        results = run_shops_parallel(self.shop_codes, self.shop_config, self.extract_shop)
+        
         for shop_code in self.shop_codes:
             try:
-                logger.info(f"\n{'='*60}")
-                logger.info(f"TRAITEMENT MAGASIN {shop_code}")
-                logger.info(f"{'='*60}")
-                
-                if self.extract_shop(shop_code):
+                if results[shop_code].result():
                     successful_shops += 1
                     logger.info(f"✅ Magasin {shop_code} traité avec succès")
                 else:
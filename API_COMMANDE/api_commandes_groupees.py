@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Extracteur API Prosuma RPOS - Commandes groupées (Toutes, Directes, Réassort)
+Récupère une seule fois les commandes fournisseurs d'un magasin et produit les
+trois exports COMMANDE, COMMANDE_DIRECTE et COMMANDE_REASSORT en un seul passage
+"""
+
+import os
+import sys
+import logging
+import urllib3
+
+# Ajouter le répertoire parent et les dossiers des APIs de commandes au path
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(project_root)
+for api_folder in ('API_COMMANDE', 'API_COMMANDE_DIRECTE', 'API_COMMANDE_REASSORT'):
+    sys.path.append(os.path.join(project_root, api_folder))
+
+from utils import PageFetcher, run_shops_parallel, get_cached_shop_info, get_cached_suppliers, RecordSpool, extract_object_id, apply_high_water_mark, save_high_water_mark, mark_shop_incomplete, is_since, stage, record_rows_out
+from api_commande import ProsumaAPICommandeExtractor
+from api_commande_directe import ProsumaAPICommandeDirecteExtractor
+from api_commande_reassort import ProsumaAPICommandeReassortExtractor
+
+# Désactiver les warnings SSL
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+logger = logging.getLogger(__name__)
+
+class ProsumaAPICommandesGroupeesExtractor:
+    """Les trois extractions de commandes à partir d'une seule pagination de /api/supplier_order/.
+
+    La fenêtre (magasin + dates, et is_awaiting_delivery si ce statut est
+    demandé) est récupérée sans les filtres propres à chaque API. Les
+    fournisseurs sont enrichis une fois (cache partagé), puis chaque commande
+    est répartie vers les extracteurs dont elle satisfait les filtres API
+    (matches_api_filters). Chaque extracteur applique ensuite son propre
+    filtrage post-récupération (filter_orders) et son export_to_csv habituel.
+    """
+
+    APIS = ('COMMANDE', 'COMMANDE_DIRECTE', 'COMMANDE_REASSORT')
+
+    def __init__(self):
+        self.commande = ProsumaAPICommandeExtractor()
+        self.directe = ProsumaAPICommandeDirecteExtractor()
+        self.reassort = ProsumaAPICommandeReassortExtractor()
+        self.extractors = (self.commande, self.directe, self.reassort)
+
+        # Configuration commune (config.env, magasins.json, dates, statut)
+        self.session = self.commande.session
+        for extractor in self.extractors:
+            extractor.session = self.session
+        self.shop_config = self.commande.shop_config
+        self.shop_codes = self.commande.shop_codes
+        self.start_date = self.commande.start_date
+        self.end_date = self.commande.end_date
+        self.status_filter = self.commande.status_filter
+
+    def get_start_dates(self, base_url, shop_id):
+        """date_0 de chaque API: début de la période, ou son point de reprise en mode incrémental"""
+        start_dates = {}
+        for api_name in self.APIS:
+            params = {
+                'date_0': self.start_date.strftime('%Y-%m-%dT00:00:00'),
+                'date_1': self.end_date.strftime('%Y-%m-%dT23:59:59')
+            }
+            start_dates[api_name] = apply_high_water_mark(params, api_name, base_url, shop_id)['date_0']
+        return start_dates
+
+    def create_page_fetcher(self, base_url, shop_id, start_dates, page_size=1000):
+        """Prépare la pagination de la fenêtre commune aux trois APIs"""
+        url = f"{base_url}/api/supplier_order/"
+        params = {
+            'shop': shop_id,
+            'page_size': page_size,
+            # Mode incrémental: repartir du point de reprise le plus ancien des trois APIs
+            'date_0': min(start_dates.values()),
+            'date_1': self.end_date.strftime('%Y-%m-%dT23:59:59')
+        }
+        if self.status_filter and self.status_filter.lower() == 'en attente de livraison':
+            params['is_awaiting_delivery'] = 'true'
+            logger.info(f"Filtre API: is_awaiting_delivery=true")
+
+        return PageFetcher(self.session, url, params, page_size=page_size, timeout=60,
+                           checkpoint_name="COMMANDES_GROUPEES")
+
+    def get_orders(self, base_url, shop_id, start_dates, page_size=1000):
+        """Récupère toutes les commandes de la fenêtre commune (sur disque, mémoire bornée)"""
+        logger.info("🔍 Comptage du nombre total de commandes (toutes APIs confondues)...")
+        fetcher = self.create_page_fetcher(base_url, shop_id, start_dates, page_size)
+        total_records = fetcher.count_records()
+
+        all_orders = RecordSpool()
+        if total_records == 0:
+            logger.warning("⚠️ Aucune commande trouvée")
+            return all_orders
+
+        logger.info("=" * 60)
+        logger.info(f"📊 INFORMATIONS D'EXTRACTION - MAGASIN {shop_id}")
+        logger.info("=" * 60)
+        logger.info(f"📊 Total commandes disponibles: {total_records:,}")
+        logger.info(f"📅 Période: {self.start_date.strftime('%Y-%m-%d')} à {self.end_date.strftime('%Y-%m-%d')}")
+        logger.info("=" * 60)
+
+        try:
+            # Page 1 reprise du comptage, pages 2..N récupérées en parallèle
+            for page, orders_on_page in fetcher.iter_pages(total_records):
+                all_orders.extend(orders_on_page)
+                progress_percent = page * 100 // fetcher.total_pages
+                logger.info(f"  ✅ Page {page}/{fetcher.total_pages} ({progress_percent}%): {len(orders_on_page)} commandes récupérées (total: {len(all_orders):,}/{total_records:,})")
+        except Exception as e:
+            logger.error(f"❌ Erreur lors de la récupération des commandes: {e}")
+            # Commandes tronquées: les points de reprise des trois APIs ne doivent pas avancer
+            mark_shop_incomplete()
+
+        return all_orders
+
+    def route_orders(self, base_url, orders, start_dates):
+        """Enrichit les fournisseurs une fois et répartit les commandes entre les trois APIs.
+
+        Chaque API ne reçoit que les commandes postérieures à son propre date_0:
+        la fenêtre commune part du point de reprise le plus ancien des trois.
+        """
+        supplier_ids = {extract_object_id(order.get('supplier', {})) for order in orders}
+        supplier_ids.discard(None)
+        suppliers = get_cached_suppliers(self.session, base_url, supplier_ids, self.reassort.get_supplier_info)
+
+        matchers = {
+            'COMMANDE': self.commande.matches_api_filters,
+            'COMMANDE_DIRECTE': self.directe.matches_api_filters,
+            'COMMANDE_REASSORT': self.reassort.matches_api_filters,
+        }
+        routed = {api_name: RecordSpool() for api_name in self.APIS}
+        for order in orders:
+            supplier = order.get('supplier')
+            supplier_info = suppliers.get(extract_object_id(supplier or {}))
+            # is_central de la commande d'abord (comme le filtre du serveur), sinon celui du
+            # fournisseur (en ID ou URL compris), None si inconnu
+            if order.get('is_central') is None:
+                if supplier_info:
+                    order['is_central'] = supplier_info.get('is_central', False)
+                elif isinstance(supplier, dict):
+                    order['is_central'] = supplier.get('is_central')
+                else:
+                    order['is_central'] = None
+            if isinstance(supplier, dict) and order['is_central'] is not None:
+                supplier['is_central'] = order['is_central']
+
+            for api_name, matches_api_filters in matchers.items():
+                if matches_api_filters(order) and is_since(order, start_dates[api_name]):
+                    routed[api_name].append(order)
+
+        for api_name, api_orders in routed.items():
+            logger.info(f"   📦 {api_name}: {len(api_orders):,} commande(s)")
+        return routed
+
+    def extract_shop(self, shop_code):
+        """Extrait et exporte les trois types de commandes pour un magasin"""
+        shop_info = self.shop_config.get(shop_code)
+        if not shop_info:
+            logger.error(f"Configuration manquante pour le magasin {shop_code}")
+            return False
+
+        base_url = shop_info['url']
+        shop_name = shop_info['name']
+
+        logger.info(f"==================================================")
+        logger.info(f"EXTRACTION COMMANDES GROUPÉES MAGASIN {shop_code}")
+        logger.info(f"==================================================")
+
+        if not self.commande.test_api_connection(base_url):
+            logger.error(f"❌ Impossible de se connecter au serveur {base_url}")
+            return False
+
+        shop_data = get_cached_shop_info(self.session, base_url, shop_code, self.commande.get_shop_info)
+        shop_id = (shop_data or {}).get('id')
+        if not shop_id:
+            logger.error(f"❌ Impossible de récupérer les informations du magasin {shop_code}")
+            return False
+
+        start_dates = self.get_start_dates(base_url, shop_id)
+        orders = self.get_orders(base_url, shop_id, start_dates)
+        if not orders:
+            logger.warning(f"⚠️ Aucune commande trouvée pour le magasin {shop_code}")
+            return True
+
+        routed = self.route_orders(base_url, orders, start_dates)
+        exports = {
+            'COMMANDE': (self.commande, self.commande.filter_orders(routed['COMMANDE'])),
+            'COMMANDE_DIRECTE': (self.directe, self.directe.filter_orders(routed['COMMANDE_DIRECTE'])),
+            'COMMANDE_REASSORT': (self.reassort, self.reassort.filter_orders(base_url, routed['COMMANDE_REASSORT'])),
+        }
+
+        success = True
+        for api_name, (extractor, api_orders) in exports.items():
+            if not api_orders:
+                logger.warning(f"⚠️ {api_name}: aucune commande à exporter pour le magasin {shop_code}")
+                continue
+            with stage('csv'):
+                csv_file = extractor.export_to_csv(api_orders, shop_code, shop_name)
+            if csv_file:
+                record_rows_out(len(api_orders))
+                save_high_water_mark(api_name, base_url, shop_id, api_orders)
+                logger.info(f"✅ {api_name}: {len(api_orders):,} lignes exportées -> {csv_file}")
+            else:
+                logger.error(f"❌ {api_name}: erreur lors de l'export pour le magasin {shop_code}")
+                success = False
+        return success
+
+    def extract_all(self):
+        """Extrait les commandes groupées pour tous les magasins configurés"""
+        logger.info("=" * 60)
+        logger.info("DÉBUT DE L'EXTRACTION API PROSUMA - COMMANDES GROUPÉES")
+        logger.info("=" * 60)
+
+        results = run_shops_parallel(self.shop_codes, self.shop_config, self.extract_shop)
+
+        failed_shops = []
+        for shop_code in self.shop_codes:
+            try:
+                if not results[shop_code].result():
+                    failed_shops.append(shop_code)
+            except Exception as e:
+                logger.error(f"❌ Erreur lors de l'extraction du magasin {shop_code}: {e}")
+                failed_shops.append(shop_code)
+
+        total_shops = len(self.shop_codes)
+        logger.info("=" * 60)
+        logger.info(f"✅ Magasins traités avec succès: {total_shops - len(failed_shops)}/{total_shops}")
+        for shop_code in failed_shops:
+            shop_name = self.shop_config.get(shop_code, {}).get('name', 'Nom inconnu')
+            logger.warning(f"   ❌ Code magasin: {shop_code} - Nom: {shop_name}")
+        logger.info("=" * 60)
+        return not failed_shops
+
+def main():
+    """Fonction principale"""
+    try:
+        extractor = ProsumaAPICommandesGroupeesExtractor()
+        extractor.extract_all()
+    except Exception as e:
+        print(f"❌ Erreur fatale: {e}")
+
+if __name__ == "__main__":
+    main()
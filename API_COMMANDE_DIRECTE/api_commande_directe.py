@@ -4,7 +4,6 @@ Extracteur API Prosuma RPOS - Commandes Directes
 Récupère les commandes directes via l'API Prosuma avec pagination automatique
 """
 
-import requests
 import os
 import csv
 import json
@@ -18,7 +17,7 @@ import sys
 
 # Ajouter le répertoire parent au path pour importer utils
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler
+from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler, PageFetcher, run_shops_parallel, get_cached_shop_info, apply_high_water_mark, save_high_water_mark, RecordSpool, get_http_session, stage, record_rows_out, shop_log_handlers
 
 # Désactiver les warnings SSL
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -112,9 +111,7 @@ class ProsumaAPICommandeDirecteExtractor:
         self.setup_logging()
         
         # Configuration de la session
-        self.session = requests.Session()
-        self.session.auth = (self.username, self.password)
-        self.session.verify = False
+        self.session = get_http_session(self.username, self.password)
         
         print(f"Extracteur API Commandes Directes initialisé pour {self.username}")
         print(f"Magasins configurés: {self.shop_codes}")
@@ -164,11 +161,11 @@ class ProsumaAPICommandeDirecteExtractor:
         try:
             logging.basicConfig(
                 level=logging.INFO,
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                handlers=[
+                format='%(asctime)s - %(levelname)s - [%(shop)s] %(message)s',
+                handlers=shop_log_handlers([
                     logging.FileHandler(log_file, encoding='utf-8'),
                     SafeStreamHandler()
-                ]
+                ])
             )
             
             # Définir les permissions pour permettre à tous les utilisateurs d'écrire
@@ -181,8 +178,8 @@ class ProsumaAPICommandeDirecteExtractor:
             print("⚠️ Les logs seront affichés uniquement dans la console")
             logging.basicConfig(
                 level=logging.INFO,
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                handlers=[SafeStreamHandler()]
+                format='%(asctime)s - %(levelname)s - [%(shop)s] %(message)s',
+                handlers=shop_log_handlers([SafeStreamHandler()])
             )
         
         global logger
@@ -343,41 +340,39 @@ class ProsumaAPICommandeDirecteExtractor:
             logger.error(f"❌ Erreur lors de la récupération des informations du magasin: {e}")
             return None
 
-    def count_total_records(self, base_url, shop_id, page_size=1000):
-        """Compte le nombre total de commandes directes disponibles"""
-        try:
-            url = f"{base_url}/api/supplier_order/"
-            params = {
-                'shop': shop_id,
-                'page_size': page_size,
-                'page': 1,
-                'is_direct': 'true',  # Récupérer uniquement les commandes directes
-                'is_central': 'false',  # Exclure les commandes centrales
-                'date_0': self.start_date.strftime('%Y-%m-%dT00:00:00'),
-                'date_1': self.end_date.strftime('%Y-%m-%dT23:59:59')
-            }
-            if self.status_filter and self.status_filter.lower() == 'en attente de livraison':
-                params['is_awaiting_delivery'] = 'true'
-            
-            response = self.session.get(url, params=params, timeout=30)
-            
-            if response.status_code == 200:
-                data = response.json()
-                total_count = data.get('count', 0)
-                return total_count
-            else:
-                logger.error(f"❌ Erreur lors du comptage: {response.status_code}")
-                return 0
-                
-        except Exception as e:
-            logger.error(f"❌ Erreur lors du comptage: {e}")
-            return 0
+    def create_page_fetcher(self, base_url, shop_id, page_size=1000):
+        """Prépare la pagination de l'endpoint (URL, filtres, taille de page)"""
+        url = f"{base_url}/api/supplier_order/"
+        params = {
+            'shop': shop_id,
+            'page_size': page_size,
+            'is_direct': 'true',  # Récupérer uniquement les commandes directes
+            'is_central': 'false',  # Exclure les commandes centrales
+            'date_0': self.start_date.strftime('%Y-%m-%dT00:00:00'),
+            'date_1': self.end_date.strftime('%Y-%m-%dT23:59:59')
+        }
+        if self.status_filter and self.status_filter.lower() == 'en attente de livraison':
+            params['is_awaiting_delivery'] = 'true'
+            logger.info(f"Filtre API: is_awaiting_delivery=true")
+        
+        logger.info(f"🔍 Filtres API appliqués:")
+        logger.info(f"   - is_direct: true (commandes directes uniquement)")
+        logger.info(f"   - is_central: false (exclure les commandes centrales)")
+        if self.status_filter:
+            logger.info(f"   - status: {self.status_filter}")
+        
+        # Mode incrémental: ne demander que les enregistrements après le dernier export
+        apply_high_water_mark(params, "COMMANDE_DIRECTE", base_url, shop_id)
+        
+        return PageFetcher(self.session, url, params, page_size=page_size, timeout=60,
+                           checkpoint_name="COMMANDE_DIRECTE")
 
     def get_orders(self, base_url, shop_id, page_size=1000):
         """Récupère les commandes directes avec pagination complète"""
         # D'abord, compter le nombre total de commandes
         logger.info("🔍 Comptage du nombre total de commandes directes...")
-        total_records = self.count_total_records(base_url, shop_id, page_size)
+        fetcher = self.create_page_fetcher(base_url, shop_id, page_size)
+        total_records = fetcher.count_records()
         
         if total_records == 0:
             logger.warning("⚠️ Aucune commande directe trouvée")
@@ -393,89 +388,14 @@ class ProsumaAPICommandeDirecteExtractor:
         logger.info("=" * 60)
         
         try:
-            url = f"{base_url}/api/supplier_order/"
-            params = {
-                'shop': shop_id,
-                'page_size': page_size,
-                'is_direct': 'true',  # Récupérer uniquement les commandes directes
-                'is_central': 'false',  # Exclure les commandes centrales
-                'date_0': self.start_date.strftime('%Y-%m-%dT00:00:00'),
-                'date_1': self.end_date.strftime('%Y-%m-%dT23:59:59')
-            }
-            if self.status_filter and self.status_filter.lower() == 'en attente de livraison':
-                params['is_awaiting_delivery'] = 'true'
-                logger.info(f"Filtre API: is_awaiting_delivery=true")
-            
-            logger.info(f"🔍 Filtres API appliqués:")
-            logger.info(f"   - is_direct: true (commandes directes uniquement)")
-            logger.info(f"   - is_central: false (exclure les commandes centrales)")
-            if self.status_filter:
-                logger.info(f"   - status: {self.status_filter}")
-            
             all_orders = []
-            page = 1
-            total_pages = (total_records + page_size - 1) // page_size
-            
-            while page <= total_pages:
-                # Afficher la progression
-                progress_percent = (page - 1) * 100 // total_pages if total_pages > 0 else 0
-                logger.info(f"📄 Récupération page {page}/{total_pages} ({progress_percent}%) - {len(all_orders):,}/{total_records:,} commandes...")
-                
-                params['page'] = page
-                
-                response = self.session.get(url, params=params, timeout=60)
-                response.raise_for_status()
-                data = response.json()
-                
-                orders_on_page = data.get('results', [])
+            # Page 1 reprise du comptage, pages 2..N récupérées en parallèle
+            for page, orders_on_page in fetcher.iter_pages(total_records):
                 all_orders.extend(orders_on_page)
-                
-                logger.info(f"  ✅ Page {page}: {len(orders_on_page)} commandes directes récupérées (total: {len(all_orders):,}/{total_records:,})")
-                
-                # Vérifier s'il y a une page suivante
-                if not data.get('next'):
-                    logger.info(f"  ✅ Dernière page atteinte (page {page})")
-                    break
-                
-                page += 1
-            
-            # Filtrage post-récupération pour exclure les commandes centrales (sécurité supplémentaire)
-            original_count = len(all_orders)
-            filtered_orders = []
-            central_orders_excluded = 0
-            
-            for order in all_orders:
-                # Vérifier is_central dans la commande elle-même
-                is_central = order.get('is_central', None)
-                
-                # Si pas dans order, chercher dans supplier
-                if is_central is None:
-                    supplier = order.get('supplier', {})
-                    if isinstance(supplier, dict):
-                        is_central = supplier.get('is_central', None)
-                
-                # Exclure les commandes centrales (is_central=True)
-                if is_central is not None and is_central:
-                    central_orders_excluded += 1
-                    logger.debug(f"❌ Commande centrale exclue: {order.get('reference', order.get('id', 'N/A'))} (is_central=True)")
-                else:
-                    # Commande directe non centrale, on la garde
-                    filtered_orders.append(order)
-            
-            if central_orders_excluded > 0:
-                logger.info(f"🔍 Filtrage post-récupération: {central_orders_excluded} commande(s) centrale(s) exclue(s)")
-                logger.info(f"   Commandes directes retenues: {len(filtered_orders):,}/{original_count:,}")
+                progress_percent = page * 100 // fetcher.total_pages
+                logger.info(f"  ✅ Page {page}/{fetcher.total_pages} ({progress_percent}%): {len(orders_on_page)} commandes directes récupérées (total: {len(all_orders):,}/{total_records:,})")
             
-            all_orders = filtered_orders
-            
-            # Filtrage post-récupération pour le statut si nécessaire
-            if self.status_filter and self.status_filter.lower() != 'en attente de livraison':
-                logger.info(f"Filtrage post-récupération pour le statut: '{self.status_filter}'")
-                original_count = len(all_orders)
-                all_orders = [order for order in all_orders 
-                              if (order.get('status_display') or order.get('status', '')).lower() == self.status_filter.lower()]
-                filtered_count = len(all_orders)
-                logger.info(f"Filtrage: {original_count} -> {filtered_count} commandes")
+            all_orders = self.filter_orders(all_orders)
 
             # Afficher le résumé final
             logger.info("=" * 60)
@@ -493,6 +413,58 @@ class ProsumaAPICommandeDirecteExtractor:
             logger.error(f"❌ Erreur lors de la récupération des commandes directes: {e}")
             return []
 
+    def matches_api_filters(self, order):
+        """Équivalent local des filtres API (is_direct=true, is_central=false), pour le mode commandes groupées.
+        is_central est lu sur la commande ou son fournisseur, enrichis au préalable: une
+        commande dont le fournisseur n'a pas pu être résolu est exclue (le serveur
+        l'exclurait aussi avec is_central=false)"""
+        supplier = order.get('supplier', {})
+        is_central = order.get('is_central')
+        if is_central is None and isinstance(supplier, dict):
+            is_central = supplier.get('is_central')
+        return order.get('is_direct') is True and is_central is not None and not is_central
+
+    def filter_orders(self, all_orders):
+        """Filtrage post-récupération (commandes centrales, statut)"""
+        # Filtrage post-récupération pour exclure les commandes centrales (sécurité supplémentaire)
+        original_count = len(all_orders)
+        filtered_orders = RecordSpool()
+        central_orders_excluded = 0
+        
+        for order in all_orders:
+            # Vérifier is_central dans la commande elle-même
+            is_central = order.get('is_central', None)
+            
+            # Si pas dans order, chercher dans supplier
+            if is_central is None:
+                supplier = order.get('supplier', {})
+                if isinstance(supplier, dict):
+                    is_central = supplier.get('is_central', None)
+            
+            # Exclure les commandes centrales (is_central=True)
+            if is_central is not None and is_central:
+                central_orders_excluded += 1
+                logger.debug(f"❌ Commande centrale exclue: {order.get('reference', order.get('id', 'N/A'))} (is_central=True)")
+            else:
+                # Commande directe non centrale, on la garde
+                filtered_orders.append(order)
+        
+        if central_orders_excluded > 0:
+            logger.info(f"🔍 Filtrage post-récupération: {central_orders_excluded} commande(s) centrale(s) exclue(s)")
+            logger.info(f"   Commandes directes retenues: {len(filtered_orders):,}/{original_count:,}")
+        
+        all_orders = filtered_orders
+        
+        # Filtrage post-récupération pour le statut si nécessaire
+        if self.status_filter and self.status_filter.lower() != 'en attente de livraison':
+            logger.info(f"Filtrage post-récupération pour le statut: '{self.status_filter}'")
+            original_count = len(all_orders)
+            all_orders = RecordSpool(order for order in all_orders 
+                                     if (order.get('status_display') or order.get('status', '')).lower() == self.status_filter.lower())
+            filtered_count = len(all_orders)
+            logger.info(f"Filtrage: {original_count} -> {filtered_count} commandes")
+        return all_orders
+
     def export_to_csv(self, orders, shop_code, shop_name):
         """Exporte les commandes directes vers un fichier CSV"""
         if not orders:
@@ -618,7 +590,7 @@ class ProsumaAPICommandeDirecteExtractor:
         
         # Récupérer les informations du magasin
         logger.info(f"Récupération des informations du magasin {shop_code}...")
-        shop_data = self.get_shop_info(base_url, shop_code)
+        shop_data = get_cached_shop_info(self.session, base_url, shop_code, self.get_shop_info)
         if not shop_data:
             logger.error(f"❌ Impossible de récupérer les informations du magasin {shop_code}")
             return False
@@ -642,8 +614,11 @@ class ProsumaAPICommandeDirecteExtractor:
         logger.info("=" * 60)
         logger.info(f"💾 EXPORT CSV - MAGASIN {shop_code}")
         logger.info("=" * 60)
-        csv_file = self.export_to_csv(orders, shop_code, shop_name)
+        with stage('csv'):
+            csv_file = self.export_to_csv(orders, shop_code, shop_name)
         if csv_file:
+            record_rows_out(len(orders))
+            save_high_water_mark("COMMANDE_DIRECTE", base_url, shop_id, orders)
             logger.info("=" * 60)
             logger.info(f"✅ MAGASIN {shop_code} TRAITÉ AVEC SUCCÈS")
             logger.info("=" * 60)
@@ -674,13 +649,12 @@ class ProsumaAPICommandeDirecteExtractor:
         total_shops = len(self.shop_codes)
         failed_shops = []  # Liste des magasins en échec avec leur nom
         
+        # Magasins traités en parallèle (plafond de magasins simultanés par serveur)
+        results = run_shops_parallel(self.shop_codes, self.shop_config, self.extract_shop)
+        
         for shop_code in self.shop_codes:
             try:
-                logger.info(f"\n{'='*60}")
-                logger.info(f"TRAITEMENT MAGASIN {shop_code}")
-                logger.info(f"{'='*60}")
-                
-                if self.extract_shop(shop_code):
+                if results[shop_code].result():
                     successful_shops += 1
                     logger.info(f"✅ Magasin {shop_code} traité avec succès")
                 else:
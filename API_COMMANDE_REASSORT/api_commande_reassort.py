@@ -4,7 +4,6 @@ Extracteur API Prosuma RPOS - Commandes Réassort
 Récupère les commandes réassort via l'API Prosuma avec pagination automatique
 """
 
-import requests
 import os
 import csv
 import json
@@ -19,7 +18,7 @@ import sys
 
 # Ajouter le répertoire parent au path pour importer utils
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler
+from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler, PageFetcher, run_shops_parallel, get_cached_shop_info, apply_high_water_mark, save_high_water_mark, extract_object_id, get_cached_suppliers, RecordSpool, get_http_session, stage, record_rows_out, shop_log_handlers
 
 # Désactiver les warnings SSL
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -113,9 +112,7 @@ class ProsumaAPICommandeReassortExtractor:
         self.setup_logging()
         
         # Configuration de la session
-        self.session = requests.Session()
-        self.session.auth = (self.username, self.password)
-        self.session.verify = False
+        self.session = get_http_session(self.username, self.password)
         
         print(f"Extracteur API Commandes Réassort initialisé pour {self.username}")
         print(f"Magasins configurés: {self.shop_codes}")
@@ -165,11 +162,11 @@ class ProsumaAPICommandeReassortExtractor:
         try:
             logging.basicConfig(
                 level=logging.INFO,
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                handlers=[
+                format='%(asctime)s - %(levelname)s - [%(shop)s] %(message)s',
+                handlers=shop_log_handlers([
                     logging.FileHandler(log_file, encoding='utf-8'),
                     SafeStreamHandler()
-                ]
+                ])
             )
             
             # Définir les permissions pour permettre à tous les utilisateurs d'écrire
@@ -182,8 +179,8 @@ class ProsumaAPICommandeReassortExtractor:
             print("⚠️ Les logs seront affichés uniquement dans la console")
             logging.basicConfig(
                 level=logging.INFO,
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                handlers=[SafeStreamHandler()]
+                format='%(asctime)s - %(levelname)s - [%(shop)s] %(message)s',
+                handlers=shop_log_handlers([SafeStreamHandler()])
             )
         
         global logger
@@ -441,43 +438,23 @@ class ProsumaAPICommandeReassortExtractor:
         # Collecter tous les IDs de fournisseurs uniques
         supplier_ids = set()
         for order in orders:
-            supplier = order.get('supplier', {})
-            if isinstance(supplier, dict):
-                supplier_id = supplier.get('id')
-                if supplier_id:
-                    supplier_ids.add(supplier_id)
-            elif isinstance(supplier, str):
-                # Si supplier est une URL, extraire l'ID
-                if supplier.endswith('/'):
-                    supplier = supplier[:-1]
-                supplier_id = supplier.split('/')[-1]
-                if supplier_id:
-                    supplier_ids.add(supplier_id)
+            supplier_id = extract_object_id(order.get('supplier', {}))
+            if supplier_id:
+                supplier_ids.add(supplier_id)
         
         logger.info(f"   📊 {len(supplier_ids)} fournisseur(s) unique(s) à récupérer")
         
-        # Créer un cache pour les informations des fournisseurs
-        supplier_cache = {}
-        for supplier_id in supplier_ids:
-            supplier_info = self.get_supplier_info(base_url, supplier_id)
-            if supplier_info:
-                supplier_cache[supplier_id] = supplier_info
+        # Fournisseurs: cache disque partagé par les magasins et les APIs d'un même serveur
+        supplier_cache = get_cached_suppliers(self.session, base_url, supplier_ids, self.get_supplier_info)
         
         logger.info(f"   ✅ {len(supplier_cache)} fournisseur(s) récupéré(s)")
         
         # Enrichir les commandes avec les informations du fournisseur
+        # (réécrites: les commandes d'un RecordSpool sont relues depuis le disque)
         enriched_count = 0
+        enriched_orders = RecordSpool()
         for order in orders:
-            supplier = order.get('supplier', {})
-            supplier_id = None
-            
-            if isinstance(supplier, dict):
-                supplier_id = supplier.get('id')
-            elif isinstance(supplier, str):
-                # Si supplier est une URL, extraire l'ID
-                if supplier.endswith('/'):
-                    supplier = supplier[:-1]
-                supplier_id = supplier.split('/')[-1]
+            supplier_id = extract_object_id(order.get('supplier', {}))
             
             if supplier_id and supplier_id in supplier_cache:
                 supplier_info = supplier_cache[supplier_id]
@@ -485,45 +462,44 @@ class ProsumaAPICommandeReassortExtractor:
                 if isinstance(order.get('supplier'), dict):
                     order['supplier']['is_central'] = supplier_info.get('is_central', False)
                     enriched_count += 1
+            enriched_orders.append(order)
         
         logger.info(f"   ✅ {enriched_count} commande(s) enrichie(s) avec is_central")
-        return orders
+        return enriched_orders
 
-    def count_total_records(self, base_url, shop_id, page_size=1000):
-        """Compte le nombre total de commandes réassort disponibles"""
-        try:
-            url = f"{base_url}/api/supplier_order/"
-            params = {
-                'shop': shop_id,
-                'page_size': page_size,
-                'page': 1,
-                'is_external': 'true',
-                'is_direct': 'false',  # Exclure les commandes directes pour ne garder que les réassort
-                'date_0': self.start_date.strftime('%Y-%m-%dT00:00:00'),
-                'date_1': self.end_date.strftime('%Y-%m-%dT23:59:59')
-            }
-            if self.status_filter and self.status_filter.lower() == 'en attente de livraison':
-                params['is_awaiting_delivery'] = 'true'
-            
-            response = self.session.get(url, params=params, timeout=30)
-            
-            if response.status_code == 200:
-                data = response.json()
-                total_count = data.get('count', 0)
-                return total_count
-            else:
-                logger.error(f"❌ Erreur lors du comptage: {response.status_code}")
-                return 0
-                
-        except Exception as e:
-            logger.error(f"❌ Erreur lors du comptage: {e}")
-            return 0
+    def create_page_fetcher(self, base_url, shop_id, page_size=1000):
+        """Prépare la pagination de l'endpoint (URL, filtres, taille de page)"""
+        url = f"{base_url}/api/supplier_order/"
+        params = {
+            'shop': shop_id,
+            'page_size': page_size,
+            'is_external': 'true',
+            'is_direct': 'false',  # Exclure les commandes directes pour ne garder que les réassort
+            'date_0': self.start_date.strftime('%Y-%m-%dT00:00:00'),
+            'date_1': self.end_date.strftime('%Y-%m-%dT23:59:59')
+        }
+        if self.status_filter and self.status_filter.lower() == 'en attente de livraison':
+            params['is_awaiting_delivery'] = 'true'
+            logger.info(f"Filtre API: is_awaiting_delivery=true")
+        
+        logger.info(f"🔍 Filtres API appliqués:")
+        logger.info(f"   - is_external: true (commandes externes)")
+        logger.info(f"   - is_direct: false (exclure les commandes directes)")
+        if self.status_filter:
+            logger.info(f"   - status: {self.status_filter}")
+        
+        # Mode incrémental: ne demander que les enregistrements après le dernier export
+        apply_high_water_mark(params, "COMMANDE_REASSORT", base_url, shop_id)
+        
+        return PageFetcher(self.session, url, params, page_size=page_size, timeout=60,
+                           checkpoint_name="COMMANDE_REASSORT")
 
     def get_orders(self, base_url, shop_id, page_size=1000):
         """Récupère les commandes réassort avec pagination complète"""
         # D'abord, compter le nombre total de commandes
         logger.info("🔍 Comptage du nombre total de commandes réassort...")
-        total_records = self.count_total_records(base_url, shop_id, page_size)
+        fetcher = self.create_page_fetcher(base_url, shop_id, page_size)
+        total_records = fetcher.count_records()
         
         if total_records == 0:
             logger.warning("⚠️ Aucune commande réassort trouvée")
@@ -539,133 +515,14 @@ class ProsumaAPICommandeReassortExtractor:
         logger.info("=" * 60)
         
         try:
-            url = f"{base_url}/api/supplier_order/"
-            params = {
-                'shop': shop_id,
-                'page_size': page_size,
-                'is_external': 'true',
-                'is_direct': 'false',  # Exclure les commandes directes pour ne garder que les réassort
-                'date_0': self.start_date.strftime('%Y-%m-%dT00:00:00'),
-                'date_1': self.end_date.strftime('%Y-%m-%dT23:59:59')
-            }
-            if self.status_filter and self.status_filter.lower() == 'en attente de livraison':
-                params['is_awaiting_delivery'] = 'true'
-                logger.info(f"Filtre API: is_awaiting_delivery=true")
-            
-            logger.info(f"🔍 Filtres API appliqués:")
-            logger.info(f"   - is_external: true (commandes externes)")
-            logger.info(f"   - is_direct: false (exclure les commandes directes)")
-            if self.status_filter:
-                logger.info(f"   - status: {self.status_filter}")
-            
             all_orders = []
-            page = 1
-            total_pages = (total_records + page_size - 1) // page_size
-            
-            while page <= total_pages:
-                # Afficher la progression
-                progress_percent = (page - 1) * 100 // total_pages if total_pages > 0 else 0
-                logger.info(f"📄 Récupération page {page}/{total_pages} ({progress_percent}%) - {len(all_orders):,}/{total_records:,} commandes...")
-                
-                params['page'] = page
-                
-                response = self.session.get(url, params=params, timeout=60)
-                response.raise_for_status()
-                data = response.json()
-                
-                orders_on_page = data.get('results', [])
+            # Page 1 reprise du comptage, pages 2..N récupérées en parallèle
+            for page, orders_on_page in fetcher.iter_pages(total_records):
                 all_orders.extend(orders_on_page)
-                
-                logger.info(f"  ✅ Page {page}: {len(orders_on_page)} commandes réassort récupérées (total: {len(all_orders):,}/{total_records:,})")
-                
-                # Vérifier s'il y a une page suivante
-                if not data.get('next'):
-                    logger.info(f"  ✅ Dernière page atteinte (page {page})")
-                    break
-                
-                page += 1
-            
-            # Enrichir les commandes avec les informations complètes des fournisseurs
-            all_orders = self.enrich_orders_with_supplier_info(base_url, all_orders)
-            
-            # Filtrage de sécurité : utiliser supplier.is_central pour identifier les réassort
-            # Selon la documentation API: is_central=True = fournisseur centrale = réassort
-            original_count = len(all_orders)
-            filtered_orders = []
-            direct_orders_excluded = 0
-            
-            # Analyser la première commande pour voir la structure
-            if all_orders:
-                first_order = all_orders[0]
-                supplier = first_order.get('supplier', {})
-                has_supplier = isinstance(supplier, dict) and supplier
-                has_is_central = has_supplier and 'is_central' in supplier
-                
-                logger.info(f"🔍 Analyse des champs API:")
-                logger.info(f"   - supplier présent: {'✅ OUI' if has_supplier else '❌ NON'}")
-                if has_supplier:
-                    logger.info(f"   - supplier.is_central présent: {'✅ OUI' if has_is_central else '❌ NON'}")
-                    if has_is_central:
-                        logger.info(f"   - Valeur supplier.is_central: {supplier.get('is_central')}")
-                
-                if has_is_central:
-                    # Le champ is_central existe, on peut filtrer strictement
-                    for order in all_orders:
-                        supplier = order.get('supplier', {})
-                        if isinstance(supplier, dict):
-                            is_central = supplier.get('is_central', False)
-                            
-                            # Les réassort sont les commandes avec supplier.is_central=True
-                            if is_central:
-                                filtered_orders.append(order)
-                            else:
-                                direct_orders_excluded += 1
-                                logger.debug(f"❌ Commande directe exclue: {order.get('reference', order.get('id', 'N/A'))} (supplier.is_central=False)")
-                        else:
-                            # Pas de fournisseur, exclure par sécurité
-                            direct_orders_excluded += 1
-                            logger.debug(f"❌ Commande sans fournisseur exclue: {order.get('reference', order.get('id', 'N/A'))}")
-                else:
-                    # Le champ is_central n'existe toujours pas après enrichissement
-                    logger.warning(f"⚠️⚠️⚠️ ATTENTION: Le champ supplier.is_central n'existe toujours pas après enrichissement ⚠️⚠️⚠️")
-                    logger.warning(f"   On fait confiance au filtre API (is_external=true, is_direct=false)")
-                    logger.warning(f"   Toutes les {original_count} commandes sont acceptées comme réassort")
-                    filtered_orders = all_orders.copy()
-            
-            all_orders = filtered_orders
-            filtered_count = len(all_orders)
-            
-            if direct_orders_excluded > 0:
-                logger.warning(f"⚠️⚠️⚠️ FILTRE DE SÉCURITÉ: {direct_orders_excluded} commande(s) directe(s) exclue(s) ⚠️⚠️⚠️")
-                logger.warning(f"   Le filtre API n'a pas fonctionné correctement.")
-                logger.warning(f"   Filtrage manuel strict: {original_count} -> {filtered_count} commandes réassort")
-                logger.warning(f"   Critère: supplier.is_central=True (fournisseur centrale)")
-            elif original_count > 0:
-                logger.info(f"✅✅✅ Filtre de sécurité: {filtered_count} commandes réassort validées (supplier.is_central=True)")
+                progress_percent = page * 100 // fetcher.total_pages
+                logger.info(f"  ✅ Page {page}/{fetcher.total_pages} ({progress_percent}%): {len(orders_on_page)} commandes réassort récupérées (total: {len(all_orders):,}/{total_records:,})")
             
-            # Filtrage post-récupération si nécessaire (seulement pour les filtres autres que "en attente de livraison")
-            # Le filtre "en attente de livraison" est déjà appliqué via le paramètre API is_awaiting_delivery
-            if self.status_filter and self.status_filter.lower() != 'en attente de livraison':
-                logger.info(f"Filtrage post-récupération pour le statut: '{self.status_filter}'")
-                original_count = len(all_orders)
-                all_orders = [order for order in all_orders 
-                              if (order.get('status_display') or order.get('status', '')).lower() == self.status_filter.lower()]
-                filtered_count = len(all_orders)
-                logger.info(f"Filtrage: {original_count} -> {filtered_count} commandes")
-            
-            # Vérifier que le filtre "en attente de livraison" fonctionne correctement
-            if self.status_filter and self.status_filter.lower() == 'en attente de livraison':
-                # Vérifier que toutes les commandes sont bien en attente de livraison
-                # Le filtre API devrait déjà avoir filtré, mais on vérifie quand même
-                original_count = len(all_orders)
-                all_orders = [order for order in all_orders 
-                              if order.get('is_awaiting_delivery', False) or 
-                                 (order.get('status_display', '').lower() in ['en attente de livraison', 'awaiting delivery'])]
-                filtered_count = len(all_orders)
-                if original_count != filtered_count:
-                    logger.warning(f"⚠️ Le filtre API n'a pas fonctionné correctement. Filtrage manuel: {original_count} -> {filtered_count} commandes")
-                else:
-                    logger.info(f"✅ Filtre 'en attente de livraison' appliqué: {filtered_count} commandes")
+            all_orders = self.filter_orders(base_url, all_orders)
 
             # Afficher le résumé final
             logger.info("=" * 60)
@@ -699,6 +556,96 @@ class ProsumaAPICommandeReassortExtractor:
             logger.error(f"❌ EXTRACTION ÉCHOUÉE pour le magasin {shop_id}")
             return []
 
+    def matches_api_filters(self, order):
+        """Équivalent local des filtres API (is_external=true, is_direct=false), pour le mode commandes groupées"""
+        return order.get('is_external') is True and order.get('is_direct') is False
+
+    def filter_orders(self, base_url, all_orders):
+        """Enrichissement fournisseurs puis filtrage post-récupération (réassort, statut)"""
+        # Enrichir les commandes avec les informations complètes des fournisseurs
+        with stage('enrichment'):
+            all_orders = self.enrich_orders_with_supplier_info(base_url, all_orders)
+        
+        # Filtrage de sécurité : utiliser supplier.is_central pour identifier les réassort
+        # Selon la documentation API: is_central=True = fournisseur centrale = réassort
+        original_count = len(all_orders)
+        filtered_orders = RecordSpool()
+        direct_orders_excluded = 0
+        
+        # Analyser la première commande pour voir la structure
+        if all_orders:
+            first_order = next(iter(all_orders))
+            supplier = first_order.get('supplier', {})
+            has_supplier = isinstance(supplier, dict) and supplier
+            has_is_central = has_supplier and 'is_central' in supplier
+            
+            logger.info(f"🔍 Analyse des champs API:")
+            logger.info(f"   - supplier présent: {'✅ OUI' if has_supplier else '❌ NON'}")
+            if has_supplier:
+                logger.info(f"   - supplier.is_central présent: {'✅ OUI' if has_is_central else '❌ NON'}")
+                if has_is_central:
+                    logger.info(f"   - Valeur supplier.is_central: {supplier.get('is_central')}")
+            
+            if has_is_central:
+                # Le champ is_central existe, on peut filtrer strictement
+                for order in all_orders:
+                    supplier = order.get('supplier', {})
+                    if isinstance(supplier, dict):
+                        is_central = supplier.get('is_central', False)
+                        
+                        # Les réassort sont les commandes avec supplier.is_central=True
+                        if is_central:
+                            filtered_orders.append(order)
+                        else:
+                            direct_orders_excluded += 1
+                            logger.debug(f"❌ Commande directe exclue: {order.get('reference', order.get('id', 'N/A'))} (supplier.is_central=False)")
+                    else:
+                        # Pas de fournisseur, exclure par sécurité
+                        direct_orders_excluded += 1
+                        logger.debug(f"❌ Commande sans fournisseur exclue: {order.get('reference', order.get('id', 'N/A'))}")
+            else:
+                # Le champ is_central n'existe toujours pas après enrichissement
+                logger.warning(f"⚠️⚠️⚠️ ATTENTION: Le champ supplier.is_central n'existe toujours pas après enrichissement ⚠️⚠️⚠️")
+                logger.warning(f"   On fait confiance au filtre API (is_external=true, is_direct=false)")
+                logger.warning(f"   Toutes les {original_count} commandes sont acceptées comme réassort")
+                filtered_orders = all_orders
+        
+        all_orders = filtered_orders
+        filtered_count = len(all_orders)
+        
+        if direct_orders_excluded > 0:
+            logger.warning(f"⚠️⚠️⚠️ FILTRE DE SÉCURITÉ: {direct_orders_excluded} commande(s) directe(s) exclue(s) ⚠️⚠️⚠️")
+            logger.warning(f"   Le filtre API n'a pas fonctionné correctement.")
+            logger.warning(f"   Filtrage manuel strict: {original_count} -> {filtered_count} commandes réassort")
+            logger.warning(f"   Critère: supplier.is_central=True (fournisseur centrale)")
+        elif original_count > 0:
+            logger.info(f"✅✅✅ Filtre de sécurité: {filtered_count} commandes réassort validées (supplier.is_central=True)")
+        
+        # Filtrage post-récupération si nécessaire (seulement pour les filtres autres que "en attente de livraison")
+        # Le filtre "en attente de livraison" est déjà appliqué via le paramètre API is_awaiting_delivery
+        if self.status_filter and self.status_filter.lower() != 'en attente de livraison':
+            logger.info(f"Filtrage post-récupération pour le statut: '{self.status_filter}'")
+            original_count = len(all_orders)
+            all_orders = RecordSpool(order for order in all_orders 
+                                     if (order.get('status_display') or order.get('status', '')).lower() == self.status_filter.lower())
+            filtered_count = len(all_orders)
+            logger.info(f"Filtrage: {original_count} -> {filtered_count} commandes")
+        
+        # Vérifier que le filtre "en attente de livraison" fonctionne correctement
+        if self.status_filter and self.status_filter.lower() == 'en attente de livraison':
+            # Vérifier que toutes les commandes sont bien en attente de livraison
+            # Le filtre API devrait déjà avoir filtré, mais on vérifie quand même
+            original_count = len(all_orders)
+            all_orders = RecordSpool(order for order in all_orders 
+                                     if order.get('is_awaiting_delivery', False) or 
+                                        (order.get('status_display', '').lower() in ['en attente de livraison', 'awaiting delivery']))
+            filtered_count = len(all_orders)
+            if original_count != filtered_count:
+                logger.warning(f"⚠️ Le filtre API n'a pas fonctionné correctement. Filtrage manuel: {original_count} -> {filtered_count} commandes")
+            else:
+                logger.info(f"✅ Filtre 'en attente de livraison' appliqué: {filtered_count} commandes")
+        return all_orders
+
     def export_to_csv(self, orders, shop_code, shop_name):
         """Exporte les commandes réassort vers un fichier CSV"""
         if not orders:
@@ -914,7 +861,7 @@ class ProsumaAPICommandeReassortExtractor:
         
         # Récupérer les informations du magasin
         logger.info(f"🔍 Récupération des informations du magasin {shop_code}...")
-        shop_data = self.get_shop_info(base_url, shop_code)
+        shop_data = get_cached_shop_info(self.session, base_url, shop_code, self.get_shop_info)
         if not shop_data:
             logger.error(f"❌❌❌ IMPOSSIBLE DE RÉCUPÉRER LES INFORMATIONS DU MAGASIN ❌❌❌")
             logger.error(f"   Magasin {shop_code}: ÉCHEC")
@@ -941,8 +888,11 @@ class ProsumaAPICommandeReassortExtractor:
         logger.info("=" * 60)
         logger.info(f"💾 EXPORT CSV - MAGASIN {shop_code}")
         logger.info("=" * 60)
-        csv_file = self.export_to_csv(orders, shop_code, shop_name)
+        with stage('csv'):
+            csv_file = self.export_to_csv(orders, shop_code, shop_name)
         if csv_file:
+            record_rows_out(len(orders))
+            save_high_water_mark("COMMANDE_REASSORT", base_url, shop_id, orders)
             logger.info("=" * 60)
             logger.info(f"✅✅✅ MAGASIN {shop_code} TRAITÉ AVEC SUCCÈS ✅✅✅")
             logger.info("=" * 60)
@@ -1020,13 +970,12 @@ class ProsumaAPICommandeReassortExtractor:
         total_shops = len(self.shop_codes)
         failed_shops = []  # Liste des magasins en échec avec leur nom
         
+        # Magasins traités en parallèle (plafond de magasins simultanés par serveur)
+        results = run_shops_parallel(self.shop_codes, self.shop_config, self.extract_shop)
+        
         for shop_code in self.shop_codes:
             try:
-                logger.info(f"\n{'='*60}")
-                logger.info(f"🔄 TRAITEMENT MAGASIN {shop_code}")
-                logger.info(f"{'='*60}")
-                
-                if self.extract_shop(shop_code):
+                if results[shop_code].result():
                     successful_shops += 1
                     logger.info(f"✅✅✅ MAGASIN {shop_code} TRAITÉ AVEC SUCCÈS ✅✅✅")
                 else:
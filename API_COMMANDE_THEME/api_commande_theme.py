@@ -4,7 +4,6 @@ Extracteur API Prosuma RPOS - Commandes par Thème/Promotion
 Récupère les commandes par thème via l'API external_order
 """
 
-import requests
 import os
 import csv
 import json
@@ -18,7 +17,7 @@ import sys
 
 # Ajouter le répertoire parent au path pour importer utils
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler
+from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler, PageFetcher, run_shops_parallel, get_cached_shop_info, RecordSpool, get_http_session, stage, record_rows_out, shop_log_handlers
 
 # Désactiver les warnings SSL
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -50,9 +49,7 @@ class ProsumaAPICommandeThemeExtractor:
         self.setup_logging()
         
         # Session HTTP
-        self.session = requests.Session()
-        self.session.auth = (self.username, self.password)
-        self.session.verify = False
+        self.session = get_http_session(self.username, self.password)
 
         print(f"Extracteur API initialisé pour {self.username}")
         print(f"Magasins configurés: {self.shop_codes}")
@@ -65,21 +62,21 @@ class ProsumaAPICommandeThemeExtractor:
             log_file = os.path.join(log_path, 'prosuma_api_commande_theme.log')
             logging.basicConfig(
                 level=logging.INFO,
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                handlers=[
+                format='%(asctime)s - %(levelname)s - [%(shop)s] %(message)s',
+                handlers=shop_log_handlers([
                     logging.FileHandler(log_file, encoding='utf-8'),
                     SafeStreamHandler()
-                ]
+                ])
             )
         else:
             log_file = 'prosuma_api_commande_theme.log'
             logging.basicConfig(
                 level=logging.INFO,
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                handlers=[
+                format='%(asctime)s - %(levelname)s - [%(shop)s] %(message)s',
+                handlers=shop_log_handlers([
                     logging.FileHandler(log_file, encoding='utf-8'),
                     SafeStreamHandler()
-                ]
+                ])
             )
         
         # Définir les permissions pour permettre à tous les utilisateurs d'écrire
@@ -187,40 +184,28 @@ class ProsumaAPICommandeThemeExtractor:
             return None
 
     
-    def count_total_records(self, base_url, shop_id, page_size=1000):
-        """Compte le nombre total d'enregistrements disponibles"""
-        try:
-            url = f"{base_url}/api/product/"
-            params = {
-                'shop': shop_id,
-                'page_size': page_size,
-                'page': 1
-            }
-            
-            # Ajouter les paramètres de date si disponibles
-            if hasattr(self, 'start_date') and hasattr(self, 'end_date'):
-                params['date_0'] = self.start_date.strftime('%Y-%m-%dT%H:%M:%S')
-                params['date_1'] = self.end_date.strftime('%Y-%m-%dT%H:%M:%S')
-            
-            response = self.session.get(url, params=params, timeout=30)
-            
-            if response.status_code == 200:
-                data = response.json()
-                total_count = data.get('count', 0)
-                return total_count
-            else:
-                logger.error(f"❌ Erreur lors du comptage: {response.status_code}")
-                return 0
-                
-        except Exception as e:
-            logger.error(f"❌ Erreur lors du comptage: {e}")
-            return 0
+    def create_page_fetcher(self, base_url, shop_id, page_size=1000):
+        """Prépare la pagination de l'endpoint (URL, filtres, taille de page)"""
+        url = f"{base_url}/api/product/"
+        params = {
+            'shop': shop_id,
+            'page_size': page_size
+        }
+
+        # Ajouter les paramètres de date si disponibles
+        if hasattr(self, 'start_date') and hasattr(self, 'end_date'):
+            params['date_0'] = self.start_date.strftime('%Y-%m-%dT%H:%M:%S')
+            params['date_1'] = self.end_date.strftime('%Y-%m-%dT%H:%M:%S')
+        
+        return PageFetcher(self.session, url, params, page_size=page_size, timeout=30,
+                           checkpoint_name="COMMANDE_THEME", snapshot=True)
 
     def get_external_orders(self, base_url, shop_id, page_size=1000):
         """Récupère les données avec pagination complète"""
         # D'abord, compter le nombre total d'enregistrements
         logger.info("🔍 Comptage du nombre total d'enregistrements...")
-        total_records = self.count_total_records(base_url, shop_id, page_size)
+        fetcher = self.create_page_fetcher(base_url, shop_id, page_size)
+        total_records = fetcher.count_records()
         
         if total_records == 0:
             logger.warning("⚠️ Aucun enregistrement trouvé")
@@ -235,61 +220,14 @@ class ProsumaAPICommandeThemeExtractor:
         logger.info(f"🏪 Magasin: {shop_id}")
         logger.info("=" * 60)
         
-        all_data = []
-        page = 1
-        total_pages = (total_records + page_size - 1) // page_size  # Calcul du nombre total de pages
+        all_data = RecordSpool()  # Écrit sur disque page par page (mémoire bornée)
         
         try:
-            while page <= total_pages:
-                url = f"{base_url}/api/product/"
-                params = {
-                    'shop': shop_id,
-                    'page_size': page_size,
-                    'page': page
-                }
-                
-                # Ajouter les paramètres de date si disponibles
-                if hasattr(self, 'start_date') and hasattr(self, 'end_date'):
-                    params['date_0'] = self.start_date.strftime('%Y-%m-%dT%H:%M:%S')
-                    params['date_1'] = self.end_date.strftime('%Y-%m-%dT%H:%M:%S')
-                
-                # Afficher la progression
-                progress_percent = (page - 1) * 100 // total_pages if total_pages > 0 else 0
-                logger.info(f"📄 Récupération page {page}/{total_pages} ({progress_percent}%) - {len(all_data):,}/{total_records:,} enregistrements...")
-                
-                response = self.session.get(url, params=params, timeout=30)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    items = data.get('results', [])
-                    
-                    if not items:
-                        logger.info(f"  ✅ Dernière page atteinte (page {page}) - Aucun enregistrement retourné")
-                        break
-                    
-                    all_data.extend(items)
-                    logger.info(f"  ✅ Page {page}: {len(items)} éléments récupérés (total: {len(all_data):,}/{total_records:,})")
-                    
-                    # Vérifier si on a récupéré tous les enregistrements ou si on est à la dernière page
-                    if len(all_data) >= total_records:
-                        logger.info(f"  ✅ Tous les enregistrements récupérés (page {page}/{total_pages})")
-                        break
-                    
-                    # Si on est à la dernière page calculée, on arrête
-                    if page >= total_pages:
-                        logger.info(f"  ✅ Dernière page atteinte (page {page}/{total_pages})")
-                        break
-                    
-                    # Continuer avec la page suivante
-                    page += 1
-                else:
-                    logger.error(f"❌ Erreur lors de la récupération des données: {response.status_code}")
-                    # Continuer avec la page suivante en cas d'erreur temporaire
-                    if response.status_code == 500 or response.status_code == 503:
-                        logger.warning(f"⚠️ Erreur serveur, tentative de continuer...")
-                        page += 1
-                        continue
-                    break
+            # Page 1 reprise du comptage, pages 2..N récupérées en parallèle
+            for page, items in fetcher.iter_pages(total_records):
+                all_data.extend(items)
+                progress_percent = page * 100 // fetcher.total_pages
+                logger.info(f"  ✅ Page {page}/{fetcher.total_pages} ({progress_percent}%): {len(items)} éléments récupérés (total: {len(all_data):,}/{total_records:,})")
                     
         except Exception as e:
             logger.error(f"❌ Erreur lors de la récupération des données: {e}")
@@ -358,7 +296,8 @@ class ProsumaAPICommandeThemeExtractor:
             
             # Copier vers le réseau et supprimer le fichier local
             network_filepath = os.path.join(network_path, filename)
-            shutil.copy2(local_filepath, network_filepath)
+            with stage('network_copy'):
+                shutil.copy2(local_filepath, network_filepath)
             logger.info(f"✅ Fichier copié sur le réseau: {network_filepath}")
             
             # Supprimer le fichier local
@@ -394,7 +333,7 @@ class ProsumaAPICommandeThemeExtractor:
         
         # Récupérer les informations du magasin
         logger.info(f"Récupération des informations du magasin {shop_code}...")
-        shop_data = self.get_shop_info(base_url, shop_code)
+        shop_data = get_cached_shop_info(self.session, base_url, shop_code, self.get_shop_info)
         if not shop_data:
             logger.error(f"❌ Impossible de récupérer les informations du magasin {shop_code}")
             return False
@@ -418,8 +357,10 @@ class ProsumaAPICommandeThemeExtractor:
         logger.info("=" * 60)
         logger.info(f"💾 EXPORT CSV - MAGASIN {shop_code}")
         logger.info("=" * 60)
-        csv_file = self.export_to_csv(orders, shop_code, shop_name)
+        with stage('csv'):
+            csv_file = self.export_to_csv(orders, shop_code, shop_name)
         if csv_file:
+            record_rows_out(len(orders))
             logger.info("=" * 60)
             logger.info(f"✅ MAGASIN {shop_code} TRAITÉ AVEC SUCCÈS")
             logger.info("=" * 60)
@@ -448,19 +389,22 @@ class ProsumaAPICommandeThemeExtractor:
         total_shops = len(self.shop_codes)
         failed_shops = []  # Liste des magasins en échec avec leur nom
         
+        # Magasins traités en parallèle (plafond de magasins simultanés par serveur)
+        results = run_shops_parallel(self.shop_codes, self.shop_config, self.extract_shop)
+        
         for shop_code in self.shop_codes:
             try:
-                if self.extract_shop(shop_code):
+                if results[shop_code].result():
                     successful_shops += 1
                 else:
                     # Extraction échouée
-                    shop_name = self.shop_config.get(shop_code, {}).get(\'name\', \'Nom inconnu\')
+                    shop_name = self.shop_config.get(shop_code, {}).get('name', 'Nom inconnu')
                     failed_shops.append((shop_code, shop_name))
             except Exception as e:
-                # Erreur lors de l\'extraction
-                shop_name = self.shop_config.get(shop_code, {}).get(\'name\', \'Nom inconnu\')
+                # Erreur lors de l'extraction
+                shop_name = self.shop_config.get(shop_code, {}).get('name', 'Nom inconnu')
                 failed_shops.append((shop_code, shop_name))
-                logger.error(f"❌ Erreur lors de l\'extraction du magasin {shop_code}: {e}")
+                logger.error(f"❌ Erreur lors de l'extraction du magasin {shop_code}: {e}")
         
         # Résumé
         logger.info("=" * 60)
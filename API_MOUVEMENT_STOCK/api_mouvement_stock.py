@@ -18,7 +18,7 @@ import sys
 
 # Ajouter le répertoire parent au path pour importer utils
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler, set_log_file_permissions
+from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler, set_log_file_permissions, PageFetcher, run_shops_parallel, get_cached_shop_info, RecordSpool, apply_high_water_mark, save_high_water_mark, mark_shop_incomplete, get_http_session, stage, record_rows_out, shop_log_handlers
 
 # Désactiver les warnings SSL
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -101,9 +101,7 @@ class ProsumaAPIMouvementStockExtractor:
         self.setup_logging()
         
         # Session HTTP
-        self.session = requests.Session()
-        self.session.auth = (self.username, self.password)
-        self.session.verify = False
+        self.session = get_http_session(self.username, self.password)
 
         print(f"Extracteur API Mouvements de Stock Prosuma initialisé pour {self.username}")
         print(f"Magasins configurés: {self.shop_codes}")
@@ -116,19 +114,19 @@ class ProsumaAPIMouvementStockExtractor:
             log_file = os.path.join(log_path, 'prosuma_api_mouvement_stock.log')
             logging.basicConfig(
                 level=logging.INFO,
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                handlers=[
+                format='%(asctime)s - %(levelname)s - [%(shop)s] %(message)s',
+                handlers=shop_log_handlers([
                     logging.FileHandler(log_file, encoding='utf-8'),
                     SafeStreamHandler()
-                ]
+                ])
             )
             # Définir les permissions du fichier de log
             set_log_file_permissions(log_file)
         else:
             logging.basicConfig(
                 level=logging.INFO,
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                handlers=[SafeStreamHandler()]
+                format='%(asctime)s - %(levelname)s - [%(shop)s] %(message)s',
+                handlers=shop_log_handlers([SafeStreamHandler()])
             )
 
     def setup_dates(self):
@@ -277,194 +275,86 @@ class ProsumaAPIMouvementStockExtractor:
         
         return ordered_fields
     
-    def count_total_records(self, base_url, shop_id, page_size=1000):
-        """Compte le nombre total d'enregistrements disponibles"""
-        try:
-            url = f"{base_url}/api/stock_move/"
-            params = {
-                'shop': shop_id,
-                'page_size': page_size,
-                'page': 1
-            }
-            
-            # Ajouter les paramètres de date si disponibles (utiliser date_0 et date_1)
-            # S'assurer que date_0 commence à 00:00:00 et date_1 finit à 23:59:59
-            if hasattr(self, 'start_date') and hasattr(self, 'end_date'):
-                # Créer une copie des dates pour ajuster les heures
-                start_with_time = self.start_date.replace(hour=0, minute=0, second=0, microsecond=0)
-                end_with_time = self.end_date.replace(hour=23, minute=59, second=59, microsecond=999999)
-                params['date_0'] = start_with_time.strftime('%Y-%m-%dT%H:%M:%S')
-                params['date_1'] = end_with_time.strftime('%Y-%m-%dT%H:%M:%S')
-            
-            logger = logging.getLogger(__name__)
-            logger.info(f"🔍 URL appelée: {url}")
-            logger.info(f"🔍 Paramètres: {params}")
-            
-            response = self.session.get(url, params=params, timeout=30)
-            
-            if response.status_code == 200:
-                data = response.json()
-                
-                if isinstance(data, dict) and 'results' in data:
-                    # Si c'est une réponse paginée
-                    results_count = len(data.get('results', []))
-                    total_count = data.get('count', 0)
-                    
-                    # Si count est 0 mais qu'il y a des résultats, utiliser le nombre de résultats
-                    if total_count == 0 and results_count > 0:
-                        logger.warning(f"⚠️ L'API retourne count=0 mais {results_count} résultats - utilisation du nombre de résultats")
-                        total_count = results_count
-                    
-                    logger.info(f"✅ Comptage réussi: {total_count} enregistrements (page 1: {results_count} résultats)")
-                    return total_count
-                elif isinstance(data, list):
-                    # Si c'est directement une liste
-                    total_count = len(data)
-                    logger.info(f"✅ Comptage réussi: {total_count} enregistrements (liste directe)")
-                    return total_count
-                else:
-                    total_count = data.get('count', 0)
-                    logger.info(f"✅ Comptage réussi: {total_count} enregistrements")
-                    return total_count
-            else:
-                logger.error(f"❌ Erreur lors du comptage: {response.status_code}")
-                logger.error(f"❌ Réponse: {response.text[:500]}")
-                return 0
-                
-        except Exception as e:
-            logger = logging.getLogger(__name__)
-            logger.error(f"❌ Erreur lors du comptage: {e}")
-            return 0
+    def get_date_params(self, base_url, shop_id):
+        """Paramètres de période date_0/date_1 (00:00:00 -> 23:59:59), avec point de reprise en mode incrémental"""
+        start_with_time = self.start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+        end_with_time = self.end_date.replace(hour=23, minute=59, second=59, microsecond=999999)
+        params = {
+            'date_0': start_with_time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'date_1': end_with_time.strftime('%Y-%m-%dT%H:%M:%S')
+        }
+        return apply_high_water_mark(params, "MOUVEMENT_STOCK", base_url, shop_id)
 
+    def create_page_fetcher(self, base_url, shop_id, page_size=1000):
+        """Prépare la pagination de l'endpoint (URL, filtres, taille de page)"""
+        url = f"{base_url}/api/stock_move/"
+        params = {
+            'shop': shop_id,
+            'page_size': page_size
+        }
+        
+        # Ajouter les paramètres de date si disponibles
+        # S'assurer que date_0 commence à 00:00:00 et date_1 finit à 23:59:59
+        params.update(self.get_date_params(base_url, shop_id))
+        
+        logger = logging.getLogger(__name__)
+        logger.info(f"🔍 URL appelée: {url}")
+        logger.info(f"🔍 Paramètres: {params}")
+        
+        return PageFetcher(self.session, url, params, page_size=page_size, timeout=30,
+                           checkpoint_name="MOUVEMENT_STOCK", keyset=True)
+    
     def get_stock_moves(self, base_url, shop_id, page_size=1000):
         """Récupère les données avec pagination complète"""
         logger = logging.getLogger(__name__)
         
-        # D'abord, compter le nombre total d'enregistrements
+        # D'abord, compter le nombre total d'enregistrements (la page 1 est conservée)
         logger.info("🔍 Comptage du nombre total d'enregistrements...")
-        total_records = self.count_total_records(base_url, shop_id, page_size)
-        
-        # Si total_records est 0, vérifier quand même s'il y a des résultats
-        if total_records == 0:
-            logger.info("🔍 Vérification directe des résultats (count=0 mais peut-être des résultats)...")
-            url = f"{base_url}/api/stock_move/"
-            params = {
-                'shop': shop_id,
-                'page_size': 100,
-                'page': 1
-            }
-            if hasattr(self, 'start_date') and hasattr(self, 'end_date'):
-                # Créer une copie des dates pour ajuster les heures
-                start_with_time = self.start_date.replace(hour=0, minute=0, second=0, microsecond=0)
-                end_with_time = self.end_date.replace(hour=23, minute=59, second=59, microsecond=999999)
-                params['date_0'] = start_with_time.strftime('%Y-%m-%dT%H:%M:%S')
-                params['date_1'] = end_with_time.strftime('%Y-%m-%dT%H:%M:%S')
-            
-            try:
-                response = self.session.get(url, params=params, timeout=30)
-                if response.status_code == 200:
-                    data = response.json()
-                    if isinstance(data, dict) and 'results' in data:
-                        results = data.get('results', [])
-                        if len(results) > 0:
-                            logger.info(f"✅ {len(results)} résultats trouvés malgré count=0 - extraction avec pagination")
-                            total_records = max(len(results) * 10, 1000)  # Estimation pour pagination
-                            logger.info(f"📊 Estimation pour pagination: {total_records} enregistrements maximum")
-                        else:
-                            logger.warning("⚠️ Aucun enregistrement trouvé")
-                            return []
-                    elif isinstance(data, list) and len(data) > 0:
-                        logger.info(f"✅ {len(data)} résultats trouvés (liste directe) - extraction des données")
-                        total_records = len(data)
-                    else:
-                        logger.warning("⚠️ Aucun enregistrement trouvé")
-                        return []
-                else:
-                    logger.warning("⚠️ Aucun enregistrement trouvé")
-                    return []
-            except Exception as e:
-                logger.error(f"❌ Erreur lors de la vérification: {e}")
-                import traceback
-                logger.error(f"❌ Traceback: {traceback.format_exc()}")
-                return []
+        fetcher = self.create_page_fetcher(base_url, shop_id, page_size)
+        total_records = fetcher.count_records()
         
         # Afficher le cadre avec le nombre total
         logger.info("=" * 60)
         logger.info(f"📊 INFORMATIONS D'EXTRACTION - MAGASIN {shop_id}")
         logger.info("=" * 60)
-        logger.info(f"📊 Total enregistrements disponibles: {total_records:,}")
+        if total_records > 0:
+            logger.info(f"📊 Total enregistrements disponibles: {total_records:,}")
+        else:
+            # L'API peut retourner count=0 alors que des résultats existent
+            logger.info("📊 Total enregistrements non fourni par l'API (count=0): lecture jusqu'à la dernière page")
         logger.info(f"📅 Période: {self.start_date.strftime('%Y-%m-%d %H:%M:%S')} à {self.end_date.strftime('%Y-%m-%d %H:%M:%S')}")
         logger.info(f"🏪 Magasin: {shop_id}")
         logger.info("=" * 60)
         
-        all_data = []
-        page = 1
-        total_pages = (total_records + page_size - 1) // page_size  # Calcul du nombre total de pages
+        all_data = RecordSpool()  # Écrit sur disque page par page (mémoire bornée)
         
         try:
-            while page <= total_pages:
-                url = f"{base_url}/api/stock_move/"
-                params = {
-                    'shop': shop_id,
-                    'page_size': page_size,
-                    'page': page
-                }
-                
-                # Ajouter les paramètres de date si disponibles
-                # S'assurer que date_0 commence à 00:00:00 et date_1 finit à 23:59:59
-                if hasattr(self, 'start_date') and hasattr(self, 'end_date'):
-                    start_with_time = self.start_date.replace(hour=0, minute=0, second=0, microsecond=0)
-                    end_with_time = self.end_date.replace(hour=23, minute=59, second=59, microsecond=999999)
-                    params['date_0'] = start_with_time.strftime('%Y-%m-%dT%H:%M:%S')
-                    params['date_1'] = end_with_time.strftime('%Y-%m-%dT%H:%M:%S')
-                
-                # Afficher la progression
-                progress_percent = (page - 1) * 100 // total_pages if total_pages > 0 else 0
-                logger.info(f"📄 Récupération page {page}/{total_pages} ({progress_percent}%) - {len(all_data):,}/{total_records:,} enregistrements...")
-                
-                response = self.session.get(url, params=params, timeout=30)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    items = data.get('results', [])
-                    
-                    if not items:
-                        logger.info(f"  ✅ Dernière page atteinte (page {page}) - Aucun enregistrement retourné")
-                        break
-                    
-                    all_data.extend(items)
-                    logger.info(f"  ✅ Page {page}: {len(items)} éléments récupérés (total: {len(all_data):,}/{total_records:,})")
-                    
-                    # Si on est à la dernière page calculée, on arrête
-                    if page >= total_pages:
-                        logger.info(f"  ✅ Dernière page calculée atteinte (page {page}/{total_pages})")
-                        # Si on a une estimation (total_records > 1000), continuer jusqu'à ce qu'on n'ait plus de résultats
-                        if total_records > 1000 and len(items) > 0:
-                            logger.info(f"  🔄 Continuation de la pagination (estimation)...")
-                            page += 1
-                            continue
-                        break
-                    
-                    # Continuer avec la page suivante
-                    page += 1
-                else:
-                    logger.error(f"❌ Erreur lors de la récupération des données: {response.status_code}")
-                    logger.error(f"❌ URL: {url}")
-                    logger.error(f"❌ Paramètres: {params}")
-                    logger.error(f"❌ Réponse: {response.text[:500]}")
-                    # Continuer avec la page suivante en cas d'erreur temporaire
-                    if response.status_code == 500 or response.status_code == 503:
-                        logger.warning(f"⚠️ Erreur serveur, tentative de continuer...")
-                        page += 1
-                        continue
-                    break
-                    
+            if total_records > 0:
+                # Nombre exact connu: pages 2..N récupérées en parallèle
+                pages = fetcher.iter_pages(total_records)
+            else:
+                # Sans nombre fiable: pages lues dans l'ordre, la suivante préchargée
+                pages = fetcher.iter_until_empty()
+            for page, items in pages:
+                all_data.extend(items)
+                progress_percent = page * 100 // fetcher.total_pages
+                logger.info(f"  ✅ Page {page}/{fetcher.total_pages} ({progress_percent}%): {len(items)} éléments récupérés (total: {len(all_data):,})")
         except Exception as e:
+            mark_shop_incomplete()
             logger.error(f"❌ Erreur lors de la récupération des données: {e}")
             import traceback
             logger.error(f"❌ Traceback complet:\n{traceback.format_exc()}")
         
-        # Afficher le résumé final
+        if not all_data:
+            logger.warning("⚠️ Aucun enregistrement trouvé")
+            return []
+        
+        self._log_extraction_summary(shop_id, total_records or len(all_data), all_data)
+        return all_data
+    
+    def _log_extraction_summary(self, shop_id, total_records, all_data):
+        """Affiche le résumé final de l'extraction d'un magasin"""
+        logger = logging.getLogger(__name__)
         logger.info("=" * 60)
         logger.info(f"✅ RÉSUMÉ EXTRACTION - MAGASIN {shop_id}")
         logger.info("=" * 60)
@@ -472,8 +362,6 @@ class ProsumaAPIMouvementStockExtractor:
         logger.info(f"📥 Enregistrements extraits: {len(all_data):,}")
         logger.info(f"📈 Taux de réussite: {(len(all_data)/total_records*100):.1f}%" if total_records > 0 else "📈 Taux de réussite: 0%")
         logger.info("=" * 60)
-        
-        return all_data
     
     def export_to_csv(self, stock_moves, shop_code, shop_name):
         """Exporte les mouvements de stock vers un fichier CSV dans deux emplacements"""
@@ -552,7 +440,8 @@ class ProsumaAPIMouvementStockExtractor:
             
             # Copier vers FOFANA/EXPORT
             try:
-                shutil.copy2(asten_filepath, fofana_filepath)
+                with stage('network_copy'):
+                    shutil.copy2(asten_filepath, fofana_filepath)
                 if os.path.exists(fofana_filepath):
                     logger.info(f"✅✅✅ FICHIER COPIÉ VERS FOFANA/EXPORT ✅✅✅")
                     logger.info(f"   📁 Chemin FOFANA: {fofana_filepath}")
@@ -600,7 +489,7 @@ class ProsumaAPIMouvementStockExtractor:
         
         # Récupérer les informations du magasin
         logger.info(f"Récupération des informations du magasin {shop_code}...")
-        shop_data = self.get_shop_info(base_url, shop_code)
+        shop_data = get_cached_shop_info(self.session, base_url, shop_code, self.get_shop_info)
         if not shop_data:
             logger.error(f"❌ Impossible de récupérer les informations du magasin {shop_code}")
             return False
@@ -623,8 +512,11 @@ class ProsumaAPIMouvementStockExtractor:
         logger.info("=" * 60)
         logger.info(f"💾 EXPORT CSV - MAGASIN {shop_code}")
         logger.info("=" * 60)
-        csv_file = self.export_to_csv(stock_moves, shop_code, shop_name)
+        with stage('csv'):
+            csv_file = self.export_to_csv(stock_moves, shop_code, shop_name)
         if csv_file:
+            record_rows_out(len(stock_moves))
+            save_high_water_mark("MOUVEMENT_STOCK", base_url, shop_id, stock_moves)
             logger.info("=" * 60)
             logger.info(f"✅ MAGASIN {shop_code} TRAITÉ AVEC SUCCÈS")
             logger.info("=" * 60)
@@ -661,9 +553,12 @@ class ProsumaAPIMouvementStockExtractor:
         successful_shops = 0
         failed_shops = []
         
+        # Magasins traités en parallèle (plafond de magasins simultanés par serveur)
+        results = run_shops_parallel(self.shop_codes, self.shop_config, self.extract_shop)
+        
         for shop_code in self.shop_codes:
             try:
-                success = self.extract_shop(shop_code)
+                success = results[shop_code].result()
                 if success:
                     successful_shops += 1
                 else:
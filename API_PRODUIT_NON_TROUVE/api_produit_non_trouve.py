@@ -4,7 +4,6 @@ Extracteur API Prosuma RPOS - Produits non trouvés (Event Line)
 Récupère les événements de produits non trouvés via l'API event_line
 """
 
-import requests
 import os
 import csv
 import json
@@ -17,7 +16,7 @@ import sys
 
 # Ajouter le répertoire parent au path pour importer utils
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler
+from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler, run_shops_parallel, get_cached_shop_info, RecordSpool, apply_high_water_mark, save_high_water_mark, mark_shop_incomplete, get_http_session, PageFetcher, stage, record_rows_out, shop_log_handlers
 
 # Désactiver les warnings SSL
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -77,9 +76,7 @@ class ProsumaAPIProduitNonTrouveExtractor:
         self.setup_logging()
         
         # Session HTTP
-        self.session = requests.Session()
-        self.session.auth = (self.username, self.password)
-        self.session.verify = False
+        self.session = get_http_session(self.username, self.password)
 
         print(f"Extracteur API Produits Non Trouvés Prosuma initialisé pour {self.username}")
         print(f"Magasins configurés: {self.shop_codes}")
@@ -92,21 +89,21 @@ class ProsumaAPIProduitNonTrouveExtractor:
             log_file = os.path.join(log_path, 'prosuma_api_produit_non_trouve.log')
             logging.basicConfig(
                 level=logging.INFO,
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                handlers=[
+                format='%(asctime)s - %(levelname)s - [%(shop)s] %(message)s',
+                handlers=shop_log_handlers([
                     logging.FileHandler(log_file, encoding='utf-8'),
                     SafeStreamHandler()
-                ]
+                ])
             )
         else:
             log_file = 'prosuma_api_produit_non_trouve.log'
             logging.basicConfig(
                 level=logging.INFO,
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                handlers=[
+                format='%(asctime)s - %(levelname)s - [%(shop)s] %(message)s',
+                handlers=shop_log_handlers([
                     logging.FileHandler(log_file, encoding='utf-8'),
                     SafeStreamHandler()
-                ]
+                ])
             )
         
         # Définir les permissions pour permettre à tous les utilisateurs d'écrire
@@ -234,201 +231,89 @@ class ProsumaAPIProduitNonTrouveExtractor:
         logger.info("└" + "─" * 78 + "┘")
 
     
-    def count_total_records(self, base_url, shop_id, page_size=1000):
-        """Compte le nombre total d'enregistrements disponibles"""
-        try:
-            url = f"{base_url}/api/event_line/product_not_found"
-            params = {
-                'shop': shop_id,  # Ajouter le paramètre shop pour filtrer par magasin
-                'page_size': page_size,
-                'page': 1
-            }
-            
-            # Ajouter les paramètres de date si disponibles (format ISO avec timezone)
-            if hasattr(self, 'start_date') and hasattr(self, 'end_date'):
-                params['date_0'] = self.start_date.strftime('%Y-%m-%dT%H:%M:%S+00:00')
-                params['date_1'] = self.end_date.strftime('%Y-%m-%dT%H:%M:%S+00:00')
-            
-            logger.info(f"🔍 URL appelée: {url}")
-            logger.info(f"🔍 Paramètres: {params}")
-            response = self.session.get(url, params=params, timeout=30)
-            
-            if response.status_code == 200:
-                data = response.json()
-                # Afficher un aperçu de la réponse pour le débogage
-                logger.debug(f"📋 Structure de la réponse: {list(data.keys()) if isinstance(data, dict) else 'Liste'}")
-                
-                if isinstance(data, dict) and 'results' in data:
-                    # Si c'est une réponse paginée
-                    results_count = len(data.get('results', []))
-                    total_count = data.get('count', 0)
-                    
-                    # Si count est 0 mais qu'il y a des résultats, utiliser le nombre de résultats
-                    if total_count == 0 and results_count > 0:
-                        logger.warning(f"⚠️ L'API retourne count=0 mais {results_count} résultats - utilisation du nombre de résultats")
-                        total_count = results_count
-                    
-                    logger.info(f"✅ Comptage réussi: {total_count} enregistrements (page 1: {results_count} résultats)")
-                    return total_count
-                elif isinstance(data, list):
-                    # Si c'est directement une liste
-                    total_count = len(data)
-                    logger.info(f"✅ Comptage réussi: {total_count} enregistrements (liste directe)")
-                    return total_count
-                else:
-                    total_count = data.get('count', 0)
-                    logger.info(f"✅ Comptage réussi: {total_count} enregistrements")
-                    return total_count
-            else:
-                logger.error(f"❌ Erreur lors du comptage: {response.status_code}")
-                logger.error(f"❌ Réponse: {response.text[:500]}")
-                # Essayer sans le paramètre shop si l'erreur est 400
-                if response.status_code == 400:
-                    logger.info("🔄 Tentative sans le paramètre shop...")
-                    params_without_shop = {k: v for k, v in params.items() if k != 'shop'}
-                    response2 = self.session.get(url, params=params_without_shop, timeout=30)
-                    if response2.status_code == 200:
-                        data = response2.json()
-                        total_count = data.get('count', 0)
-                        logger.info(f"✅ Comptage réussi (sans shop): {total_count} enregistrements")
-                        return total_count
-                return 0
-                
-        except Exception as e:
-            logger.error(f"❌ Erreur lors du comptage: {e}")
-            return 0
+    def get_date_params(self, base_url, shop_id):
+        """Paramètres de période date_0/date_1 (format ISO avec timezone), avec point de reprise en mode incrémental"""
+        params = {
+            'date_0': self.start_date.strftime('%Y-%m-%dT%H:%M:%S+00:00'),
+            'date_1': self.end_date.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+        }
+        return apply_high_water_mark(params, "PRODUIT_NON_TROUVE", base_url, shop_id)
+
+    def create_page_fetcher(self, base_url, shop_id, page_size=1000, with_shop=True):
+        """Prépare la pagination de l'endpoint (URL, filtres, taille de page)"""
+        url = f"{base_url}/api/event_line/product_not_found"
+        params = {
+            'shop': shop_id,  # Ajouter le paramètre shop pour filtrer par magasin
+            'page_size': page_size
+        }
+        
+        # Ajouter les paramètres de date si disponibles (format ISO avec timezone)
+        params.update(self.get_date_params(base_url, shop_id))
+        if not with_shop:
+            params.pop('shop')
+        
+        logger.info(f"🔍 URL appelée: {url}")
+        logger.info(f"🔍 Paramètres: {params}")
+        
+        return PageFetcher(self.session, url, params, page_size=page_size, timeout=30,
+                           checkpoint_name="PRODUIT_NON_TROUVE")
 
     def get_event_lines(self, base_url, shop_id, page_size=1000):
         """Récupère les données avec pagination complète"""
-        # D'abord, compter le nombre total d'enregistrements
+        # D'abord, compter le nombre total d'enregistrements (la page 1 est conservée)
         logger.info("🔍 Comptage du nombre total d'enregistrements...")
-        total_records = self.count_total_records(base_url, shop_id, page_size)
-        
-        # Si total_records est 0, on fait quand même une requête pour vérifier s'il y a des résultats
-        # (car l'API peut retourner count=0 mais avoir des résultats)
-        if total_records == 0:
-            logger.info("🔍 Vérification directe des résultats (count=0 mais peut-être des résultats)...")
-            # Faire une requête pour voir s'il y a vraiment des résultats
-            url = f"{base_url}/api/event_line/product_not_found"
-            params = {
-                'shop': shop_id,
-                'page_size': 100,
-                'page': 1
-            }
-            if hasattr(self, 'start_date') and hasattr(self, 'end_date'):
-                params['date_0'] = self.start_date.strftime('%Y-%m-%dT%H:%M:%S+00:00')
-                params['date_1'] = self.end_date.strftime('%Y-%m-%dT%H:%M:%S+00:00')
-            
-            try:
-                response = self.session.get(url, params=params, timeout=30)
-                if response.status_code == 200:
-                    data = response.json()
-                    if isinstance(data, dict) and 'results' in data:
-                        results = data.get('results', [])
-                        if len(results) > 0:
-                            logger.info(f"✅ {len(results)} résultats trouvés malgré count=0 - extraction avec pagination")
-                            # Estimer le total en fonction du nombre de résultats et de la page_size
-                            # Si on a 100 résultats sur la première page avec page_size=100, il peut y en avoir plus
-                            total_records = max(len(results), 1000)  # Estimation conservatrice
-                            logger.info(f"📊 Estimation: au moins {len(results)} résultats, extraction avec pagination jusqu'à {total_records}")
-                        else:
-                            logger.warning("⚠️ Aucun enregistrement trouvé")
-                            return []
-                    elif isinstance(data, list) and len(data) > 0:
-                        logger.info(f"✅ {len(data)} résultats trouvés (liste directe) - extraction des données")
-                        total_records = len(data)
-                    else:
-                        logger.warning("⚠️ Aucun enregistrement trouvé")
-                        return []
-                else:
-                    logger.warning("⚠️ Aucun enregistrement trouvé")
-                    return []
-            except Exception as e:
-                logger.error(f"❌ Erreur lors de la vérification: {e}")
-                import traceback
-                logger.error(f"❌ Traceback: {traceback.format_exc()}")
-                return []
+        fetcher = self.create_page_fetcher(base_url, shop_id, page_size)
+        total_records = fetcher.count_records()
+        # Essayer sans le paramètre shop si l'erreur est 400
+        if fetcher.count_status == 400:
+            logger.info("🔄 Tentative sans le paramètre shop...")
+            fetcher = self.create_page_fetcher(base_url, shop_id, page_size, with_shop=False)
+            total_records = fetcher.count_records()
         
         # Afficher le cadre avec le nombre total
         logger.info("=" * 60)
         logger.info(f"📊 INFORMATIONS D'EXTRACTION - MAGASIN {shop_id}")
         logger.info("=" * 60)
-        logger.info(f"📊 Total enregistrements disponibles: {total_records:,}")
+        if total_records > 0:
+            logger.info(f"📊 Total enregistrements disponibles: {total_records:,}")
+        else:
+            # L'API peut retourner count=0 alors que des résultats existent
+            logger.info("📊 Total enregistrements non fourni par l'API (count=0): lecture jusqu'à la dernière page")
         logger.info(f"📅 Période: {self.start_date.strftime('%Y-%m-%d %H:%M:%S')} à {self.end_date.strftime('%Y-%m-%d %H:%M:%S')}")
         logger.info(f"🏪 Magasin: {shop_id}")
         logger.info("=" * 60)
         
-        all_data = []
-        page = 1
-        total_pages = (total_records + page_size - 1) // page_size  # Calcul du nombre total de pages
+        all_data = RecordSpool()  # Écrit sur disque page par page (mémoire bornée)
         
         try:
-            while page <= total_pages:
-                url = f"{base_url}/api/event_line/product_not_found"
-                params = {
-                    'shop': shop_id,  # Ajouter le paramètre shop pour filtrer par magasin
-                    'page_size': page_size,
-                    'page': page
-                }
-                
-                # Ajouter les paramètres de date si disponibles (format ISO avec timezone)
-                if hasattr(self, 'start_date') and hasattr(self, 'end_date'):
-                    params['date_0'] = self.start_date.strftime('%Y-%m-%dT%H:%M:%S+00:00')
-                    params['date_1'] = self.end_date.strftime('%Y-%m-%dT%H:%M:%S+00:00')
-                
-                # Afficher la progression
-                progress_percent = (page - 1) * 100 // total_pages if total_pages > 0 else 0
-                logger.info(f"📄 Récupération page {page}/{total_pages} ({progress_percent}%) - {len(all_data):,}/{total_records:,} enregistrements...")
-                
-                response = self.session.get(url, params=params, timeout=30)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    items = data.get('results', [])
-                    
-                    if not items:
-                        logger.info(f"  ✅ Dernière page atteinte (page {page}) - Aucun enregistrement retourné")
-                        break
-                    
-                    all_data.extend(items)
-                    logger.info(f"  ✅ Page {page}: {len(items)} éléments récupérés (total: {len(all_data):,}/{total_records:,})")
-                    
-                    # Si on est à la dernière page calculée, on arrête
-                    if page >= total_pages:
-                        logger.info(f"  ✅ Dernière page calculée atteinte (page {page}/{total_pages})")
-                        # Si on a une estimation (total_records > 1000), continuer jusqu'à ce qu'on n'ait plus de résultats
-                        if total_records > 1000 and len(items) > 0:
-                            logger.info(f"  🔄 Continuation de la pagination (estimation)...")
-                            page += 1
-                            continue
-                        break
-                    
-                    # Continuer avec la page suivante
-                    page += 1
-                else:
-                    logger.error(f"❌ Erreur lors de la récupération des données: {response.status_code}")
-                    logger.error(f"❌ URL: {url}")
-                    logger.error(f"❌ Paramètres: {params}")
-                    logger.error(f"❌ Réponse: {response.text[:500]}")
-                    # Continuer avec la page suivante en cas d'erreur temporaire
-                    if response.status_code == 500 or response.status_code == 503:
-                        logger.warning(f"⚠️ Erreur serveur, tentative de continuer...")
-                        page += 1
-                        continue
-                    break
-                    
+            if total_records > 0:
+                # Nombre exact connu: pages 2..N récupérées en parallèle
+                pages = fetcher.iter_pages(total_records)
+            else:
+                # Sans nombre fiable: pages lues dans l'ordre, la suivante préchargée
+                pages = fetcher.iter_until_empty()
+            for page, items in pages:
+                all_data.extend(items)
+                progress_percent = page * 100 // fetcher.total_pages
+                logger.info(f"  ✅ Page {page}/{fetcher.total_pages} ({progress_percent}%): {len(items)} éléments récupérés (total: {len(all_data):,})")
         except Exception as e:
+            mark_shop_incomplete()
             logger.error(f"❌ Erreur lors de la récupération des données: {e}")
             import traceback
             logger.error(f"❌ Traceback complet:\n{traceback.format_exc()}")
         
+        if not all_data:
+            logger.warning("⚠️ Aucun enregistrement trouvé")
+            return []
+        
         # Afficher le résumé final
+        total_records = total_records or len(all_data)
         logger.info("=" * 60)
         logger.info(f"✅ RÉSUMÉ EXTRACTION - MAGASIN {shop_id}")
         logger.info("=" * 60)
         logger.info(f"📊 Enregistrements trouvés: {total_records:,}")
         logger.info(f"📥 Enregistrements extraits: {len(all_data):,}")
-        logger.info(f"📈 Taux de réussite: {(len(all_data)/total_records*100):.1f}%" if total_records > 0 else "📈 Taux de réussite: 0%")
+        logger.info(f"📈 Taux de réussite: {(len(all_data)/total_records*100):.1f}%")
         logger.info("=" * 60)
         
         return all_data
@@ -589,7 +474,7 @@ class ProsumaAPIProduitNonTrouveExtractor:
         
         # Récupérer les informations du magasin
         logger.info(f"Récupération des informations du magasin {shop_code}...")
-        shop_data = self.get_shop_info(base_url, shop_code)
+        shop_data = get_cached_shop_info(self.session, base_url, shop_code, self.get_shop_info)
         if not shop_data:
             logger.error(f"❌ Impossible de récupérer les informations du magasin {shop_code}")
             return False
@@ -612,8 +497,11 @@ class ProsumaAPIProduitNonTrouveExtractor:
         logger.info("=" * 60)
         logger.info(f"💾 EXPORT CSV - MAGASIN {shop_code}")
         logger.info("=" * 60)
-        csv_file = self.export_to_csv(events, shop_code, shop_name)
+        with stage('csv'):
+            csv_file = self.export_to_csv(events, shop_code, shop_name)
         if csv_file:
+            record_rows_out(len(events))
+            save_high_water_mark("PRODUIT_NON_TROUVE", base_url, shop_id, events)
             logger.info("=" * 60)
             logger.info(f"✅ MAGASIN {shop_code} TRAITÉ AVEC SUCCÈS")
             logger.info("=" * 60)
@@ -646,12 +534,15 @@ class ProsumaAPIProduitNonTrouveExtractor:
         total_shops = len(self.shop_codes)
         failed_shops = []  # Liste des magasins en échec avec leur nom
         
+        # Magasins traités en parallèle (plafond de magasins simultanés par serveur)
+        results = run_shops_parallel(self.shop_codes, self.shop_config, self.extract_shop)
+        
         for shop_code in self.shop_codes:
             try:
                 shop_info = self.shop_config.get(shop_code, {})
                 shop_name = shop_info.get('name', 'Nom inconnu')
                 
-                if self.extract_shop(shop_code):
+                if results[shop_code].result():
                     successful_shops += 1
                 else:
                     # Extraction échouée (connexion, authentification, etc.)
@@ -4,7 +4,6 @@ Extracteur API Prosuma RPOS - Promotions
 Récupère toutes les promotions via l'API Prosuma avec pagination automatique
 """
 
-import requests
 import os
 import csv
 import json
@@ -18,7 +17,7 @@ import sys
 
 # Ajouter le répertoire parent au path pour importer utils
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler
+from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler, run_shops_parallel, get_cached_shop_info, PageFetcher, RecordSpool, get_http_session, stage, record_rows_out, shop_log_handlers
 
 # Désactiver les warnings SSL
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -47,9 +46,7 @@ class ProsumaAPIPromoExtractor:
         self.setup_logging()
         
         # Session HTTP
-        self.session = requests.Session()
-        self.session.auth = (self.username, self.password)
-        self.session.verify = False
+        self.session = get_http_session(self.username, self.password)
 
         logger.info(f"Extracteur API Promotions Prosuma initialisé pour {self.username}")
         logger.info(f"Magasins configurés: {self.shop_codes}")
@@ -61,21 +58,21 @@ class ProsumaAPIPromoExtractor:
             log_file = os.path.join(log_path, 'prosuma_api_promo.log')
             logging.basicConfig(
                 level=logging.INFO,
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                handlers=[
+                format='%(asctime)s - %(levelname)s - [%(shop)s] %(message)s',
+                handlers=shop_log_handlers([
                     logging.FileHandler(log_file, encoding='utf-8'),
                     SafeStreamHandler()
-                ]
+                ])
             )
         else:
             log_file = 'prosuma_api_promo.log'
             logging.basicConfig(
                 level=logging.INFO,
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                handlers=[
+                format='%(asctime)s - %(levelname)s - [%(shop)s] %(message)s',
+                handlers=shop_log_handlers([
                     logging.FileHandler(log_file, encoding='utf-8'),
                     SafeStreamHandler()
-                ]
+                ])
             )
         
         # Définir les permissions pour permettre à tous les utilisateurs d'écrire
@@ -154,53 +151,27 @@ class ProsumaAPIPromoExtractor:
             return None
 
     
-    def count_total_records(self, base_url, shop_id, page_size=1000):
-        """Compte le nombre total de promotions disponibles"""
-        try:
-            url = f"{base_url}/api/promotion/"
-            params = {
-                'shop': shop_id,
-                'page_size': page_size,
-                'page': 1
-            }
-            
-            response = self.session.get(url, params=params, timeout=30)
-            
-            if response.status_code == 200:
-                data = response.json()
-                total_count = data.get('count', 0)
-                return total_count
-            else:
-                logger.error(f"❌ Erreur lors du comptage: {response.status_code}")
-                return 0
-                
-        except Exception as e:
-            logger.error(f"❌ Erreur lors du comptage: {e}")
-            return 0
+    def create_page_fetcher(self, base_url, shop_id, page_size=1000):
+        """Prépare la pagination de l'endpoint (URL, filtres, taille de page)"""
+        url = f"{base_url}/api/promotion/"
+        params = {
+            'shop': shop_id,
+            'page_size': page_size
+        }
+        
+        return PageFetcher(self.session, url, params, page_size=page_size, timeout=30,
+                           checkpoint_name="PROMO")
 
     def get_promotions(self, base_url, shop_id, page_size=1000):
         """Récupère toutes les promotions avec pagination complète"""
-        all_promotions = []
-        page = 1
+        all_promotions = RecordSpool()  # Écrit sur disque page par page (mémoire bornée)
+        total_records = 0
         
         try:
-            # D'abord, récupérer le total de promotions
-            url = f"{base_url}/api/promotion/"
-            params = {
-                'shop': shop_id,
-                'page_size': page_size,
-                'page': 1
-            }
-            
-            response = self.session.get(url, params=params, timeout=30)
-            
-            if response.status_code != 200:
-                logger.error(f"❌ Erreur lors de la récupération des promotions: {response.status_code}")
-                return []
-            
-            first_data = response.json()
-            total_records = first_data.get('count', 0)
-            total_pages = (total_records + page_size - 1) // page_size if total_records > 0 else 0
+            # D'abord, récupérer le total de promotions (la page 1 est conservée)
+            fetcher = self.create_page_fetcher(base_url, shop_id, page_size)
+            total_records = fetcher.count_records()
+            total_pages = (total_records + fetcher.page_size - 1) // fetcher.page_size if total_records > 0 else 0
             
             logger.info("=" * 60)
             logger.info("INFORMATIONS D'EXTRACTION")
@@ -209,56 +180,11 @@ class ProsumaAPIPromoExtractor:
             logger.info(f"Nombre de pages à récupérer: {total_pages}")
             logger.info("=" * 60)
             
-            # Traiter la première page déjà récupérée
-            promotions = first_data.get('results', [])
-            if promotions:
+            # Page 1 reprise du comptage, pages 2..N récupérées en parallèle
+            for page, promotions in fetcher.iter_pages(total_records):
                 all_promotions.extend(promotions)
-                logger.info(f"  ✅ Page 1: {len(promotions)} promotions récupérées (total: {len(all_promotions):,}/{total_records:,})")
-            
-            # Continuer avec les pages suivantes
-            page = 2
-            while page <= total_pages:
-                params = {
-                    'shop': shop_id,
-                    'page_size': page_size,
-                    'page': page
-                }
-                
-                progress_percent = (page - 1) * 100 // total_pages if total_pages > 0 else 0
-                logger.info(f"📄 Récupération page {page}/{total_pages} ({progress_percent}%) - {len(all_promotions):,}/{total_records:,} promotions...")
-                
-                response = self.session.get(url, params=params, timeout=30)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    promotions = data.get('results', [])
-                    
-                    if not promotions:
-                        logger.info(f"  ✅ Dernière page atteinte (page {page}) - Aucune promotion retournée")
-                        break
-                    
-                    all_promotions.extend(promotions)
-                    logger.info(f"  ✅ Page {page}: {len(promotions)} promotions récupérées (total: {len(all_promotions):,}/{total_records:,})")
-                    
-                    # Vérifier si on a récupéré toutes les promotions ou si on est à la dernière page
-                    if len(all_promotions) >= total_records:
-                        logger.info(f"  ✅ Toutes les promotions récupérées (page {page}/{total_pages})")
-                        break
-                    
-                    # Si on est à la dernière page calculée, on arrête
-                    if page >= total_pages:
-                        logger.info(f"  ✅ Dernière page atteinte (page {page}/{total_pages})")
-                        break
-                    
-                    page += 1
-                else:
-                    logger.error(f"❌ Erreur lors de la récupération des promotions: {response.status_code}")
-                    # Continuer avec la page suivante en cas d'erreur temporaire
-                    if response.status_code == 500 or response.status_code == 503:
-                        logger.warning(f"⚠️ Erreur serveur, tentative de continuer...")
-                        page += 1
-                        continue
-                    break
+                progress_percent = page * 100 // fetcher.total_pages
+                logger.info(f"  ✅ Page {page}/{fetcher.total_pages} ({progress_percent}%): {len(promotions)} promotions récupérées (total: {len(all_promotions):,}/{total_records:,})")
                     
         except Exception as e:
             logger.error(f"❌ Erreur lors de la récupération des promotions: {e}")
@@ -331,7 +257,8 @@ class ProsumaAPIPromoExtractor:
             
             # Copier vers le réseau et supprimer le fichier local
             network_filepath = os.path.join(network_path, filename)
-            shutil.copy2(local_filepath, network_filepath)
+            with stage('network_copy'):
+                shutil.copy2(local_filepath, network_filepath)
             logger.info(f"✅ Fichier copié sur le réseau: {network_filepath}")
             
             # Supprimer le fichier local
@@ -367,7 +294,7 @@ class ProsumaAPIPromoExtractor:
         
         # Récupérer les informations du magasin
         logger.info(f"Récupération des informations du magasin {shop_code}...")
-        shop_data = self.get_shop_info(base_url, shop_code)
+        shop_data = get_cached_shop_info(self.session, base_url, shop_code, self.get_shop_info)
         if not shop_data:
             logger.error(f"❌ Impossible de récupérer les informations du magasin {shop_code}")
             return False
@@ -388,8 +315,10 @@ class ProsumaAPIPromoExtractor:
         logger.info(f"✅ {len(promotions)} promotions récupérées au total pour le magasin {shop_code}")
         
         # Exporter vers CSV
-        csv_file = self.export_to_csv(promotions, shop_code, shop_name)
+        with stage('csv'):
+            csv_file = self.export_to_csv(promotions, shop_code, shop_name)
         if csv_file:
+            record_rows_out(len(promotions))
             logger.info(f"✅ Magasin {shop_code} traité avec succès - Fichier sur le réseau: {csv_file}")
             return True
         else:
@@ -413,19 +342,22 @@ class ProsumaAPIPromoExtractor:
         total_shops = len(self.shop_codes)
         failed_shops = []  # Liste des magasins en échec avec leur nom
         
+        # Magasins traités en parallèle (plafond de magasins simultanés par serveur)
+        results = run_shops_parallel(self.shop_codes, self.shop_config, self.extract_shop)
+        
         for shop_code in self.shop_codes:
             try:
-                if self.extract_shop(shop_code):
+                if results[shop_code].result():
                     successful_shops += 1
                 else:
                     # Extraction échouée
-                    shop_name = self.shop_config.get(shop_code, {}).get(\'name\', \'Nom inconnu\')
+                    shop_name = self.shop_config.get(shop_code, {}).get('name', 'Nom inconnu')
                     failed_shops.append((shop_code, shop_name))
             except Exception as e:
-                # Erreur lors de l\'extraction
-                shop_name = self.shop_config.get(shop_code, {}).get(\'name\', \'Nom inconnu\')
+                # Erreur lors de l'extraction
+                shop_name = self.shop_config.get(shop_code, {}).get('name', 'Nom inconnu')
                 failed_shops.append((shop_code, shop_name))
-                logger.error(f"❌ Erreur lors de l\'extraction du magasin {shop_code}: {e}")
+                logger.error(f"❌ Erreur lors de l'extraction du magasin {shop_code}: {e}")
         
         # Résumé
         logger.info("=" * 60)
@@ -4,7 +4,6 @@ Extracteur API Prosuma RPOS - RECEPTION
 Récupère les données via l'API delivery
 """
 
-import requests
 import os
 import csv
 import json
@@ -18,7 +17,7 @@ import sys
 
 # Ajouter le répertoire parent au path pour importer utils
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler
+from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler, PageFetcher, run_shops_parallel, get_cached_shop_info, apply_high_water_mark, save_high_water_mark, extract_object_id, fetch_objects_by_ids, get_cached_suppliers, get_http_session, stage, record_rows_out, shop_log_handlers
 
 # Désactiver les warnings SSL
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -50,9 +49,7 @@ class ProsumaAPIReceptionExtractor:
         self.setup_logging()
         
         # Session HTTP
-        self.session = requests.Session()
-        self.session.auth = (self.username, self.password)
-        self.session.verify = False
+        self.session = get_http_session(self.username, self.password)
 
         print(f"Extracteur API initialisé pour {self.username}")
         print(f"Magasins configurés: {self.shop_codes}")
@@ -65,21 +62,21 @@ class ProsumaAPIReceptionExtractor:
             log_file = os.path.join(log_path, f'prosuma_api_reception.log')
             logging.basicConfig(
                 level=logging.INFO,
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                handlers=[
+                format='%(asctime)s - %(levelname)s - [%(shop)s] %(message)s',
+                handlers=shop_log_handlers([
                     logging.FileHandler(log_file, encoding='utf-8'),
                     SafeStreamHandler()
-                ]
+                ])
             )
         else:
             log_file = f'prosuma_api_reception.log'
             logging.basicConfig(
                 level=logging.INFO,
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                handlers=[
+                format='%(asctime)s - %(levelname)s - [%(shop)s] %(message)s',
+                handlers=shop_log_handlers([
                     logging.FileHandler(log_file, encoding='utf-8'),
                     SafeStreamHandler()
-                ]
+                ])
             )
         
         # Définir les permissions pour permettre à tous les utilisateurs d'écrire
@@ -238,45 +235,22 @@ class ProsumaAPIReceptionExtractor:
         # Collecter tous les IDs de commandes uniques
         order_ids = set()
         for delivery in deliveries:
-            order = delivery.get('order')
-            if isinstance(order, dict):
-                order_id = order.get('id')
-                if order_id:
-                    order_ids.add(order_id)
-            elif isinstance(order, str):
-                # Si order est une URL, extraire l'ID
-                if order.endswith('/'):
-                    order = order[:-1]
-                order_id = order.split('/')[-1]
-                if order_id:
-                    order_ids.add(order_id)
+            order_id = extract_object_id(delivery.get('order'))
+            if order_id:
+                order_ids.add(order_id)
         
         logger.info(f"   📊 {len(order_ids)} commande(s) unique(s) à récupérer")
         
-        # Créer un cache pour les informations des commandes
-        order_cache = {}
-        supplier_cache = {}
+        # Commandes récupérées par lots (filtre id__in), sinon une par une en parallèle
+        order_cache = fetch_objects_by_ids(
+            self.session, base_url, 'supplier_order', order_ids,
+            lambda order_id: self.get_order_info(base_url, order_id)
+        )
         
-        for order_id in order_ids:
-            order_info = self.get_order_info(base_url, order_id)
-            if order_info:
-                order_cache[order_id] = order_info
-                
-                # Récupérer aussi les informations du fournisseur si disponible
-                supplier = order_info.get('supplier', {})
-                supplier_id = None
-                
-                if isinstance(supplier, dict):
-                    supplier_id = supplier.get('id')
-                elif isinstance(supplier, str):
-                    if supplier.endswith('/'):
-                        supplier = supplier[:-1]
-                    supplier_id = supplier.split('/')[-1]
-                
-                if supplier_id and supplier_id not in supplier_cache:
-                    supplier_info = self.get_supplier_info(base_url, supplier_id)
-                    if supplier_info:
-                        supplier_cache[supplier_id] = supplier_info
+        # Fournisseurs: cache disque partagé par les magasins et les APIs d'un même serveur
+        supplier_ids = {extract_object_id(order_info.get('supplier')) for order_info in order_cache.values()}
+        supplier_ids.discard(None)
+        supplier_cache = get_cached_suppliers(self.session, base_url, supplier_ids, self.get_supplier_info)
         
         logger.info(f"   ✅ {len(order_cache)} commande(s) récupérée(s)")
         logger.info(f"   ✅ {len(supplier_cache)} fournisseur(s) récupéré(s)")
@@ -284,30 +258,14 @@ class ProsumaAPIReceptionExtractor:
         # Enrichir les réceptions avec les informations de la commande
         enriched_count = 0
         for delivery in deliveries:
-            order = delivery.get('order')
-            order_id = None
-            
-            if isinstance(order, dict):
-                order_id = order.get('id')
-            elif isinstance(order, str):
-                if order.endswith('/'):
-                    order = order[:-1]
-                order_id = order.split('/')[-1]
+            order_id = extract_object_id(delivery.get('order'))
             
             if order_id and order_id in order_cache:
                 order_info = order_cache[order_id]
                 
                 # Pour les réceptions : is_central=True = commande directe, is_central=False = commande réassort
                 # Enrichir le supplier dans order avec is_central
-                supplier = order_info.get('supplier', {})
-                supplier_id = None
-                
-                if isinstance(supplier, dict):
-                    supplier_id = supplier.get('id')
-                elif isinstance(supplier, str):
-                    if supplier.endswith('/'):
-                        supplier = supplier[:-1]
-                    supplier_id = supplier.split('/')[-1]
+                supplier_id = extract_object_id(order_info.get('supplier', {}))
                 
                 if supplier_id and supplier_id in supplier_cache:
                     supplier_info = supplier_cache[supplier_id]
@@ -336,41 +294,32 @@ class ProsumaAPIReceptionExtractor:
         return deliveries
 
     
-    def count_total_records(self, base_url, shop_id, page_size=1000):
-        """Compte le nombre total d'enregistrements disponibles (réceptions de commandes directes)"""
-        try:
-            url = f"{base_url}/api/delivery/"
-            params = {
-                'shop': shop_id,
-                'page_size': page_size,
-                'page': 1,
-                'is_central': 'true'  # Filtrer pour les réceptions de commandes directes (is_central=true = commande directe)
-            }
-            
-            # Ajouter les paramètres de date si disponibles
-            if hasattr(self, 'start_date') and hasattr(self, 'end_date'):
-                params['date_0'] = self.start_date.strftime('%Y-%m-%dT%H:%M:%S')
-                params['date_1'] = self.end_date.strftime('%Y-%m-%dT%H:%M:%S')
-            
-            response = self.session.get(url, params=params, timeout=30)
-            
-            if response.status_code == 200:
-                data = response.json()
-                total_count = data.get('count', 0)
-                return total_count
-            else:
-                logger.error(f"❌ Erreur lors du comptage: {response.status_code}")
-                return 0
-                
-        except Exception as e:
-            logger.error(f"❌ Erreur lors du comptage: {e}")
-            return 0
+    def create_page_fetcher(self, base_url, shop_id, page_size=1000):
+        """Prépare la pagination de l'endpoint (URL, filtres, taille de page)"""
+        url = f"{base_url}/api/delivery/"
+        params = {
+            'shop': shop_id,
+            'page_size': page_size,
+            'is_central': 'true'  # Filtrer pour les réceptions de commandes directes (is_central=true = commande directe)
+        }
+        
+        # Ajouter les paramètres de date si disponibles
+        if hasattr(self, 'start_date') and hasattr(self, 'end_date'):
+            params['date_0'] = self.start_date.strftime('%Y-%m-%dT%H:%M:%S')
+            params['date_1'] = self.end_date.strftime('%Y-%m-%dT%H:%M:%S')
+        
+        # Mode incrémental: ne demander que les enregistrements après le dernier export
+        apply_high_water_mark(params, "RECEPTION", base_url, shop_id)
+        
+        return PageFetcher(self.session, url, params, page_size=page_size, timeout=30,
+                           checkpoint_name="RECEPTION")
 
     def get_data(self, base_url, shop_id, page_size=1000):
         """Récupère les réceptions de commandes directes avec pagination complète"""
         # D'abord, compter le nombre total d'enregistrements
         logger.info("🔍 Comptage du nombre total de réceptions de commandes directes...")
-        total_records = self.count_total_records(base_url, shop_id, page_size)
+        fetcher = self.create_page_fetcher(base_url, shop_id, page_size)
+        total_records = fetcher.count_records()
         
         if total_records == 0:
             logger.warning("⚠️ Aucune réception de commande directe trouvée")
@@ -386,64 +335,16 @@ class ProsumaAPIReceptionExtractor:
         logger.info("=" * 60)
         
         all_data = []
-        page = 1
-        total_pages = (total_records + page_size - 1) // page_size  # Calcul du nombre total de pages
         
         logger.info(f"🔍 Filtres API appliqués:")
         logger.info(f"   - is_central: true (réceptions de commandes directes)")
         
         try:
-            while page <= total_pages:
-                url = f"{base_url}/api/delivery/"
-                params = {
-                    'shop': shop_id,
-                    'page_size': page_size,
-                    'page': page,
-                    'is_central': 'true'  # Filtrer pour les réceptions de commandes directes (is_central=true = commande directe)
-                }
-                
-                # Ajouter les paramètres de date si disponibles
-                if hasattr(self, 'start_date') and hasattr(self, 'end_date'):
-                    params['date_0'] = self.start_date.strftime('%Y-%m-%dT%H:%M:%S')
-                    params['date_1'] = self.end_date.strftime('%Y-%m-%dT%H:%M:%S')
-                
-                # Afficher la progression
-                progress_percent = (page - 1) * 100 // total_pages if total_pages > 0 else 0
-                logger.info(f"📄 Récupération page {page}/{total_pages} ({progress_percent}%) - {len(all_data):,}/{total_records:,} enregistrements...")
-                
-                response = self.session.get(url, params=params, timeout=30)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    items = data.get('results', [])
-                    
-                    if not items:
-                        logger.info(f"  ✅ Dernière page atteinte (page {page}) - Aucun enregistrement retourné")
-                        break
-                    
-                    all_data.extend(items)
-                    logger.info(f"  ✅ Page {page}: {len(items)} réceptions récupérées (total: {len(all_data):,}/{total_records:,})")
-                    
-                    # Vérifier si on a récupéré tous les enregistrements ou si on est à la dernière page
-                    if len(all_data) >= total_records:
-                        logger.info(f"  ✅ Toutes les réceptions récupérées (page {page}/{total_pages})")
-                        break
-                    
-                    # Si on est à la dernière page calculée, on arrête
-                    if page >= total_pages:
-                        logger.info(f"  ✅ Dernière page atteinte (page {page}/{total_pages})")
-                        break
-                    
-                    # Continuer avec la page suivante
-                    page += 1
-                else:
-                    logger.error(f"❌ Erreur lors de la récupération des données: {response.status_code}")
-                    # Continuer avec la page suivante en cas d'erreur temporaire
-                    if response.status_code == 500 or response.status_code == 503:
-                        logger.warning(f"⚠️ Erreur serveur, tentative de continuer...")
-                        page += 1
-                        continue
-                    break
+            # Page 1 reprise du comptage, pages 2..N récupérées en parallèle
+            for page, items in fetcher.iter_pages(total_records):
+                all_data.extend(items)
+                progress_percent = page * 100 // fetcher.total_pages
+                logger.info(f"  ✅ Page {page}/{fetcher.total_pages} ({progress_percent}%): {len(items)} réceptions récupérées (total: {len(all_data):,}/{total_records:,})")
                     
         except Exception as e:
             logger.error(f"❌ Erreur lors de la récupération des données: {e}")
@@ -451,7 +352,8 @@ class ProsumaAPIReceptionExtractor:
         # Enrichir les réceptions avec les informations de la commande (order) pour obtenir is_direct et is_central
         if all_data:
             logger.info(f"🔍 Enrichissement des réceptions avec les informations des commandes...")
-            all_data = self.enrich_deliveries_with_order_info(base_url, all_data)
+            with stage('enrichment'):
+                all_data = self.enrich_deliveries_with_order_info(base_url, all_data)
         
         # Filtre de sécurité supplémentaire : vérifier que les réceptions sont bien des commandes directes
         original_count = len(all_data)
@@ -779,7 +681,7 @@ class ProsumaAPIReceptionExtractor:
         
         return unique_fields
 
-def export_to_csv(self, data, shop_code, shop_name):
+    def export_to_csv(self, data, shop_code, shop_name):
         """Exporte les données vers un fichier CSV avec formatage amélioré"""
         if not data:
             logger.warning(f"Aucune donnée à exporter pour le magasin {shop_code}")
@@ -1005,7 +907,8 @@ def export_to_csv(self, data, shop_code, shop_name):
             
             # Copier vers le réseau et supprimer le fichier local
             network_filepath = os.path.join(network_path, filename)
-            shutil.copy2(local_filepath, network_filepath)
+            with stage('network_copy'):
+                shutil.copy2(local_filepath, network_filepath)
             logger.info(f"✅ Fichier copié sur le réseau: {network_filepath}")
             
             # Supprimer le fichier local
@@ -1041,7 +944,7 @@ def export_to_csv(self, data, shop_code, shop_name):
         
         # Récupérer les informations du magasin
         logger.info(f"Récupération des informations du magasin {shop_code}...")
-        shop_data = self.get_shop_info(base_url, shop_code)
+        shop_data = get_cached_shop_info(self.session, base_url, shop_code, self.get_shop_info)
         if not shop_data:
             logger.error(f"❌ Impossible de récupérer les informations du magasin {shop_code}")
             return False
@@ -1065,14 +968,17 @@ def export_to_csv(self, data, shop_code, shop_name):
         logger.info("=" * 60)
         logger.info(f"💾 EXPORT CSV - MAGASIN {shop_code}")
         logger.info("=" * 60)
-        csv_file = self.export_to_csv(data, shop_code, shop_name)
+        with stage('csv'):
+            csv_file = self.export_to_csv(data, shop_code, shop_name)
         if csv_file:
+            record_rows_out(len(data))
+            save_high_water_mark("RECEPTION", base_url, shop_id, data)
             logger.info("=" * 60)
-        logger.info(f"✅ MAGASIN {shop_code} TRAITÉ AVEC SUCCÈS")
-        logger.info("=" * 60)
-        logger.info(f"📁 Fichier sur le réseau: {csv_file}")
+            logger.info(f"✅ MAGASIN {shop_code} TRAITÉ AVEC SUCCÈS")
+            logger.info("=" * 60)
+            logger.info(f"📁 Fichier sur le réseau: {csv_file}")
             logger.info(f"📊 Lignes exportées: {len(data):,}")
-        logger.info("=" * 60)
+            logger.info("=" * 60)
             return True
         else:
             logger.error(f"❌ Erreur lors de l'export pour le magasin {shop_code}")
@@ -1095,9 +1001,12 @@ def export_to_csv(self, data, shop_code, shop_name):
         total_shops = len(self.shop_codes)
         failed_shops = []  # Liste des magasins en échec avec leur nom
         
+        # Magasins traités en parallèle (plafond de magasins simultanés par serveur)
+        results = run_shops_parallel(self.shop_codes, self.shop_config, self.extract_shop)
+        
         for shop_code in self.shop_codes:
             try:
-                if self.extract_shop(shop_code):
+                if results[shop_code].result():
                     successful_shops += 1
                 else:
                     # Extraction échouée
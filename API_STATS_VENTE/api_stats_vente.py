@@ -5,7 +5,6 @@ Extracteur API Prosuma RPOS - STATS_VENTE
 Récupère les données via l'API product_line
 """
 
-import requests
 import os
 import csv
 import json
@@ -13,11 +12,11 @@ import logging
 import shutil
 import platform
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import urllib3
 import sys
 import io
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Configurer stdout/stderr pour UTF-8 sur Windows
 if sys.platform == 'win32':
@@ -28,7 +27,7 @@ if sys.platform == 'win32':
 
 # Ajouter le répertoire parent au path pour importer utils
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler
+from utils import load_shop_config, build_network_path, create_network_folder, SafeStreamHandler, PageFetcher, run_shops_parallel, get_cached_shop_info, RecordSpool, apply_high_water_mark, save_high_water_mark, cached_lookup, with_current_context, get_http_session, stage, record_rows_out, ShopContextFilter
 
 # Désactiver les warnings SSL
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -60,9 +59,7 @@ class ProsumaAPIStatsventeExtractor:
         self.setup_logging()
         
         # Session HTTP
-        self.session = requests.Session()
-        self.session.auth = (self.username, self.password)
-        self.session.verify = False
+        self.session = get_http_session(self.username, self.password)
 
         print(f"Extracteur API initialisé pour {self.username}")
         print(f"Magasins configurés: {self.shop_codes}")
@@ -70,9 +67,12 @@ class ProsumaAPIStatsventeExtractor:
 
     def setup_logging(self):
         """Configure le logging avec fichier sur le réseau"""
-        # Désactiver tous les handlers existants pour éviter les conflits
+        global logger
         root_logger = logging.getLogger()
-        root_logger.handlers = []
+        if root_logger.handlers:
+            # Logging déjà configuré (orchestrateur run_api_extraction.py): ses handlers sont conservés
+            logger = logging.getLogger(__name__)
+            return
         
         log_path = self.get_log_network_path()
         if log_path:
@@ -85,9 +85,11 @@ class ProsumaAPIStatsventeExtractor:
         stream_handler = SafeStreamHandler()
         
         # Formatter
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - [%(shop)s] %(message)s')
         file_handler.setFormatter(formatter)
         stream_handler.setFormatter(formatter)
+        file_handler.addFilter(ShopContextFilter())
+        stream_handler.addFilter(ShopContextFilter())
         
         # Configurer le logger root
         root_logger.setLevel(logging.INFO)
@@ -98,7 +100,6 @@ class ProsumaAPIStatsventeExtractor:
         from utils import set_log_file_permissions
         set_log_file_permissions(log_file)
         
-        global logger
         logger = logging.getLogger(__name__)
 
     def setup_dates(self):
@@ -205,37 +206,28 @@ class ProsumaAPIStatsventeExtractor:
             logger.error(f"❌ Erreur lors de la récupération des informations du magasin: {e}")
             return None
 
-    def count_total_records(self, base_url, shop_id, page_size=1000):
-        """Compte le nombre total d'enregistrements disponibles"""
-        try:
-            url = f"{base_url}/api/product_line/"
-            params = {
-                'shop': shop_id,
-                'page_size': page_size,
-                'page': 1,
-                'date_0': self.start_date.strftime('%Y-%m-%dT%H:%M:%S'),
-                'date_1': self.end_date.strftime('%Y-%m-%dT%H:%M:%S')
-            }
-            
-            response = self.session.get(url, params=params, timeout=30)
-            
-            if response.status_code == 200:
-                data = response.json()
-                total_count = data.get('count', 0)
-                return total_count
-            else:
-                logger.error(f"❌ Erreur lors du comptage: {response.status_code}")
-                return 0
-                
-        except Exception as e:
-            logger.error(f"❌ Erreur lors du comptage: {e}")
-            return 0
+    def create_page_fetcher(self, base_url, shop_id, page_size=1000):
+        """Prépare la pagination de l'endpoint (URL, filtres, taille de page)"""
+        url = f"{base_url}/api/product_line/"
+        params = {
+            'shop': shop_id,
+            'page_size': page_size,
+            'date_0': self.start_date.strftime('%Y-%m-%dT%H:%M:%S'),
+            'date_1': self.end_date.strftime('%Y-%m-%dT%H:%M:%S')
+        }
+        
+        # Mode incrémental: ne demander que les enregistrements après le dernier export
+        apply_high_water_mark(params, "STATS_VENTE", base_url, shop_id)
+        
+        return PageFetcher(self.session, url, params, page_size=page_size, timeout=30,
+                           checkpoint_name="STATS_VENTE", keyset=True)
 
     def get_data(self, base_url, shop_id, page_size=1000):
         """Récupère les données avec pagination complète et enrichissement"""
         # D'abord, compter le nombre total d'enregistrements
         logger.info("🔍 Comptage du nombre total d'enregistrements...")
-        total_records = self.count_total_records(base_url, shop_id, page_size)
+        fetcher = self.create_page_fetcher(base_url, shop_id, page_size)
+        total_records = fetcher.count_records()
         
         if total_records == 0:
             logger.warning("⚠️ Aucun enregistrement trouvé")
@@ -250,62 +242,19 @@ class ProsumaAPIStatsventeExtractor:
         logger.info(f"🏪 Magasin: {shop_id}")
         logger.info("=" * 60)
         
-        all_data = []
-        page = 1
-        total_pages = (total_records + page_size - 1) // page_size  # Calcul du nombre total de pages
+        all_data = RecordSpool()  # Écrit sur disque page par page (mémoire bornée)
         
         try:
-            while page <= total_pages:
-                url = f"{base_url}/api/product_line/"
-                params = {
-                    'shop': shop_id,
-                    'page_size': page_size,
-                    'page': page,
-                    'date_0': self.start_date.strftime('%Y-%m-%dT%H:%M:%S'),
-                    'date_1': self.end_date.strftime('%Y-%m-%dT%H:%M:%S')
-                }
-                
-                # Afficher la progression
-                progress_percent = (page - 1) * 100 // total_pages if total_pages > 0 else 0
-                logger.info(f"📄 Récupération page {page}/{total_pages} ({progress_percent}%) - {len(all_data):,}/{total_records:,} enregistrements...")
-                
-                response = self.session.get(url, params=params, timeout=30)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    items = data.get('results', [])
-                    
-                    if not items:
-                        logger.info(f"  ✅ Dernière page atteinte (page {page}) - Aucun enregistrement retourné")
-                        break
-                    
-                    # Enrichir les données avec les informations des tickets et produits
+            # Page 1 reprise du comptage, pages 2..N récupérées en parallèle
+            for page, items in fetcher.iter_pages(total_records):
+                # Enrichir les données avec les informations des tickets et produits
+                with stage('enrichment'):
                     enriched_items = self.enrich_data(items, base_url)
-                    all_data.extend(enriched_items)
-                    
-                    # Afficher la progression détaillée
-                    logger.info(f"  ✅ Page {page}: {len(items)} éléments récupérés (total: {len(all_data):,}/{total_records:,})")
-                    
-                    # Vérifier si on a récupéré tous les enregistrements ou si on est à la dernière page
-                    if len(all_data) >= total_records:
-                        logger.info(f"  ✅ Tous les enregistrements récupérés (page {page}/{total_pages})")
-                        break
-                    
-                    # Si on est à la dernière page calculée, on arrête
-                    if page >= total_pages:
-                        logger.info(f"  ✅ Dernière page atteinte (page {page}/{total_pages})")
-                        break
-                    
-                    # Continuer avec la page suivante
-                    page += 1
-                else:
-                    logger.error(f"❌ Erreur lors de la récupération des données: {response.status_code}")
-                    # Continuer avec la page suivante en cas d'erreur temporaire
-                    if response.status_code == 500 or response.status_code == 503:
-                        logger.warning(f"⚠️ Erreur serveur, tentative de continuer...")
-                        page += 1
-                        continue
-                    break
+                all_data.extend(enriched_items)
+                
+                # Afficher la progression détaillée
+                progress_percent = page * 100 // fetcher.total_pages
+                logger.info(f"  ✅ Page {page}/{fetcher.total_pages} ({progress_percent}%): {len(items)} éléments récupérés (total: {len(all_data):,}/{total_records:,})")
                     
         except Exception as e:
             logger.error(f"❌ Erreur lors de la récupération des données: {e}")
@@ -384,51 +333,30 @@ class ProsumaAPIStatsventeExtractor:
             product_id = self._extract_id(product_value)
             
             if receipt_id:
+                receipt_id = str(receipt_id)
                 receipt_ids.add(receipt_id)
                 item_receipt_map[idx] = receipt_id
             
             if product_id:
+                product_id = str(product_id)
                 product_ids.add(product_id)
                 item_product_map[idx] = product_id
         
-        # Créer des dictionnaires pour stocker les résultats
-        ticket_cache = {}
-        product_cache = {}
-        
-        # Utiliser ThreadPoolExecutor pour les requêtes parallèles
-        max_workers = min(20, len(receipt_ids) + len(product_ids))  # Limiter à 20 threads max
-        
-        if receipt_ids or product_ids:
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                # Soumettre toutes les tâches
-                future_to_receipt = {
-                    executor.submit(self._fetch_ticket_info, receipt_id, base_url): receipt_id 
-                    for receipt_id in receipt_ids
-                }
-                future_to_product = {
-                    executor.submit(self._fetch_product_info, product_id, base_url): product_id 
-                    for product_id in product_ids
-                }
-                
-                # Récupérer les résultats des tickets
-                for future in as_completed(future_to_receipt):
-                    receipt_id = future_to_receipt[future]
-                    try:
-                        ticket_info = future.result()
-                        if ticket_info:
-                            ticket_cache[receipt_id] = ticket_info
-                    except Exception as e:
-                        logger.debug(f"Erreur lors de la récupération du ticket {receipt_id}: {e}")
-                
-                # Récupérer les résultats des produits
-                for future in as_completed(future_to_product):
-                    product_id = future_to_product[future]
-                    try:
-                        product_info = future.result()
-                        if product_info:
-                            product_cache[product_id] = product_info
-                    except Exception as e:
-                        logger.debug(f"Erreur lors de la récupération du produit {product_id}: {e}")
+        # Cache persistant (SQLite) partagé entre magasins et exécutions:
+        # seuls les tickets et produits jamais vus sont demandés, en parallèle (20 threads max),
+        # les tickets et les produits en même temps
+        server = base_url.rstrip('/')
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            tickets = executor.submit(with_current_context(cached_lookup),
+                f"receipt|{server}", receipt_ids,
+                lambda receipt_id: self._fetch_ticket_info(receipt_id, base_url)
+            )
+            products = executor.submit(with_current_context(cached_lookup),
+                f"product|{server}", product_ids,
+                lambda product_id: self._fetch_product_info(product_id, base_url)
+            )
+            ticket_cache = tickets.result()
+            product_cache = products.result()
         
         # Enrichir les items avec les données en cache
         for idx, item in enumerate(enriched_items):
@@ -536,7 +464,8 @@ class ProsumaAPIStatsventeExtractor:
             
             # Copier vers le réseau et supprimer le fichier local
             network_filepath = os.path.join(network_path, filename)
-            shutil.copy2(local_filepath, network_filepath)
+            with stage('network_copy'):
+                shutil.copy2(local_filepath, network_filepath)
             logger.info(f"✅ Fichier copié sur le réseau: {network_filepath}")
             
             # Supprimer le fichier local
@@ -572,7 +501,7 @@ class ProsumaAPIStatsventeExtractor:
         
         # Récupérer les informations du magasin
         logger.info(f"Récupération des informations du magasin {shop_code}...")
-        shop_data = self.get_shop_info(base_url, shop_code)
+        shop_data = get_cached_shop_info(self.session, base_url, shop_code, self.get_shop_info)
         if not shop_data:
             logger.error(f"❌ Impossible de récupérer les informations du magasin {shop_code}")
             return False
@@ -601,8 +530,11 @@ class ProsumaAPIStatsventeExtractor:
         logger.info("=" * 60)
         logger.info(f"💾 EXPORT CSV - MAGASIN {shop_code}")
         logger.info("=" * 60)
-        csv_file = self.export_to_csv(data, shop_code, shop_name)
+        with stage('csv'):
+            csv_file = self.export_to_csv(data, shop_code, shop_name)
         if csv_file:
+            record_rows_out(len(data))
+            save_high_water_mark("STATS_VENTE", base_url, shop_id, data)
             logger.info("=" * 60)
             logger.info(f"✅ MAGASIN {shop_code} TRAITÉ AVEC SUCCÈS")
             logger.info("=" * 60)
@@ -631,19 +563,22 @@ class ProsumaAPIStatsventeExtractor:
         total_shops = len(self.shop_codes)
         failed_shops = []  # Liste des magasins en échec avec leur nom
         
+        # Magasins traités en parallèle (plafond de magasins simultanés par serveur)
+        results = run_shops_parallel(self.shop_codes, self.shop_config, self.extract_shop)
+        
         for shop_code in self.shop_codes:
             try:
-                if self.extract_shop(shop_code):
+                if results[shop_code].result():
                     successful_shops += 1
                 else:
                     # Extraction échouée
-                    shop_name = self.shop_config.get(shop_code, {}).get(\'name\', \'Nom inconnu\')
+                    shop_name = self.shop_config.get(shop_code, {}).get('name', 'Nom inconnu')
                     failed_shops.append((shop_code, shop_name))
             except Exception as e:
-                # Erreur lors de l\'extraction
-                shop_name = self.shop_config.get(shop_code, {}).get(\'name\', \'Nom inconnu\')
+                # Erreur lors de l'extraction
+                shop_name = self.shop_config.get(shop_code, {}).get('name', 'Nom inconnu')
                 failed_shops.append((shop_code, shop_name))
-                logger.error(f"❌ Erreur lors de l\'extraction du magasin {shop_code}: {e}")
+                logger.error(f"❌ Erreur lors de l'extraction du magasin {shop_code}: {e}")
         
         # Résumé
         logger.info("=" * 60)
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Serveur Prosuma RPOS simulé, pour mesurer les extracteurs sans toucher aux serveurs posN de production
+
+Chaque serveur posN simulé écoute sur son propre port local et sert, pour ses
+magasins, les données de synthetic_data.py avec la pagination DRF (count/next/results):
+/api/user/, /api/shop/, /api/supplier_order/, /api/delivery/, /api/stock_move/,
+/api/product/, /api/product_line/, /api/receipt/, /api/supplier/,
+/api/promotion/ et /api/event_line/product_not_found.
+
+Latence (fixe + par enregistrement) et erreurs (503, timeouts) sont injectables,
+et le volume comme les cardinalités sont réglables: les mesures sont reproductibles (--seed).
+
+Usage:
+    python3 BENCHMARK/mock_prosuma_server.py --servers 3 --shops-per-server 2
+    python3 BENCHMARK/mock_prosuma_server.py --volume 5 --latency-ms 80 --error-rate 0.02
+    python3 BENCHMARK/mock_prosuma_server.py --magasins BENCHMARK/magasins_mock.json
+
+Statistiques des requêtes reçues: GET /__stats__ (remise à zéro: /__stats__?reset=1)
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+from bisect import bisect_right
+from collections import OrderedDict, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl, urlencode
+
+from synthetic_data import SyntheticData, SERVER_TABLES, build_shops, parse_rows
+
+# Filtres booléens acceptés, par endpoint
+BOOLEAN_FILTERS = ('is_external', 'is_direct', 'is_deleted', 'is_awaiting_delivery', 'is_central', 'is_active')
+
+class Dataset(SyntheticData):
+    """Données d'un serveur posN simulé (synthetic_data.py) et filtres DRF de l'API"""
+
+    def __init__(self, *args, **kwargs):
+        self._queries = OrderedDict()
+        self._queries_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def query(self, name, params):
+        """Applique les filtres DRF supportés et retourne la liste résultante.
+
+        Le résultat filtré est mis en cache (hors page, page_size et id__gt):
+        paginer 1M de lignes ne refiltre pas toute la table à chaque page.
+        """
+        if params.get('id__in'):
+            ids = {int(i) for i in params['id__in'].split(',') if i.isdigit()}
+            table = self.by_id[name]
+            rows = self._filter(sorted((table[i] for i in ids if i in table), key=lambda row: row['id'], reverse=True),
+                                name, params)
+            ids = None
+        else:
+            key = (name, tuple(sorted((k, v) for k, v in params.items() if k not in ('page', 'page_size', 'id__gt'))))
+            with self._queries_lock:
+                cached = self._queries.get(key)
+                if cached:
+                    self._queries.move_to_end(key)
+            if cached is None:
+                rows = self._filter(self.tables[name], name, params)
+                cached = (rows, [row['id'] for row in rows])
+                with self._queries_lock:
+                    self._queries[key] = cached
+                    while len(self._queries) > 32:
+                        self._queries.popitem(last=False)
+            rows, ids = cached
+        if params.get('id__gt', '').isdigit():
+            after = int(params['id__gt'])
+            if ids is not None and params.get('ordering') == 'id':
+                rows = rows[bisect_right(ids, after):]
+            else:
+                rows = [row for row in rows if row['id'] > after]
+        return rows
+
+    def _filter(self, rows, name, params):
+        shop = params.get('shop')
+        if shop and name not in SERVER_TABLES + ('shop',):
+            rows = [row for row in rows if str(_object_id(row.get('shop'))) == shop]
+        for field in ('reference', 'code'):
+            if params.get(field):
+                rows = [row for row in rows if row.get(field) == params[field]]
+        if params.get('date_0'):
+            rows = [row for row in rows if row.get('date', '') >= params['date_0'][:19]]
+        if params.get('date_1'):
+            rows = [row for row in rows if row.get('date', '') <= params['date_1'][:19]]
+        for field in BOOLEAN_FILTERS:
+            if field in params:
+                wanted = params[field].lower() == 'true'
+                rows = [row for row in rows if bool(row.get(field)) == wanted]
+        if 'has_promo_price' in params:
+            wanted = params['has_promo_price'].lower() == 'true'
+            rows = [row for row in rows if (row.get('promo_price') is not None) == wanted]
+        ordering = params.get('ordering')
+        if ordering in ('id', '-id'):
+            rows = sorted(rows, key=lambda row: row['id'], reverse=ordering == '-id')
+        return list(rows)
+
+def _object_id(value):
+    return value.get('id') if isinstance(value, dict) else value
+
+# Chemins d'API -> table du jeu de données
+ROUTES = {
+    'shop': 'shop', 'supplier': 'supplier', 'supplier_order': 'supplier_order', 'delivery': 'delivery',
+    'stock_move': 'stock_move', 'product': 'product', 'product_line': 'product_line', 'receipt': 'receipt',
+    'promotion': 'promotion', 'event_line/product_not_found': 'product_not_found',
+}
+
+class MockOptions:
+    """Latence, erreurs et pagination du serveur simulé"""
+
+    def __init__(self, latency_ms=50, latency_per_item_ms=0.05, jitter=0.2, error_rate=0.0,
+                 timeout_rate=0.0, hang_seconds=120, max_page_size=5000, count_zero=(), seed=42):
+        self.latency_ms = latency_ms
+        self.latency_per_item_ms = latency_per_item_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang_seconds = hang_seconds
+        self.max_page_size = max_page_size
+        self.count_zero = set(count_zero)
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+
+    def draw(self):
+        with self.rng_lock:
+            return self.rng.random(), self.rng.random(), self.rng.uniform(1 - self.jitter, 1 + self.jitter)
+
+class MockStats:
+    """Compteurs de requêtes par endpoint (consultables via /__stats__)
+
+    rows compte les enregistrements renvoyés par les listes paginées et
+    first_row_at (horodatage time.time()) la première réponse non vide.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = defaultdict(int)
+            self.errors = defaultdict(int)
+            self.rows = defaultdict(int)
+            self.bytes = 0
+            self.first_row_at = None
+
+    def add(self, endpoint, size, error=False, rows=0):
+        with self.lock:
+            self.requests[endpoint] += 1
+            self.bytes += size
+            if rows:
+                self.rows[endpoint] += rows
+                if self.first_row_at is None:
+                    self.first_row_at = time.time()
+            if error:
+                self.errors[endpoint] += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'errors': dict(self.errors), 'rows': dict(self.rows),
+                    'total_requests': sum(self.requests.values()), 'total_rows': sum(self.rows.values()),
+                    'bytes': self.bytes, 'first_row_at': self.first_row_at}
+
+def make_handler(dataset, options, stats):
+    """Classe de handler HTTP liée à un jeu de données"""
+
+    class ProsumaHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, comme les serveurs de production
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, payload, endpoint, rows=0):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            stats.add(endpoint, len(body), error=status >= 500, rows=rows)
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            params = dict(parse_qsl(parsed.query))
+            path = parsed.path.strip('/')
+
+            if path == '__stats__':
+                if params.get('reset'):
+                    stats.reset()
+                return self._send(200, stats.as_dict(), '__stats__')
+            if not self.headers.get('Authorization'):
+                return self._send(401, {'detail': "Informations d'authentification non fournies."}, path)
+            if path == 'api':
+                return self._send(200, {name: f"{dataset.base_url}/api/{name}/" for name in ROUTES}, 'api')
+            if not path.startswith('api/'):
+                return self._send(404, {'detail': 'Pas trouvé.'}, path)
+            path = path[len('api/'):]
+
+            error_draw, timeout_draw, jitter = options.draw()
+            if timeout_draw < options.timeout_rate:
+                time.sleep(options.hang_seconds)
+            if error_draw < options.error_rate:
+                time.sleep(options.latency_ms / 1000 * jitter)
+                return self._send(503, {'detail': 'Service temporairement indisponible.'}, path)
+
+            if path == 'user':
+                time.sleep(options.latency_ms / 1000 * jitter)
+                return self._send(200, {'count': 1, 'next': None, 'previous': None,
+                                        'results': [{'id': 1, 'username': 'benchmark'}]}, 'user')
+
+            # Détail: /api/<endpoint>/<id>/
+            endpoint, _, object_id = path.rpartition('/')
+            if endpoint in ROUTES and object_id:
+                time.sleep(options.latency_ms / 1000 * jitter)
+                table = ROUTES[endpoint]
+                row = dataset.by_id[table].get(int(object_id)) if object_id.isdigit() else None
+                if row is None and table == 'shop':
+                    row = next((shop for shop in dataset.shops if shop['reference'] == object_id), None)
+                if row is None:
+                    return self._send(404, {'detail': 'Pas trouvé.'}, endpoint)
+                return self._send(200, row, endpoint)
+
+            if path not in ROUTES:
+                return self._send(404, {'detail': 'Pas trouvé.'}, path)
+            rows = dataset.query(ROUTES[path], params)
+            try:
+                page = int(params.get('page', 1))
+                page_size = min(int(params.get('page_size', 100)), options.max_page_size)
+            except ValueError:
+                return self._send(400, {'detail': 'Paramètre de pagination invalide.'}, path)
+            last_page = max(1, (len(rows) + page_size - 1) // page_size)
+            if page < 1 or page > last_page:
+                return self._send(404, {'detail': 'Page non valide.'}, path)
+            results = rows[(page - 1) * page_size:page * page_size]
+            next_url = None
+            if page < last_page:
+                next_url = f"{dataset.base_url}{parsed.path}?{urlencode({**params, 'page': page + 1})}"
+            time.sleep((options.latency_ms + options.latency_per_item_ms * len(results)) / 1000 * jitter)
+            count = 0 if path in options.count_zero else len(rows)
+            self._send(200, {'count': count, 'next': next_url if count else None, 'previous': None,
+                             'results': results}, path, rows=len(results))
+
+    return ProsumaHandler
+
+def start_servers(servers=2, shops_per_server=2, port=8800, host='127.0.0.1', volume=1.0,
+                  days=30, seed=42, options=None, rows=None, skew=0.0):
+    """Démarre les serveurs simulés en arrière-plan.
+
+    rows fixe le nombre exact d'enregistrements de certaines tables, ex:
+    {'stock_move': 1000000} (par magasin, ou par serveur pour product/supplier).
+    Retourne (liste de ThreadingHTTPServer, magasins au format magasins.json, MockStats).
+    """
+    options = options or MockOptions(seed=seed)
+    stats = MockStats()
+    httpds = []
+    magasins = {}
+    for index in range(servers):
+        base_url = f"http://{host}:{port + index}"
+        shops = build_shops(index, shops_per_server)
+        dataset = Dataset(base_url, shops, volume=volume, rows=rows, days=days, skew=skew, seed=seed + index)
+        httpd = ThreadingHTTPServer((host, port + index), make_handler(dataset, options, stats))
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True, name=f"mock-pos{index + 1}").start()
+        httpds.append(httpd)
+        for shop in shops:
+            magasins[shop['reference']] = {'url': base_url, 'name': shop['name']}
+    return httpds, magasins, stats
+
+def main():
+    """Fonction principale"""
+    parser = argparse.ArgumentParser(description="Serveur Prosuma RPOS simulé (benchmark hors ligne)")
+    parser.add_argument('--servers', type=int, default=2, help="Nombre de serveurs posN simulés (un port chacun)")
+    parser.add_argument('--shops-per-server', type=int, default=2, help="Magasins par serveur")
+    parser.add_argument('--port', type=int, default=8800, help="Port du premier serveur")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--volume', type=float, default=1.0, help="Multiplicateur du volume de données")
+    parser.add_argument('--rows', default='', help="Nombre exact d'enregistrements par table (ex: stock_move=1000000,product=5000)")
+    parser.add_argument('--skew', type=float, default=0.0, help="Concentration des références (0 = uniforme, 1 = Zipf)")
+    parser.add_argument('--days', type=int, default=30, help="Profondeur des dates générées, en jours")
+    parser.add_argument('--seed', type=int, default=42, help="Graine aléatoire (mesures reproductibles)")
+    parser.add_argument('--latency-ms', type=float, default=50, help="Latence fixe par requête")
+    parser.add_argument('--latency-per-item-ms', type=float, default=0.05, help="Latence par enregistrement renvoyé")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Proportion de réponses 503")
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help="Proportion de requêtes bloquées --hang-seconds")
+    parser.add_argument('--hang-seconds', type=float, default=120)
+    parser.add_argument('--max-page-size', type=int, default=5000, help="page_size maximum accepté")
+    parser.add_argument('--count-zero', default='', help="Endpoints renvoyant count=0 (ex: stock_move,event_line/product_not_found)")
+    parser.add_argument('--magasins', help="Écrire la configuration des magasins simulés dans ce fichier JSON")
+    args = parser.parse_args()
+    try:
+        rows = parse_rows(args.rows)
+    except ValueError as e:
+        parser.error(f"--rows: {e}")
+
+    options = MockOptions(latency_ms=args.latency_ms, latency_per_item_ms=args.latency_per_item_ms,
+                          error_rate=args.error_rate, timeout_rate=args.timeout_rate,
+                          hang_seconds=args.hang_seconds, max_page_size=args.max_page_size,
+                          count_zero=[name for name in args.count_zero.split(',') if name], seed=args.seed)
+    print(f"⏳ Génération des données ({args.servers} serveurs x {args.shops_per_server} magasins, volume x{args.volume})...")
+    httpds, magasins, stats = start_servers(args.servers, args.shops_per_server, args.port, args.host,
+                                            args.volume, args.days, args.seed, options, rows, args.skew)
+    if args.magasins:
+        with open(args.magasins, 'w', encoding='utf-8') as f:
+            json.dump(magasins, f, ensure_ascii=False, indent=2)
+        print(f"📝 Magasins simulés écrits dans {args.magasins}")
+    for code, shop in magasins.items():
+        print(f"   🏪 {code} {shop['name']}: {shop['url']}")
+    print("✅ Serveurs simulés démarrés (Ctrl+C pour arrêter)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print(f"\n📊 Requêtes reçues: {json.dumps(stats.as_dict(), ensure_ascii=False)}")
+        for httpd in httpds:
+            httpd.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark des extracteurs Prosuma contre le serveur simulé (mock_prosuma_server.py)
+
+Pour chaque API et chaque jeu de données (10k / 100k / 1M enregistrements sur
+l'endpoint principal de l'API), un serveur simulé est démarré puis
+extract_shop est exécuté dans un processus dédié. Sont mesurés:
+débit (lignes/s), requêtes émises, temps jusqu'à la première ligne, durée totale
+et pic de mémoire (RSS).
+
+Les résultats sont écrits dans BENCHMARK/results/ et comparés à une référence
+(BENCHMARK/baseline.json): une dégradation au-delà du seuil (10% par défaut)
+est signalée et le code de sortie vaut 1.
+
+Usage:
+    python3 BENCHMARK/run_benchmark.py 14 --datasets 10k,100k
+    python3 BENCHMARK/run_benchmark.py A --datasets 10k --save-baseline
+    python3 BENCHMARK/run_benchmark.py 13,14 --datasets 1M --env STREAM_EXPORT=False
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import inspect
+import argparse
+import platform
+import tempfile
+import importlib
+import subprocess
+import urllib.request
+from datetime import datetime
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BENCHMARK_DIR)
+sys.path.append(PROJECT_ROOT)
+from run_api_extraction import API_CONFIG, parse_selection
+
+MOCK_SERVER = os.path.join(BENCHMARK_DIR, 'mock_prosuma_server.py')
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, 'results')
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+RESULT_MARKER = 'BENCHMARK_RESULT '
+
+# Jeux de données: nombre d'enregistrements de l'endpoint principal (un magasin)
+DATASETS = {'10k': 10_000, '100k': 100_000, '1M': 1_000_000}
+
+# Endpoint principal de chaque API (table du serveur simulé dont le volume est fixé)
+API_ENDPOINTS = {
+    'API_COMMANDE': 'supplier_order',
+    'API_COMMANDE_DIRECTE': 'supplier_order',
+    'API_COMMANDE_REASSORT': 'supplier_order',
+    'API_BASE_ARTICLE': 'product',
+    'API_ARTICLE_PROMO': 'product',
+    'API_PROMO': 'promotion',
+    'API_PRODUIT_NON_TROUVE': 'product_not_found',
+    'API_COMMANDE_THEME': 'product',
+    'API_RECEPTION': 'delivery',
+    'API_PRE_COMMANDE': 'product',
+    'API_RETOUR_MARCHANDISE': 'product',
+    'API_INVENTAIRE': 'product',
+    'API_STATS_VENTE': 'product_line',
+    'API_MOUVEMENT_STOCK': 'stock_move',
+}
+
+# Chemins d'URL du serveur simulé (clés des compteurs /__stats__)
+MOCK_PATHS = {'product_not_found': 'event_line/product_not_found'}
+
+# Environnement des extracteurs pendant une mesure: aucun état persistant
+# (caches, points de reprise, repères incrémentaux, apprentissage) ne doit
+# rendre une exécution plus rapide que la précédente
+BENCHMARK_ENV = {
+    'PROSUMA_USER': 'benchmark',
+    'PROSUMA_PASSWORD': 'benchmark',
+    'DATE_START': '',
+    'DATE_END': '',
+    'STATUT_COMMANDE': '',
+    'CHECKPOINT_ENABLED': 'False',
+    'INCREMENTAL_MODE': 'False',
+    'SHOP_CACHE_TTL_HOURS': '0',
+    'SUPPLIER_CACHE_TTL_HOURS': '0',
+    'LOOKUP_CACHE_TTL_HOURS': '0',
+    'SNAPSHOT_TTL_MINUTES': '0',
+    'ADAPTIVE_PAGE_SIZE': 'False',
+    'ADAPTIVE_TIMEOUT': 'False',
+}
+
+# Métriques comparées à la référence: True = plus grand est meilleur
+COMPARED_METRICS = {
+    'wall_seconds': False,
+    'rows_per_sec': True,
+    'requests': False,
+    'peak_rss_mb': False,
+}
+
+def peak_rss_mb():
+    """Pic de mémoire résidente du processus courant, en Mo (None si indisponible, ex: Windows)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss est en octets sur macOS, en kilo-octets sur Linux
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def run_case(number):
+    """Processus fils: exécute extract_shop de l'API pour les magasins de MAGASINS_FILE"""
+    from utils import load_shop_config, run_shops_parallel, get_run_manifests, set_current_api
+
+    name, folder, module_name, class_name, _ = API_CONFIG[number]
+    sys.path.append(os.path.join(PROJECT_ROOT, folder))
+    module = importlib.import_module(module_name)
+    extractor = getattr(module, class_name)()
+    shop_config = load_shop_config(PROJECT_ROOT)
+    if hasattr(extractor, 'os_type'):
+        # Commandes directes / réassort imposent /mnt/share sous Linux: exports vers le dossier temporaire
+        extractor.network_folder_base = os.environ['DOWNLOAD_FOLDER_BASE']
+
+    # ARTICLE_PROMO reçoit aussi la configuration du magasin
+    if len(inspect.signature(extractor.extract_shop).parameters) > 1:
+        process_shop = lambda shop_code: extractor.extract_shop(shop_code, shop_config[shop_code])
+    else:
+        process_shop = extractor.extract_shop
+
+    # Manifestes rangés sous le nom de l'API, comme avec l'orchestrateur
+    set_current_api(name)
+    started_at = time.time()
+    started = time.perf_counter()
+    futures = run_shops_parallel(list(shop_config), shop_config, process_shop)
+    success = True
+    for future in futures.values():
+        try:
+            success = bool(future.result()) and success
+        except Exception:
+            success = False
+    result = {
+        'success': success,
+        'started_at': started_at,
+        'wall_seconds': round(time.perf_counter() - started, 3),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    # Durées par étape du manifeste de l'exécution (RUN_MANIFEST)
+    summary = get_run_manifests().summaries.get(name)
+    if summary:
+        result['stages'] = {name: stats['seconds'] for name, stats in summary['stages'].items()}
+        result['stages']['other'] = summary['other_seconds']
+    print(RESULT_MARKER + json.dumps(result), flush=True)
+    return 0 if success else 1
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def mock_request(port, path):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=10) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+def start_mock(endpoint, rows, args, workdir):
+    """Démarre un serveur simulé (un serveur, un magasin) avec `rows` enregistrements sur l'endpoint.
+
+    Retourne (processus, port, chemin du fichier magasins).
+    """
+    port = free_port()
+    magasins_file = os.path.join(workdir, f'magasins_{endpoint}_{rows}.json')
+    command = [
+        sys.executable, MOCK_SERVER, '--servers', '1', '--shops-per-server', '1', '--port', str(port),
+        '--days', '1', '--volume', str(args.background_volume), '--rows', f'{endpoint}={rows}',
+        '--latency-ms', str(args.latency_ms), '--latency-per-item-ms', str(args.latency_per_item_ms),
+        '--skew', str(args.skew), '--seed', str(args.seed), '--magasins', magasins_file,
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + args.mock_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Le serveur simulé s'est arrêté (code {process.returncode})")
+        try:
+            mock_request(port, '/__stats__')
+            with open(magasins_file, encoding='utf-8') as f:
+                json.load(f)
+            return process, port, magasins_file
+        except (OSError, ValueError):
+            time.sleep(0.5)
+    process.kill()
+    raise RuntimeError(f"Serveur simulé non prêt après {args.mock_timeout}s")
+
+def measure(number, dataset, endpoint, port, magasins_file, args, workdir):
+    """Exécute un cas (API x jeu de données) dans un processus fils et retourne ses métriques"""
+    name, folder = API_CONFIG[number][:2]
+    env = dict(os.environ)
+    env.update(BENCHMARK_ENV)
+    env.update({
+        'MAGASINS_FILE': magasins_file,
+        'DOWNLOAD_FOLDER_BASE': os.path.join(workdir, 'export'),
+        'RUN_MANIFEST_DIR': os.path.join(workdir, 'manifests'),
+        'PYTHONIOENCODING': 'utf-8',
+    })
+    env.update(args.env)
+    if folder == 'API_BASE_ARTICLE':
+        env.pop('DATE_START', None)
+        env.pop('DATE_END', None)
+
+    mock_request(port, '/__stats__?reset=1')
+    case = {'api': name, 'number': number, 'dataset': dataset, 'dataset_rows': DATASETS[dataset], 'endpoint': endpoint}
+    try:
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--case', str(number)],
+            cwd=workdir, env=env, capture_output=True, text=True, encoding='utf-8', errors='replace',
+            timeout=args.case_timeout,
+        )
+    except subprocess.TimeoutExpired:
+        case.update({'success': False, 'error': f"timeout après {args.case_timeout}s"})
+        return case
+
+    lines = [line for line in completed.stdout.splitlines() if line.startswith(RESULT_MARKER)]
+    if not lines:
+        tail = (completed.stderr or completed.stdout).strip().splitlines()[-5:]
+        case.update({'success': False, 'error': ' | '.join(tail) or f"code de sortie {completed.returncode}"})
+        return case
+    result = json.loads(lines[-1][len(RESULT_MARKER):])
+    stats = mock_request(port, '/__stats__')
+
+    rows = stats['rows'].get(MOCK_PATHS.get(endpoint, endpoint), 0)
+    first_row_at = stats.get('first_row_at')
+    case.update({
+        'success': result['success'],
+        'wall_seconds': result['wall_seconds'],
+        'rows': rows,
+        'rows_per_sec': round(rows / result['wall_seconds'], 1) if result['wall_seconds'] else None,
+        'requests': stats['total_requests'],
+        'errors': sum(stats['errors'].values()),
+        'bytes': stats['bytes'],
+        'time_to_first_row': round(first_row_at - result['started_at'], 3) if first_row_at else None,
+        'peak_rss_mb': result['peak_rss_mb'],
+        'stages': result.get('stages'),
+    })
+    return case
+
+def case_key(case):
+    return f"{case['api']}|{case['dataset']}"
+
+def compare(results, baseline, threshold):
+    """Liste des dégradations par rapport à la référence, au-delà du seuil"""
+    regressions = []
+    for case in results:
+        reference = baseline.get(case_key(case))
+        if not reference or not case.get('success'):
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            current, previous = case.get(metric), reference.get(metric)
+            if current is None or not previous:
+                continue
+            change = (current - previous) / previous
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append({'case': case_key(case), 'metric': metric,
+                                    'baseline': previous, 'current': current, 'change': round(change, 3)})
+    return regressions
+
+def print_results(results, baseline):
+    print("=" * 110)
+    print(f"{'API':<28}{'Jeu':>6}{'Lignes':>10}{'Lignes/s':>12}{'Requêtes':>10}{'1re ligne':>11}{'Durée':>10}{'RSS Mo':>9}  Réf.")
+    print("-" * 110)
+    for case in results:
+        if not case.get('success'):
+            print(f"❌ {case['api']:<25}{case['dataset']:>6}  échec: {case.get('error', 'extraction en échec')}")
+            continue
+        reference = baseline.get(case_key(case))
+        delta = ''
+        if reference and reference.get('wall_seconds'):
+            delta = f"{(case['wall_seconds'] - reference['wall_seconds']) / reference['wall_seconds']:+.0%}"
+        first_row = f"{case['time_to_first_row']:.2f}s" if case['time_to_first_row'] is not None else '-'
+        rss = f"{case['peak_rss_mb']:.0f}" if case['peak_rss_mb'] is not None else '-'
+        print(f"{case['api']:<28}{case['dataset']:>6}{case['rows']:>10,}{case['rows_per_sec'] or 0:>12,.0f}"
+              f"{case['requests']:>10,}{first_row:>11}{case['wall_seconds']:>9.2f}s{rss:>9}  {delta}")
+    print("=" * 110)
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f).get('results', {})
+
+def parse_env(values):
+    env = {}
+    for value in values:
+        if '=' not in value:
+            raise argparse.ArgumentTypeError(f"--env attend NOM=VALEUR: {value}")
+        name, _, setting = value.partition('=')
+        env[name] = setting
+    return env
+
+def main():
+    """Fonction principale"""
+    parser = argparse.ArgumentParser(description="Benchmark des extracteurs Prosuma contre le serveur simulé")
+    parser.add_argument('selection', nargs='?', default='A', help="Numéros des APIs (ex: 1,3,14 ou 4-9) ou A pour toutes")
+    parser.add_argument('--datasets', default='10k,100k', help=f"Jeux de données parmi {','.join(DATASETS)}")
+    parser.add_argument('--latency-ms', type=float, default=20, help="Latence fixe du serveur simulé par requête")
+    parser.add_argument('--latency-per-item-ms', type=float, default=0.01, help="Latence par enregistrement renvoyé")
+    parser.add_argument('--background-volume', type=float, default=0.01,
+                        help="Volume des autres tables (fournisseurs, produits référencés...)")
+    parser.add_argument('--skew', type=float, default=0.0,
+                        help="Concentration des références fournisseurs/produits/tickets (0 = uniforme)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--env', action='append', default=[], metavar='NOM=VALEUR',
+                        help="Variable d'environnement des extracteurs (ex: PAGE_WORKERS=8), répétable")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="Fichier de référence")
+    parser.add_argument('--save-baseline', action='store_true', help="Enregistrer ces résultats comme référence")
+    parser.add_argument('--threshold', type=float, default=0.10, help="Seuil de dégradation toléré (0.10 = 10%%)")
+    parser.add_argument('--output', help="Fichier de résultats (défaut: BENCHMARK/results/benchmark_<date>.json)")
+    parser.add_argument('--case-timeout', type=int, default=3600, help="Durée maximale d'un cas, en secondes")
+    parser.add_argument('--mock-timeout', type=int, default=600, help="Durée maximale de génération des données")
+    parser.add_argument('--case', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        return run_case(args.case)
+
+    try:
+        numbers = parse_selection(args.selection)
+        args.env = parse_env(args.env)
+    except (ValueError, argparse.ArgumentTypeError) as e:
+        parser.error(str(e))
+    datasets = [name for name in args.datasets.split(',') if name]
+    unknown = [name for name in datasets if name not in DATASETS]
+    if unknown:
+        parser.error(f"Jeu(x) de données inconnu(s): {unknown}. Choisir parmi {list(DATASETS)}")
+
+    baseline = load_baseline(args.baseline)
+    results = []
+    with tempfile.TemporaryDirectory(prefix='prosuma_benchmark_') as workdir:
+        for dataset in datasets:
+            # Un serveur simulé par endpoint: les APIs qui partagent l'endpoint le réutilisent
+            groups = {}
+            for number in numbers:
+                groups.setdefault(API_ENDPOINTS[API_CONFIG[number][1]], []).append(number)
+            for endpoint, group in groups.items():
+                print(f"⏳ Jeu {dataset}: génération de {DATASETS[dataset]:,} enregistrements {endpoint}...", flush=True)
+                try:
+                    process, port, magasins_file = start_mock(endpoint, DATASETS[dataset], args, workdir)
+                except RuntimeError as e:
+                    print(f"❌ {e}")
+                    results.extend({'api': API_CONFIG[n][0], 'number': n, 'dataset': dataset,
+                                    'endpoint': endpoint, 'success': False, 'error': str(e)} for n in group)
+                    continue
+                try:
+                    for number in group:
+                        print(f"🚀 {API_CONFIG[number][0]} ({dataset})...", flush=True)
+                        results.append(measure(number, dataset, endpoint, port, magasins_file, args, workdir))
+                finally:
+                    process.terminate()
+                    process.wait()
+
+    print_results(results, baseline)
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f"⚠️ Dégradation {regression['case']} {regression['metric']}: "
+              f"{regression['baseline']} -> {regression['current']} ({regression['change']:+.0%})")
+    if baseline and not regressions:
+        print(f"✅ Aucune dégradation au-delà de {args.threshold:.0%} par rapport à la référence")
+
+    report = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': {'latency_ms': args.latency_ms, 'latency_per_item_ms': args.latency_per_item_ms,
+                    'background_volume': args.background_volume, 'skew': args.skew, 'seed': args.seed,
+                    'env': args.env},
+        'results': {case_key(case): case for case in results},
+        'regressions': regressions,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"📝 Résultats: {output}")
+
+    if args.save_baseline:
+        # Les cas absents de cette exécution gardent leur référence précédente
+        merged = dict(baseline)
+        merged.update({key: case for key, case in report['results'].items() if case.get('success')})
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({**report, 'results': merged}, f, ensure_ascii=False, indent=2)
+        print(f"📌 Référence enregistrée: {args.baseline}")
+
+    failed = [case for case in results if not case.get('success')]
+    return 1 if regressions or failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Scénarios de vérification des extracteurs contre le serveur simulé (mock_prosuma_server.py)
+
+Chaque scénario démarre son serveur simulé, exécute les extracteurs dans des
+processus dédiés (un processus = une exécution, comme depuis le menu) et
+vérifie un comportement précis. Le code de sortie vaut 1 si un scénario échoue.
+
+Scénarios:
+- commandes_groupees: les commandes groupées (1+2+3) exportent, pour chaque
+  API, les mêmes commandes que COMMANDE, COMMANDE_DIRECTE et
+  COMMANDE_REASSORT lancées séparément
+- reprise: une extraction MOUVEMENT_STOCK interrompue (arrêt brutal du
+  processus), puis relancée avec un autre page_size appris, ne redemande que
+  les pages absentes du point de reprise et exporte chaque mouvement une fois
+
+Usage:
+    python3 BENCHMARK/run_scenarios.py
+    python3 BENCHMARK/run_scenarios.py commandes_groupees reprise
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import importlib
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BENCHMARK_DIR)
+sys.path.append(BENCHMARK_DIR)
+sys.path.append(PROJECT_ROOT)
+from run_benchmark import BENCHMARK_ENV, start_mock, mock_request
+from run_api_extraction import API_CONFIG, COMMANDES_GROUPEES
+
+RESULT_MARKER = 'SCENARIO_RESULT '
+
+# Reprise: pages enregistrées avant l'arrêt brutal, page_size appris entre les deux exécutions
+INTERRUPT_AFTER_PAGES = 3
+RESUME_TUNED_PAGE_SIZE = 500
+INTERRUPTED_EXIT_CODE = 3
+
+def load_extractor(api):
+    """Crée l'extracteur d'une entrée de API_CONFIG (ou COMMANDES_GROUPEES)"""
+    folder, module_name, class_name = api[1:4]
+    sys.path.append(os.path.join(PROJECT_ROOT, folder))
+    return getattr(importlib.import_module(module_name), class_name)()
+
+def capture_exports(extractor, api_name, exported):
+    """Remplace export_to_csv: les identifiants des commandes exportées sont notés dans exported[api_name]"""
+    def export_to_csv(orders, shop_code, shop_name):
+        exported.setdefault(api_name, []).extend(order['id'] for order in orders)
+        return f"{api_name}_{shop_code}.csv"
+    extractor.export_to_csv = export_to_csv
+
+def step_commandes(mode):
+    """Processus fils: commandes exportées par API, en mode 'groupees' ou 'separees'"""
+    from utils import load_shop_config
+
+    exported = {}
+    if mode == 'groupees':
+        grouped = load_extractor(COMMANDES_GROUPEES)
+        for api_name, extractor in zip(grouped.APIS, grouped.extractors):
+            capture_exports(extractor, api_name, exported)
+        runs = [grouped]
+    else:
+        runs = []
+        for number, api_name in zip((1, 2, 3), ('COMMANDE', 'COMMANDE_DIRECTE', 'COMMANDE_REASSORT')):
+            extractor = load_extractor(API_CONFIG[number])
+            capture_exports(extractor, api_name, exported)
+            runs.append(extractor)
+
+    for shop_code in load_shop_config(PROJECT_ROOT):
+        for extractor in runs:
+            extractor.extract_shop(shop_code)
+    return {api_name: sorted(ids) for api_name, ids in exported.items()}
+
+def step_mouvements(mode):
+    """Processus fils: mouvements de stock exportés, en mode 'reference', 'interrompu' ou 'reprise'.
+
+    Points de reprise et page_size appris sont rangés dans le dossier du scénario.
+    En mode 'interrompu', le processus s'arrête brutalement (os._exit) après
+    INTERRUPT_AFTER_PAGES pages enregistrées. En mode 'reprise', le page_size
+    appris pour l'endpoint passe à RESUME_TUNED_PAGE_SIZE avant l'extraction.
+    """
+    import utils
+
+    workdir = os.environ['SCENARIO_WORKDIR']
+    utils.PageCheckpoint.DIRNAME = os.path.join(workdir, 'checkpoints')
+    utils._page_size_tuner = tuner = utils.PageSizeTuner(os.path.join(workdir, utils.PageSizeTuner.FILENAME))
+    shop_config = utils.load_shop_config(PROJECT_ROOT)
+
+    if mode == 'interrompu':
+        save_page = utils.PageCheckpoint.save_page
+        saved = []
+
+        def save_then_stop(checkpoint, page, items):
+            save_page(checkpoint, page, items)
+            saved.append(page)
+            if len(saved) >= INTERRUPT_AFTER_PAGES:
+                os._exit(INTERRUPTED_EXIT_CODE)
+        utils.PageCheckpoint.save_page = save_then_stop
+    elif mode == 'reprise':
+        for shop in shop_config.values():
+            tuner.store.set(tuner._key(f"{shop['url']}/api/stock_move/"),
+                            {'page_size': RESUME_TUNED_PAGE_SIZE, 'cap': None})
+        tuner.store.save()
+
+    extractor = load_extractor(API_CONFIG[14])
+    exported = {}
+    capture_exports(extractor, 'MOUVEMENT_STOCK', exported)
+    futures = utils.run_shops_parallel(list(shop_config), shop_config, extractor.extract_shop)
+    success = all(future.result() for future in futures.values())
+    return {'success': success, 'ids': exported.get('MOUVEMENT_STOCK', [])}
+
+STEPS = {'commandes': step_commandes, 'mouvements': step_mouvements}
+
+def run_step(step, argument, env, expected_exit=0):
+    """Exécute une étape dans un processus fils et retourne son résultat (dict, {} sans résultat
+    attendu), None en cas d'échec ou de code de sortie inattendu"""
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--step', step, argument],
+        cwd=env['SCENARIO_WORKDIR'], env=env, capture_output=True, text=True, encoding='utf-8', errors='replace',
+    )
+    lines = [line for line in completed.stdout.splitlines() if line.startswith(RESULT_MARKER)]
+    if completed.returncode == expected_exit and (lines or expected_exit):
+        return json.loads(lines[-1][len(RESULT_MARKER):]) if lines else {}
+    tail = (completed.stderr or completed.stdout).strip().splitlines()[-5:]
+    print(f"   ❌ Étape {step} {argument} en échec (code {completed.returncode}): {' | '.join(tail)}")
+    return None
+
+def scenario_env(workdir, magasins_file, **settings):
+    """Environnement des extracteurs: celui du benchmark (aucun état persistant) + réglages du scénario"""
+    env = dict(os.environ)
+    env.update(BENCHMARK_ENV)
+    env.update({
+        'MAGASINS_FILE': magasins_file,
+        'DOWNLOAD_FOLDER_BASE': os.path.join(workdir, 'export'),
+        'RUN_MANIFEST': 'False',
+        'PYTHONIOENCODING': 'utf-8',
+        'SCENARIO_WORKDIR': workdir,
+    })
+    env.update(settings)
+    return env
+
+def scenario_commandes_groupees(workdir, args):
+    """Mêmes commandes exportées par API en mode groupé et en lancement séparé"""
+    process, port, magasins_file = start_mock('supplier_order', args.orders, args, workdir)
+    try:
+        env = scenario_env(workdir, magasins_file)
+        separate = run_step('commandes', 'separees', env)
+        grouped = run_step('commandes', 'groupees', env)
+    finally:
+        process.kill()
+    if separate is None or grouped is None:
+        return False
+
+    success = True
+    for api_name in ('COMMANDE', 'COMMANDE_DIRECTE', 'COMMANDE_REASSORT'):
+        expected, actual = set(separate.get(api_name, [])), set(grouped.get(api_name, []))
+        if expected == actual and expected:
+            print(f"   ✅ {api_name}: {len(actual):,} commande(s) identiques")
+        else:
+            success = False
+            print(f"   ❌ {api_name}: {len(expected):,} en lancement séparé, {len(actual):,} en mode groupé "
+                  f"({len(expected - actual)} manquante(s), {len(actual - expected)} en trop)")
+    return success
+
+def checkpoint_state(workdir):
+    """(pages, enregistrements, page_size) des points de reprise du dossier du scénario"""
+    directory = os.path.join(workdir, 'checkpoints')
+    pages = rows = 0
+    page_sizes = set()
+    for filename in os.listdir(directory) if os.path.isdir(directory) else []:
+        path = os.path.join(directory, filename)
+        if filename.endswith('.jsonl'):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    pages += 1
+                    rows += len(json.loads(line)['items'])
+        elif filename.endswith('.json'):
+            with open(path, encoding='utf-8') as f:
+                page_sizes.add(json.load(f).get('page_size'))
+    return pages, rows, page_sizes
+
+def scenario_reprise(workdir, args):
+    """Extraction interrompue puis reprise avec un autre page_size appris: seules les pages manquantes sont demandées"""
+    process, port, magasins_file = start_mock('stock_move', args.moves, args, workdir)
+    try:
+        reference = run_step('mouvements', 'reference', scenario_env(workdir, magasins_file))
+        env = scenario_env(workdir, magasins_file, CHECKPOINT_ENABLED='True', ADAPTIVE_PAGE_SIZE='True')
+        interrupted = run_step('mouvements', 'interrompu', env, expected_exit=INTERRUPTED_EXIT_CODE)
+        pages, saved_rows, page_sizes = checkpoint_state(workdir)
+        mock_request(port, '/__stats__?reset=1')
+        resumed = run_step('mouvements', 'reprise', env)
+        served = mock_request(port, '/__stats__')['rows'].get('stock_move', 0)
+    finally:
+        process.kill()
+    if reference is None or interrupted is None or resumed is None:
+        return False
+
+    expected = set(reference['ids'])
+    print(f"   ℹ️ Référence: {len(expected):,} mouvements. Arrêt brutal: {pages} page(s), "
+          f"{saved_rows:,} mouvements dans le point de reprise (page_size {', '.join(map(str, page_sizes))})")
+    checks = [
+        ("extraction reprise réussie", resumed['success']),
+        ("point de reprise enregistré avant l'arrêt", pages > 0 and saved_rows < len(expected)),
+        ("mêmes mouvements que la référence", set(resumed['ids']) == expected),
+        ("aucun mouvement exporté en double", len(resumed['ids']) == len(set(resumed['ids']))),
+        (f"seules les pages manquantes redemandées ({served:,} mouvements reçus, "
+         f"{len(expected) - saved_rows:,} attendus)", served == len(expected) - saved_rows),
+        ("point de reprise supprimé après succès", checkpoint_state(workdir)[0] == 0),
+    ]
+    for label, passed in checks:
+        print(f"   {'✅' if passed else '❌'} {label}")
+    return all(passed for _, passed in checks)
+
+SCENARIOS = {'commandes_groupees': scenario_commandes_groupees, 'reprise': scenario_reprise}
+
+def main():
+    """Fonction principale"""
+    parser = argparse.ArgumentParser(description="Scénarios de vérification contre le serveur simulé")
+    parser.add_argument('scenarios', nargs='*', help=f"Scénarios parmi {', '.join(SCENARIOS)} (défaut: tous)")
+    parser.add_argument('--orders', type=int, default=3000, help="Commandes fournisseurs du magasin simulé")
+    parser.add_argument('--moves', type=int, default=10000, help="Mouvements de stock du magasin simulé (reprise)")
+    parser.add_argument('--latency-ms', type=float, default=1, help="Latence fixe du serveur simulé par requête")
+    parser.add_argument('--latency-per-item-ms', type=float, default=0.0, help="Latence par enregistrement renvoyé")
+    parser.add_argument('--background-volume', type=float, default=0.01,
+                        help="Volume des autres tables (fournisseurs, produits référencés...)")
+    parser.add_argument('--skew', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--mock-timeout', type=int, default=600, help="Durée maximale de génération des données")
+    parser.add_argument('--step', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.step:
+        step, argument = args.step
+        print(RESULT_MARKER + json.dumps(STEPS[step](argument)), flush=True)
+        return 0
+
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Scénario(s) inconnu(s): {unknown}. Choisir parmi {list(SCENARIOS)}")
+
+    names = args.scenarios or list(SCENARIOS)
+    failed = []
+    for name in names:
+        print(f"🧪 {name}: {SCENARIOS[name].__doc__}", flush=True)
+        with tempfile.TemporaryDirectory(prefix='prosuma_scenario_') as workdir:
+            if not SCENARIOS[name](workdir, args):
+                failed.append(name)
+    print("=" * 60)
+    print(f"{'❌' if failed else '✅'} {len(names) - len(failed)}/{len(names)} scénario(s) réussi(s)"
+          f"{', en échec: ' + ', '.join(failed) if failed else ''}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
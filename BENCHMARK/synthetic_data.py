@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Générateur de données synthétiques au format des endpoints Prosuma RPOS
+
+Produit, à l'échelle voulue, les enregistrements de tous les endpoints lus par
+les extracteurs: commandes fournisseurs (fournisseur imbriqué), réceptions
+(commande imbriquée), mouvements de stock (codes de STOCK_MOVE_TYPES), lignes
+de vente (références ticket / produit), produits, fournisseurs, promotions,
+tickets et produits non trouvés.
+
+Les cardinalités (fournisseurs, produits, tickets, commandes distincts) sont
+réglables indépendamment du volume, ainsi que la concentration des références
+(--skew): de quoi mesurer le taux de succès des caches et le nombre d'appels
+d'enrichissement. Le serveur simulé (mock_prosuma_server.py) sert ces données.
+
+Usage:
+    python3 BENCHMARK/synthetic_data.py --out /tmp/jeu --rows product_line=1000000 --products 2000 --receipts 50000
+    python3 BENCHMARK/synthetic_data.py --out /tmp/jeu --volume 0.1 --suppliers 20 --skew 1.2
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+from bisect import bisect_left
+from itertools import accumulate
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'API_MOUVEMENT_STOCK'))
+from api_mouvement_stock import STOCK_MOVE_TYPES
+
+# Volume de base par magasin (x volume); produits et fournisseurs sont par serveur
+BASE_VOLUME = {
+    'supplier_order': 2000,
+    'delivery': 1000,
+    'stock_move': 20000,
+    'receipt': 5000,
+    'product_line': 30000,
+    'promotion': 200,
+    'product_not_found': 500,
+    'product': 5000,
+    'supplier': 300,
+}
+
+# Tables partagées par tous les magasins d'un serveur
+SERVER_TABLES = ('product', 'supplier')
+
+SHOP_NAMES = ['HYPER', 'CASH CENTER', 'MANDARINE', 'CASINO', 'SUPER U', 'PROXI', 'LEADER PRICE', 'SOCOCE']
+ORDER_STATUSES = [
+    ('draft', 'Brouillon'), ('validated', 'Validée'),
+    ('awaiting_delivery', 'En attente de livraison'), ('delivered', 'Livrée'), ('cancelled', 'Annulée'),
+]
+CITIES = ['ABIDJAN', 'BOUAKE', 'SAN PEDRO', 'YAMOUSSOUKRO', 'KORHOGO', 'DALOA']
+CATEGORIES = ['EPICERIE', 'BOISSONS', 'DPH', 'FRAIS', 'SURGELES', 'LIQUIDES', 'BAZAR']
+
+def build_shops(server_index, shops_per_server, first_id=1):
+    """Magasins d'un serveur posN: codes à 3 chiffres comme dans magasins.json"""
+    shops = []
+    for i in range(shops_per_server):
+        number = server_index * shops_per_server + i
+        code = f"{(number + 1) * 10:03d}"
+        shops.append({
+            'id': first_id + number, 'reference': code, 'code': code,
+            'name': f"{SHOP_NAMES[number % len(SHOP_NAMES)]} {number + 1}",
+            'email': f"magasin{code}@prosuma.ci", 'url': '', 'is_warehouse': False,
+            'gps': f"5.{3000 + number},-4.{100 + number}",
+        })
+    return shops
+
+def parse_rows(value):
+    """'stock_move=1000000,product=5000' -> {'stock_move': 1000000, 'product': 5000}"""
+    try:
+        rows = {name: int(count) for name, count in (part.split('=') for part in value.split(',') if part)}
+    except ValueError:
+        raise ValueError("attendu: table=nombre[,table=nombre...]")
+    unknown = set(rows) - set(BASE_VOLUME)
+    if unknown:
+        raise ValueError(f"table(s) inconnue(s): {sorted(unknown)}. Choisir parmi {sorted(BASE_VOLUME)}")
+    return rows
+
+class SyntheticData:
+    """Enregistrements synthétiques d'un serveur posN (déterministes pour une graine donnée).
+
+    rows fixe le nombre exact d'enregistrements d'une table (par magasin, ou
+    par serveur pour product et supplier), les autres suivent BASE_VOLUME x
+    volume. Les cardinalités se règlent ainsi: rows={'product': 200} limite
+    les lignes de vente à 200 produits distincts. skew > 0 concentre les
+    références sur les premiers éléments (loi de Zipf d'exposant skew).
+    """
+
+    def __init__(self, base_url='http://127.0.0.1:8800', shops=None, volume=1.0, rows=None,
+                 days=30, skew=0.0, seed=42):
+        self.base_url = base_url
+        self.shops = shops if shops is not None else build_shops(0, 1)
+        self.rows = rows or {}
+        self.days = days
+        self.skew = skew
+        self.rng = random.Random(seed)
+        self.now = datetime.now().replace(microsecond=0)
+        self.tables = {}
+        self._next_id = 1
+        self._build(volume)
+        self.by_id = {name: {row['id']: row for row in table} for name, table in self.tables.items()}
+
+    def _id(self):
+        value = self._next_id
+        self._next_id += 1
+        return value
+
+    def _date(self):
+        return (self.now - timedelta(seconds=self.rng.randint(0, self.days * 86400))).strftime('%Y-%m-%dT%H:%M:%S')
+
+    def _ean(self):
+        return f"{self.rng.randint(10**12, 10**13 - 1)}"
+
+    def _count(self, name, volume):
+        if name in self.rows:
+            return max(1, int(self.rows[name]))
+        return max(1, int(BASE_VOLUME[name] * volume))
+
+    def _picker(self, population):
+        """Tirage d'un élément: uniforme, ou selon une loi de Zipf si skew > 0"""
+        rng = self.rng
+        if self.skew <= 0:
+            return lambda: population[rng.randrange(len(population))]
+        cumulative = list(accumulate(1 / rank ** self.skew for rank in range(1, len(population) + 1)))
+        total = cumulative[-1]
+        return lambda: population[bisect_left(cumulative, rng.random() * total)]
+
+    def _build(self, volume):
+        rng = self.rng
+        suppliers = [self._supplier() for _ in range(self._count('supplier', volume))]
+        pick_supplier = self._picker(suppliers)
+        products = [self._product(pick_supplier()) for _ in range(self._count('product', volume))]
+        pick_product = self._picker(products)
+        self.tables = {'shop': list(self.shops), 'supplier': suppliers, 'product': products}
+        for name in BASE_VOLUME:
+            self.tables.setdefault(name, [])
+
+        for shop in self.shops:
+            shop_ref = {key: shop[key] for key in ('id', 'reference', 'name', 'email', 'url', 'is_warehouse', 'gps')}
+
+            orders = [self._supplier_order(shop_ref, pick_supplier()) for _ in range(self._count('supplier_order', volume))]
+            self.tables['supplier_order'].extend(orders)
+            pick_order = self._picker(orders)
+            self.tables['delivery'].extend(self._delivery(shop_ref, pick_order())
+                                           for _ in range(self._count('delivery', volume)))
+
+            move_types = sorted(STOCK_MOVE_TYPES)
+            for _ in range(self._count('stock_move', volume)):
+                self.tables['stock_move'].append({
+                    'id': self._id(), 'shop': shop['id'], 'date': self._date(), 'product': pick_product()['id'],
+                    'stock_move_type': rng.choice(move_types), 'quantity': rng.randint(-50, 200),
+                })
+
+            receipts = []
+            for _ in range(self._count('receipt', volume)):
+                receipt_id = self._id()
+                date = self._date()
+                receipts.append({
+                    'id': receipt_id, 'number': f"T{receipt_id:08d}", 'nb': receipt_id, 'shop': shop['id'],
+                    'date': date, 'created_at': date, 'total_incl_tax': round(rng.uniform(500, 200000), 0),
+                })
+            self.tables['receipt'].extend(receipts)
+            pick_receipt = self._picker(receipts)
+            self.tables['product_line'].extend(self._product_line(shop, pick_receipt(), pick_product())
+                                               for _ in range(self._count('product_line', volume)))
+
+            for _ in range(self._count('promotion', volume)):
+                promotion_id = self._id()
+                self.tables['promotion'].append({
+                    'id': promotion_id, 'reference': f"P{promotion_id:06d}", 'name': f"PROMOTION {promotion_id}",
+                    'description': '', 'shop': shop['id'], 'start_date': self._date(), 'end_date': self._date(),
+                    'discount_type': rng.choice(['percent', 'amount']), 'discount_value': rng.randint(5, 50),
+                    'is_active': rng.random() < 0.6, 'date': self._date(),
+                    'created_at': self._date(), 'updated_at': self._date(),
+                })
+
+            for _ in range(self._count('product_not_found', volume)):
+                date = self._date()
+                self.tables['product_not_found'].append({
+                    'id': self._id(), 'shop': shop['id'], 'date': date, 'event_type': 'product_not_found',
+                    'description': 'Code barre inconnu', 'input_ean': self._ean(), 'ean': '',
+                    'motive_text': 'Produit non trouvé', 'seller': f"CAISSE {rng.randint(1, 20)}", 'nb': 1,
+                    'created_at': date, 'updated_at': date, 'is_deleted': False,
+                })
+
+        # Ordre par défaut des endpoints: du plus récent au plus ancien (comme Prosuma)
+        for table in self.tables.values():
+            table.sort(key=lambda row: row['id'], reverse=True)
+
+    def _supplier(self):
+        rng = self.rng
+        supplier_id = self._id()
+        return {
+            'id': supplier_id, 'reference': f"F{supplier_id:05d}", 'code': f"F{supplier_id:05d}",
+            'name': f"FOURNISSEUR {supplier_id}", 'company_name': f"SOCIETE {supplier_id}",
+            'is_central': rng.random() < 0.4, 'city': rng.choice(CITIES), 'country': 'CI',
+            'email': f"contact{supplier_id}@fournisseur.ci", 'code_com': f"C{supplier_id}",
+        }
+
+    def _product(self, supplier):
+        rng = self.rng
+        product_id = self._id()
+        price = round(rng.uniform(100, 50000), 0)
+        promo = rng.random() < 0.15
+        updated_at = self._date()
+        return {
+            'id': product_id, 'reference': f"A{product_id:06d}", 'name': f"ARTICLE {product_id}",
+            'barcode': self._ean(), 'ean_codes': [self._ean()],
+            'price': price, 'promo_price': round(price * 0.8, 0) if promo else None,
+            'promo_start_date': self._date() if promo else None, 'promo_end_date': self._date() if promo else None,
+            'supplier': {'id': supplier['id'], 'name': supplier['name']},
+            'category': rng.choice(CATEGORIES), 'brand': f"MARQUE {rng.randint(1, 200)}",
+            'unit': rng.choice(['U', 'KG', 'L']), 'stock_quantity': rng.randint(0, 500),
+            'is_active': rng.random() < 0.95, 'description': '', 'weight': round(rng.uniform(0.1, 5), 2),
+            'created_at': self._date(), 'updated_at': updated_at, 'date': updated_at,
+        }
+
+    def _supplier_order(self, shop_ref, supplier):
+        rng = self.rng
+        order_id = self._id()
+        status, status_display = rng.choice(ORDER_STATUSES)
+        return {
+            'id': order_id, 'reference': f"CF{order_id:07d}", 'external_reference': f"EXT{order_id}",
+            'code_com': supplier['code_com'], 'shop': shop_ref,
+            'supplier': {key: supplier[key] for key in ('id', 'name', 'reference', 'code', 'email', 'is_central')},
+            'date': self._date(), 'delivery_date': self._date(), 'validation_date': self._date(),
+            'status': status, 'status_display': status_display,
+            'is_external': rng.random() < 0.7, 'is_direct': rng.random() < 0.3,
+            'is_deleted': rng.random() < 0.02, 'is_awaiting_delivery': status == 'awaiting_delivery',
+            'total_amount': round(rng.uniform(10000, 5000000), 0), 'notes': '',
+            'created_at': self._date(), 'updated_at': self._date(),
+            # Statut central au moment de la commande: diffère parfois de celui du fournisseur
+            'is_central': supplier['is_central'] if rng.random() < 0.9 else not supplier['is_central'],
+        }
+
+    def _delivery(self, shop_ref, order):
+        rng = self.rng
+        delivery_id = self._id()
+        return {
+            'id': delivery_id, 'delivery_number': f"BL{delivery_id:07d}", 'number': delivery_id,
+            'shop': shop_ref,
+            'order': {
+                'id': order['id'], 'url': f"{self.base_url}/api/supplier_order/{order['id']}/",
+                'reference': order['reference'], 'external_reference': order['external_reference'],
+                'status': order['status'], 'status_display': order['status_display'],
+                'supplier': dict(order['supplier']), 'is_direct': order['is_direct'],
+            },
+            'supplier': dict(order['supplier']), 'is_central': order['supplier']['is_central'],
+            'date': self._date(), 'delivery_date': self._date(), 'status': 'validated',
+            'status_display': 'Validée', 'validated': True, 'total_quantity': rng.randint(1, 500),
+            'total_buying_price_excl_tax': round(rng.uniform(1000, 2000000), 0),
+            'total_buying_price_incl_tax': round(rng.uniform(1000, 2400000), 0),
+            'created_at': self._date(),
+        }
+
+    def _product_line(self, shop, receipt, product):
+        rng = self.rng
+        quantity = rng.randint(1, 10)
+        total = product['price'] * quantity
+        return {
+            'id': self._id(), 'shop': shop['id'], 'date': receipt['date'],
+            'receipt': receipt['id'], 'product': product['id'], 'quantity': quantity,
+            'selling_price': product['price'], 'original_price': product['price'],
+            'buying_price': round(product['price'] * 0.7, 0), 'discount': 0, 'vat_rate': 18,
+            'total_incl_tax': total, 'total_excl_tax': round(total / 1.18, 0),
+            'total_vat': round(total - total / 1.18, 0), 'points': 0,
+            'ean': product['barcode'], 'input_ean': product['barcode'], 'label_1': product['name'],
+            'motive_text': '', 'manual_weight': False, 'scanned': True, 'returned_quantity': 0,
+            'serial_number': '', 'seller': f"CAISSE {rng.randint(1, 20)}", 'department': product['category'],
+        }
+
+    def cardinalities(self):
+        """Nombre d'éléments distincts référencés, par relation"""
+        return {
+            'supplier_order.supplier': len({row['supplier']['id'] for row in self.tables['supplier_order']}),
+            'delivery.order': len({row['order']['id'] for row in self.tables['delivery']}),
+            'stock_move.product': len({row['product'] for row in self.tables['stock_move']}),
+            'product_line.receipt': len({row['receipt'] for row in self.tables['product_line']}),
+            'product_line.product': len({row['product'] for row in self.tables['product_line']}),
+        }
+
+def main():
+    """Fonction principale"""
+    parser = argparse.ArgumentParser(description="Génère des enregistrements synthétiques au format Prosuma RPOS")
+    parser.add_argument('--out', required=True, help="Dossier de sortie (un fichier <endpoint>.jsonl par endpoint)")
+    parser.add_argument('--shops', type=int, default=1, help="Nombre de magasins")
+    parser.add_argument('--volume', type=float, default=1.0, help="Multiplicateur du volume de base")
+    parser.add_argument('--rows', default='', help="Nombre exact par table (ex: stock_move=1000000,product_line=500000)")
+    parser.add_argument('--suppliers', type=int, help="Fournisseurs distincts")
+    parser.add_argument('--products', type=int, help="Produits distincts")
+    parser.add_argument('--receipts', type=int, help="Tickets distincts par magasin")
+    parser.add_argument('--orders', type=int, help="Commandes fournisseurs distinctes par magasin")
+    parser.add_argument('--skew', type=float, default=0.0, help="Concentration des références (0 = uniforme, 1 = Zipf)")
+    parser.add_argument('--days', type=int, default=30, help="Profondeur des dates générées, en jours")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    try:
+        rows = parse_rows(args.rows)
+    except ValueError as e:
+        parser.error(f"--rows: {e}")
+    for name, value in (('supplier', args.suppliers), ('product', args.products),
+                        ('receipt', args.receipts), ('supplier_order', args.orders)):
+        if value:
+            rows[name] = value
+
+    print(f"⏳ Génération ({args.shops} magasin(s), volume x{args.volume})...")
+    data = SyntheticData(shops=build_shops(0, args.shops), volume=args.volume, rows=rows,
+                         days=args.days, skew=args.skew, seed=args.seed)
+    os.makedirs(args.out, exist_ok=True)
+    for name, table in data.tables.items():
+        path = os.path.join(args.out, f"{name}.jsonl")
+        with open(path, 'w', encoding='utf-8') as f:
+            for row in table:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+        print(f"   📝 {name}: {len(table):,} enregistrements -> {path}")
+    print("📊 Cardinalités des références:")
+    for relation, count in data.cardinalities().items():
+        print(f"   {relation}: {count:,} distincts")
+
+if __name__ == "__main__":
+    main()
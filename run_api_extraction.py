@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Orchestrateur des extractions API Prosuma RPOS
+Lance une ou plusieurs APIs dans un seul processus, en parallèle, à la place du
+menu run_api_extraction.sh qui démarre un processus Python par API, l'un après
+l'autre.
+
+Les extracteurs partagent la session HTTP, les caches (magasins, fournisseurs,
+produits) et un fichier de log unique où chaque ligne indique l'API et le
+magasin concernés.
+La durée totale approche celle de l'API la plus longue au lieu de leur somme.
+
+Usage:
+    python3 run_api_extraction.py A
+    python3 run_api_extraction.py 1,3,5
+    python3 run_api_extraction.py 4-9 --debut 2025-01-01 --fin 2025-01-31
+    python3 run_api_extraction.py 1-3 --statut "en attente de livraison"
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import importlib
+from contextlib import contextmanager
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import urllib3
+from dotenv import load_dotenv
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(PROJECT_ROOT)
+from utils import SafeStreamHandler, ApiContextFilter, ShopContextFilter, create_network_folder, set_log_file_permissions, set_current_api, get_env_int, get_http_session, log_http_pool_stats, log_run_manifest
+
+# Désactiver les warnings SSL
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+logger = logging.getLogger(__name__)
+
+# Même numérotation que API_CONFIG dans run_api_extraction.sh
+# numéro: (nom, dossier, module, classe, filtre de statut)
+API_CONFIG = {
+    1: ("COMMANDES", "API_COMMANDE", "api_commande", "ProsumaAPICommandeExtractor", True),
+    2: ("COMMANDES DIRECTES", "API_COMMANDE_DIRECTE", "api_commande_directe", "ProsumaAPICommandeDirecteExtractor", True),
+    3: ("COMMANDES RÉASSORT", "API_COMMANDE_REASSORT", "api_commande_reassort", "ProsumaAPICommandeReassortExtractor", True),
+    4: ("BASE ARTICLES", "API_BASE_ARTICLE", "api_article", "ProsumaAPIBaseArticleExtractor", False),
+    5: ("ARTICLES AVEC PRIX PROMO", "API_ARTICLE_PROMO", "api_article_promo", "ProsumaAPIArticlePromoExtractor", False),
+    6: ("PROMOTIONS", "API_PROMO", "api_promo", "ProsumaAPIPromoExtractor", False),
+    7: ("PRODUITS NON TROUVÉS", "API_PRODUIT_NON_TROUVE", "api_produit_non_trouve", "ProsumaAPIProduitNonTrouveExtractor", False),
+    8: ("COMMANDES THÈME", "API_COMMANDE_THEME", "api_commande_theme", "ProsumaAPICommandeThemeExtractor", False),
+    9: ("RÉCEPTION", "API_RECEPTION", "api_reception", "ProsumaAPIReceptionExtractor", False),
+    10: ("PRÉ-COMMANDES", "API_PRE_COMMANDE", "api_pre_commande", "ProsumaAPIPrecommandeExtractor", False),
+    11: ("RETOURS MARCHANDISES", "API_RETOUR_MARCHANDISE", "api_retour_marchandise", "ProsumaAPIRetourmarchandiseExtractor", False),
+    12: ("INVENTAIRES", "API_INVENTAIRE", "api_inventaire", "ProsumaAPIInventaireExtractor", False),
+    13: ("STATISTIQUES VENTES", "API_STATS_VENTE", "api_stats_vente", "ProsumaAPIStatsventeExtractor", False),
+    14: ("MOUVEMENTS DE STOCK", "API_MOUVEMENT_STOCK", "api_mouvement_stock", "ProsumaAPIMouvementStockExtractor", False),
+}
+
+# 1, 2 et 3 sélectionnées ensemble: une seule récupération des commandes (api_commandes_groupees.py)
+COMMANDES_GROUPEES = ("COMMANDES GROUPÉES", "API_COMMANDE", "api_commandes_groupees", "ProsumaAPICommandesGroupeesExtractor", True)
+
+def parse_selection(choice):
+    """Convertit '1,3,5', '4-9' ou 'A' en liste de numéros d'API"""
+    if choice.strip().upper() == 'A':
+        return sorted(API_CONFIG)
+    selection = []
+    for part in choice.replace(' ', '').split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            selection.extend(range(int(start), int(end) + 1))
+        else:
+            selection.append(int(part))
+    unknown = [number for number in selection if number not in API_CONFIG]
+    if unknown:
+        raise ValueError(f"Option(s) invalide(s): {unknown}. Choisir entre 1 et {len(API_CONFIG)}, ou A")
+    return sorted(set(selection))
+
+def resolve_apis(selection):
+    """Liste des APIs à lancer, avec les commandes 1+2+3 regroupées si possible"""
+    if {1, 2, 3} <= set(selection):
+        return [COMMANDES_GROUPEES] + [API_CONFIG[n] for n in selection if n not in (1, 2, 3)]
+    return [API_CONFIG[n] for n in selection]
+
+@contextmanager
+def api_environment(folder, status):
+    """Variables d'environnement lues par un extracteur à son initialisation
+    (comme run_extraction dans run_api_extraction.sh)"""
+    saved = {name: os.environ.get(name) for name in ('DATE_START', 'DATE_END', 'STATUT_COMMANDE')}
+    try:
+        os.environ['STATUT_COMMANDE'] = status or ''
+        if folder == 'API_BASE_ARTICLE':
+            # Base articles: aucune date (extraction complète)
+            os.environ.pop('DATE_START', None)
+            os.environ.pop('DATE_END', None)
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def setup_logging():
+    """Un seul fichier de log pour toutes les APIs, chaque ligne préfixée par l'API et le magasin"""
+    # Même dossier que les logs des extracteurs: <DOWNLOAD_FOLDER_BASE>/Etats Natacha/SCRIPT/LOG
+    network_base = os.getenv('DOWNLOAD_FOLDER_BASE', '')
+    log_dir = PROJECT_ROOT
+    if network_base:
+        if os.name == 'nt':
+            log_path = network_base.replace('/', '\\').rstrip('\\') + '\\Etats Natacha\\SCRIPT\\LOG'
+        else:
+            if network_base.startswith('\\\\'):
+                network_base = '//' + network_base.lstrip('\\').replace('\\', '/')
+            log_path = network_base.rstrip('/') + '/Etats Natacha/SCRIPT/LOG'
+        if create_network_folder(log_path):
+            log_dir = log_path
+    log_file = os.path.join(log_dir, f'orchestrateur_{datetime.now().strftime("%Y%m%d")}.log')
+
+    handlers = [SafeStreamHandler()]
+    try:
+        handlers.append(logging.FileHandler(log_file, encoding='utf-8'))
+        set_log_file_permissions(log_file)
+    except OSError as e:
+        print(f"⚠️ Log fichier indisponible ({log_file}): {e}")
+    for handler in handlers:
+        handler.addFilter(ApiContextFilter())
+        handler.addFilter(ShopContextFilter())
+    # Configuré avant les extracteurs: leur setup_logging (basicConfig ou handlers
+    # ajoutés seulement si le logger racine n'en a pas) devient sans effet
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - [%(api)s] [%(shop)s] %(message)s',
+        handlers=handlers,
+        force=True
+    )
+
+def create_shared_session():
+    """Session HTTP commune à tous les extracteurs (pools de connexions par serveur partagés)"""
+    return get_http_session(os.getenv('PROSUMA_USER'), os.getenv('PROSUMA_PASSWORD'))
+
+def load_extractor(api, status, session):
+    """Importe le module de l'API et crée son extracteur avec la session partagée"""
+    name, folder, module_name, class_name, _ = api
+    folder_path = os.path.join(PROJECT_ROOT, folder)
+    if folder_path not in sys.path:
+        sys.path.append(folder_path)
+    module = importlib.import_module(module_name)
+    with api_environment(folder, status):
+        extractor = getattr(module, class_name)()
+    for shared in (extractor, *getattr(extractor, 'extractors', ())):
+        shared.session = session
+    return extractor
+
+def run_api(name, extractor):
+    """Exécute extract_all d'une API. Retourne (succès, durée en secondes)"""
+    set_current_api(name)
+    started = time.monotonic()
+    try:
+        logger.info(f"🚀 Début de l'extraction {name}")
+        extractor.extract_all()
+        return True, time.monotonic() - started
+    except Exception as e:
+        logger.exception(f"❌ Erreur fatale pendant l'extraction {name}: {e}")
+        return False, time.monotonic() - started
+    finally:
+        logger.info(f"🏁 Fin de l'extraction {name}")
+        set_current_api('')
+
+def main():
+    """Fonction principale"""
+    parser = argparse.ArgumentParser(description="Extractions API Prosuma dans un seul processus, en parallèle")
+    parser.add_argument('selection', help="Numéros des APIs (ex: 1,3,5 ou 4-9) ou A pour toutes")
+    parser.add_argument('--statut', default=os.getenv('STATUT_COMMANDE', ''),
+                        help="Filtre de statut des commandes (APIs 1, 2, 3)")
+    parser.add_argument('--debut', help="Date de début AAAA-MM-JJ (défaut: hier)")
+    parser.add_argument('--fin', help="Date de fin AAAA-MM-JJ (défaut: aujourd'hui)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Nombre d'APIs lancées simultanément (API_WORKERS, 4 par défaut)")
+    args = parser.parse_args()
+
+    load_dotenv(os.path.join(PROJECT_ROOT, 'config.env'))
+    if bool(args.debut) != bool(args.fin):
+        parser.error("--debut et --fin doivent être fournis ensemble")
+    if args.debut:
+        for value in (args.debut, args.fin):
+            datetime.strptime(value, '%Y-%m-%d')
+        os.environ.update({
+            'DATE_START': args.debut, 'DATE_END': args.fin,
+            'USE_DEFAULT_DATES': 'false', 'CUSTOM_START_DATE': args.debut, 'CUSTOM_END_DATE': args.fin,
+        })
+
+    try:
+        apis = resolve_apis(parse_selection(args.selection))
+    except ValueError as e:
+        parser.error(str(e))
+
+    setup_logging()
+    workers = max(1, args.workers or get_env_int('API_WORKERS', 4))
+    session = create_shared_session()
+
+    logger.info("=" * 60)
+    logger.info(f"🚀 ORCHESTRATEUR - {len(apis)} extraction(s), {workers} en parallèle")
+    logger.info("=" * 60)
+
+    # Initialisation séquentielle: les extracteurs lisent l'environnement dans __init__
+    extractors = []
+    results = {}
+    for api in apis:
+        name, needs_status = api[0], api[4]
+        try:
+            extractors.append((name, load_extractor(api, args.statut if needs_status else '', session)))
+        except (Exception, SystemExit) as e:
+            # Certains extracteurs appellent sys.exit(1) si leur configuration est incomplète
+            logger.error(f"❌ Initialisation impossible pour {name}: {e}")
+            results[name] = (False, 0.0)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='api') as executor:
+        futures = {name: executor.submit(run_api, name, extractor) for name, extractor in extractors}
+        for name, future in futures.items():
+            results[name] = future.result()
+    total = time.monotonic() - started
+
+    logger.info("=" * 60)
+    logger.info("📊📊📊 RÉSUMÉ DE L'ORCHESTRATEUR 📊📊📊")
+    logger.info("=" * 60)
+    for name, (success, duration) in results.items():
+        logger.info(f"   {'✅' if success else '❌'} {name}: {duration:.0f}s")
+    logger.info(f"⏱️ Durée totale: {total:.0f}s (somme des APIs: {sum(d for _, d in results.values()):.0f}s)")
+    log_http_pool_stats()
+    log_run_manifest()
+    logger.info("=" * 60)
+    return 0 if all(success for success, _ in results.values()) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -958,8 +958,18 @@ while true; do
                 echo "📅 Utilisation des dates déjà configurées"
             fi
             
-            # Pour chaque API, demander les filtres spécifiques
-            for i in {1..14}; do
+            # Commandes (1, 2, 3): une seule récupération de /api/supplier_order/
+            # répartie vers les trois exports (Toutes, Directes, Réassort)
+            if ask_status_filter "COMMANDES (Toutes, Directes, Réassort)"; then
+                echo
+                echo "1-3/14 - COMMANDES GROUPÉES..."
+                run_extraction "COMMANDES GROUPÉES" "API_COMMANDE" "api_commandes_groupees.py" "$SELECTED_STATUS_FILTER"
+            else
+                echo "⚠️ Extraction COMMANDES GROUPÉES annulée"
+            fi
+
+            # Pour chaque autre API, demander les filtres spécifiques
+            for i in {4..14}; do
                 IFS='|' read -r api_name api_folder script_name needs_status <<< "${API_CONFIG[$i]}"
                 
                 selected_status=""
@@ -5,11 +5,30 @@ Utilitaires partagés pour les APIs Prosuma RPOS
 
 import os
 import json
+import base64
 import logging
 import sys
 import io
 import subprocess
+import tempfile
+import contextvars
+import gzip
+import hashlib
+import sqlite3
+import shutil
+import weakref
 import platform
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qsl, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 
 logger = logging.getLogger(__name__)
 
@@ -97,10 +116,11 @@ class SafeStreamHandler(logging.StreamHandler):
             pass
 
 def load_shop_config(base_dir):
-    """Charge la configuration des magasins depuis le magasins.json unifié"""
+    """Charge la configuration des magasins depuis le magasins.json unifié
+    (ou depuis le fichier MAGASINS_FILE, ex: magasins du serveur simulé de BENCHMARK)"""
     try:
         # Chercher dans le répertoire fourni (API_PROSUMA_RPOS)
-        config_path = os.path.join(base_dir, 'magasins.json')
+        config_path = os.getenv('MAGASINS_FILE') or os.path.join(base_dir, 'magasins.json')
         
         if os.path.exists(config_path):
             with open(config_path, 'r', encoding='utf-8') as f:
@@ -258,8 +278,2696 @@ if (Test-Path $file) {{
         return False
 
 
+def get_env_int(name, default):
+    """Lit une variable d'environnement entière, avec valeur par défaut si absente ou invalide"""
+    value = os.getenv(name, '').strip()
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logger.warning(f"⚠️ Valeur invalide pour {name}: '{value}' - utilisation de {default}")
+        return default
+
+def get_env_bool(name, default):
+    """Lit une variable d'environnement booléenne (true/false, oui/non, 1/0)"""
+    value = os.getenv(name, '').strip().lower()
+    if not value:
+        return default
+    return value in ('1', 'true', 'oui', 'yes', 'on')
+
+class ShopRun:
+    """État de l'extraction en cours pour un magasin.
+
+    run_shops_parallel en crée un par magasin et le rend accessible via
+    current_shop_run() à tout le code exécuté pour ce magasin (pagination,
+    export...), sans passer par self: les magasins tournent en parallèle
+    sur la même instance d'extracteur.
+    """
+
+    def __init__(self, shop_code):
+        self.shop_code = shop_code
+        self.incomplete = False
+        self.checkpoints = []
+        self.missing_pages = []  # [(url, [pages])] restées en échec après les nouveaux essais
+        minutes = get_env_int('SHOP_DEADLINE_MINUTES', 0)
+        self.deadline = time.monotonic() + minutes * 60 if minutes > 0 else None
+        # Mesures du magasin (durée des étapes, pages, requêtes), None si RUN_MANIFEST=False
+        self.manifest = ShopManifest(current_api_name(), shop_code) if get_env_bool('RUN_MANIFEST', True) else None
+
+class ShopManifest:
+    """Mesures de l'extraction d'un magasin pour une API, écrites en JSON en fin de magasin.
+
+    - stages: durée de chaque étape (résolution du magasin, comptage, enrichissement,
+      écriture CSV, copie réseau), hors étapes imbriquées: la copie réseau faite
+      pendant l'export n'est pas comptée deux fois
+    - pages: une entrée par requête de page (endpoint, page, durée, statut, lignes, octets)
+    - compteurs: requêtes HTTP, octets reçus, lignes reçues et exportées, nouveaux essais
+
+    Les threads de pagination et d'enrichissement y écrivent en parallèle (verrou).
+    """
+
+    def __init__(self, api, shop_code):
+        self.api = api
+        self.shop_code = shop_code
+        self.started_at = datetime.now()
+        self._started = time.monotonic()
+        self.duration = None
+        self.success = None
+        self.incomplete = False
+        self.stages = {}
+        self.pages = []
+        self.requests = 0
+        self.bytes_received = 0
+        self.rows_in = 0
+        self.rows_out = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, seconds):
+        with self._lock:
+            total, calls = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + seconds, calls + 1)
+
+    def add_request(self, size):
+        with self._lock:
+            self.requests += 1
+            self.bytes_received += size
+
+    def add_page(self, endpoint, page, seconds, status, rows, size):
+        with self._lock:
+            self.pages.append({'endpoint': endpoint, 'page': page, 'seconds': round(seconds, 3),
+                               'status': status, 'rows': rows, 'bytes': size})
+            if status == 200:
+                self.rows_in += rows
+
+    def add_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def add_rows_out(self, count):
+        with self._lock:
+            self.rows_out += count
+
+    def finish(self, success, incomplete):
+        self.duration = time.monotonic() - self._started
+        self.success = bool(success)
+        self.incomplete = incomplete
+
+    def to_dict(self):
+        with self._lock:
+            stages = {name: {'seconds': round(total, 3), 'calls': calls}
+                      for name, (total, calls) in self.stages.items()}
+            staged = sum(total for total, _ in self.stages.values())
+            page_seconds = sum(page['seconds'] for page in self.pages)
+            return {
+                'api': self.api,
+                'shop': self.shop_code,
+                'started_at': self.started_at.isoformat(timespec='seconds'),
+                'duration_seconds': round(self.duration, 3) if self.duration is not None else None,
+                'success': self.success,
+                'incomplete': self.incomplete,
+                'stages': stages,
+                # Pagination et traitement des pages par l'extracteur (hors étapes mesurées)
+                'other_seconds': round(max(0.0, self.duration - staged), 3) if self.duration is not None else None,
+                'requests': self.requests,
+                'bytes_received': self.bytes_received,
+                'rows_in': self.rows_in,
+                'rows_out': self.rows_out,
+                'retries': self.retries,
+                # Somme des durées de page: supérieure à la durée réelle quand les pages sont parallèles
+                'page_seconds': round(page_seconds, 3),
+                'pages': list(self.pages),
+            }
+
+_current_shop_run = contextvars.ContextVar('prosuma_shop_run', default=None)
+
+_current_api = contextvars.ContextVar('prosuma_api', default='')
+
+# Étape en cours ((nom, [durée des étapes imbriquées])), pour les durées hors étapes imbriquées.
+# Les threads lancés pendant une étape en héritent: le cumul est protégé par _stage_lock
+_current_stage = contextvars.ContextVar('prosuma_stage', default=None)
+_stage_lock = threading.Lock()
+
+def set_current_api(api_name):
+    """Déclare l'API en cours dans ce contexte (orchestrateur). Retourne le jeton de contextvars"""
+    return _current_api.set(api_name)
+
+def current_api_name():
+    """API en cours: celle déclarée par l'orchestrateur, sinon le nom du script lancé"""
+    return _current_api.get() or os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'python'
+
+class ApiContextFilter(logging.Filter):
+    """Ajoute %(api)s aux messages: l'API en cours, quand plusieurs tournent dans le même processus"""
+
+    def filter(self, record):
+        record.api = _current_api.get() or '-'
+        return True
+
+class ShopContextFilter(logging.Filter):
+    """Ajoute %(shop)s aux messages: le magasin en cours, quand plusieurs magasins écrivent dans le même log"""
+
+    def filter(self, record):
+        run = current_shop_run()
+        record.shop = run.shop_code if run is not None else '-'
+        return True
+
+def shop_log_handlers(handlers):
+    """Ajoute ShopContextFilter à chaque handler (format avec %(shop)s) et retourne la liste"""
+    for handler in handlers:
+        handler.addFilter(ShopContextFilter())
+    return handlers
+
+def current_shop_run():
+    """Retourne le ShopRun du magasin en cours d'extraction (ou None hors run_shops_parallel)"""
+    return _current_shop_run.get()
+
+def mark_shop_incomplete():
+    """Signale qu'une partie des données du magasin en cours n'a pas pu être récupérée"""
+    run = current_shop_run()
+    if run is not None:
+        run.incomplete = True
+
+def current_manifest():
+    """ShopManifest du magasin en cours (None hors run_shops_parallel ou si RUN_MANIFEST=False)"""
+    run = current_shop_run()
+    return run.manifest if run is not None else None
+
+@contextmanager
+def stage(name):
+    """Mesure la durée d'une étape du magasin en cours (sans effet hors run_shops_parallel).
+
+    Le temps passé dans une étape imbriquée lui est attribué à elle seule:
+    with stage('csv') autour d'un export qui copie le fichier sous
+    with stage('network_copy') compte l'écriture et la copie séparément.
+    Une étape imbriquée du même nom (cached_lookup appelé sous with
+    stage('enrichment'), y compris depuis les threads de l'étape englobante)
+    est comptée dans l'étape englobante: ni appel ni durée en double.
+    """
+    manifest = current_manifest()
+    parent = _current_stage.get()
+    if manifest is None or (parent is not None and parent[0] == name):
+        yield
+        return
+    nested = [0.0]
+    token = _current_stage.set((name, nested))
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - started
+        _current_stage.reset(token)
+        with _stage_lock:
+            if parent is not None:
+                parent[1][0] += elapsed
+            own = elapsed - nested[0]
+        manifest.add_stage(name, max(0.0, own))
+
+def record_rows_out(count):
+    """Ajoute count lignes exportées au manifeste du magasin en cours"""
+    manifest = current_manifest()
+    if manifest is not None:
+        manifest.add_rows_out(count)
+
+def with_current_context(fn):
+    """Retourne fn exécutée dans le contexte de l'appelant (magasin, API, étape en cours).
+
+    Les threads d'un ThreadPoolExecutor n'héritent pas des contextvars: sans cela,
+    les requêtes des pages et des enrichissements ne seraient rattachées à aucun
+    magasin. Chaque appel reçoit sa propre copie (un contexte ne peut être
+    actif que dans un thread à la fois).
+    """
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+class PageCheckpoint:
+    """Pages déjà récupérées d'une extraction, conservées sur disque pour reprise.
+
+    Un point de reprise correspond à une requête précise: extraction, endpoint,
+    magasin et fenêtre de dates (tous les paramètres sauf page et page_size).
+    Chaque page reçue est ajoutée à un fichier JSONL (checkpoints/<nom>.jsonl,
+    à côté de magasins.json) et le nombre total d'enregistrements est noté dans
+    <nom>.json. Si l'extraction est interrompue, la suivante relit ces pages et
+    ne demande au serveur que les pages manquantes.
+
+    Le page_size effectif (éventuellement plafonné par le serveur) est noté avec
+    le nombre: les numéros de page stockés n'ont de sens qu'avec cette taille.
+
+    Le point de reprise est supprimé quand l'extraction du magasin réussit
+    (voir _run_shop). Les fichiers plus vieux que CHECKPOINT_MAX_AGE_HOURS
+    heures (48 par défaut) sont purgés au démarrage.
+    """
+
+    DIRNAME = 'checkpoints'
+    _purged = False
+    _purge_lock = threading.Lock()
+
+    def __init__(self, name, url, params, directory=None):
+        if directory is None:
+            directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), self.DIRNAME)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._purge_expired(directory)
+
+        # page_size hors clé: il est noté dans <nom>.json et peut changer d'une exécution à l'autre
+        window = {k: v for k, v in params.items() if k not in ('page', 'page_size')}
+        digest = hashlib.sha1(
+            json.dumps([name, url, window], sort_keys=True, default=str).encode('utf-8')
+        ).hexdigest()[:16]
+        shop = str(window.get('shop', 'all'))
+        base = os.path.join(directory, f"{name}_{shop}_{digest}")
+        self.meta_path = base + '.json'
+        self.pages_path = base + '.jsonl'
+        self.count = None
+        self.page_size = None
+        self._offsets = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    @classmethod
+    def _purge_expired(cls, directory):
+        with cls._purge_lock:
+            if cls._purged:
+                return
+            cls._purged = True
+        max_age = get_env_int('CHECKPOINT_MAX_AGE_HOURS', 48) * 3600
+        now = time.time()
+        for filename in os.listdir(directory):
+            path = os.path.join(directory, filename)
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _load(self):
+        """Relit le nombre d'enregistrements, le page_size et indexe les pages déjà stockées"""
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            self.count = meta.get('count')
+            self.page_size = meta.get('page_size')
+        except (OSError, ValueError, AttributeError):
+            self.count = None
+            self.page_size = None
+        if not os.path.exists(self.pages_path):
+            return
+        valid_size = 0
+        with open(self.pages_path, 'rb') as f:
+            for line in iter(f.readline, b''):
+                try:
+                    page = json.loads(line)['page']
+                except (ValueError, KeyError):
+                    # Ligne tronquée par une interruption: on s'arrête là
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                self._offsets[page] = valid_size
+                valid_size += len(line)
+        if valid_size < os.path.getsize(self.pages_path):
+            with open(self.pages_path, 'r+b') as f:
+                f.truncate(valid_size)
+
+    @property
+    def pages(self):
+        """Numéros des pages déjà stockées"""
+        return set(self._offsets)
+
+    def has_page(self, page):
+        return page in self._offsets
+
+    def load_page(self, page):
+        """Relit les enregistrements d'une page stockée"""
+        with self._lock, open(self.pages_path, 'r', encoding='utf-8') as f:
+            f.seek(self._offsets[page])
+            return json.loads(f.readline())['items']
+
+    def save_count(self, count, page_size):
+        self.count = count
+        self.page_size = page_size
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'count': count, 'page_size': page_size, 'saved_at': datetime.now().isoformat()}, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def save_page(self, page, items):
+        """Ajoute une page reçue au fichier de reprise"""
+        line = (json.dumps({'page': page, 'items': items}, ensure_ascii=False) + '\n').encode('utf-8')
+        with self._lock, open(self.pages_path, 'ab') as f:
+            offset = f.tell()
+            f.write(line)
+            f.flush()
+            self._offsets[page] = offset
+
+    def clear(self):
+        """Supprime le point de reprise (extraction terminée)"""
+        for path in (self.meta_path, self.pages_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._offsets.clear()
+        self.count = None
+        self.page_size = None
+
+class PageSnapshot:
+    """Copie complète et partagée du résultat d'une requête paginée.
+
+    Plusieurs extractions lisent le même endpoint avec les mêmes filtres
+    (/api/product/ pour INVENTAIRE, PRE_COMMANDE, RETOUR_MARCHANDISE,
+    COMMANDE_THEME). La première enregistre toutes les pages dans
+    snapshots/ (JSONL compressé, à côté de magasins.json). Les suivantes les
+    relisent au lieu de les redemander tant que l'instantané a moins de
+    SNAPSHOT_TTL_MINUTES minutes (30 par défaut).
+
+    Chaque script calcule sa fenêtre de dates à partir de l'heure de
+    lancement, donc date_0/date_1 varient de quelques secondes ou minutes
+    d'une extraction à l'autre. Ces deux paramètres sont comparés avec une
+    tolérance égale à la durée de vie de l'instantané, tous les autres (sauf
+    page_size, noté avec l'instantané) doivent être identiques. Un instantané n'est publié (renommage atomique) que si
+    toutes les pages ont été reçues.
+
+    Dans un même processus (orchestrateur), les extractions lancées en même
+    temps ne téléchargent pas chacune l'endpoint: la première devient l'auteur
+    de l'instantané, les suivantes attendent qu'il soit publié (ou abandonné)
+    avant de le relire.
+    """
+
+    DIRNAME = 'snapshots'
+    WINDOW_PARAMS = ('date_0', 'date_1')
+    _purged = False
+    _purge_lock = threading.Lock()
+    # Instantanés en cours d'enregistrement dans le processus (chemins)
+    _writing = set()
+    _writing_cond = threading.Condition()
+
+    def __init__(self, url, params, ttl_minutes=None, directory=None):
+        if directory is None:
+            directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), self.DIRNAME)
+        if ttl_minutes is None:
+            ttl_minutes = get_env_int('SNAPSHOT_TTL_MINUTES', 30)
+        self.ttl_seconds = ttl_minutes * 60
+        os.makedirs(directory, exist_ok=True)
+        self._purge_expired(directory)
+
+        # page_size hors clé (noté dans les métadonnées): le page_size appris par un
+        # autre extracteur du même endpoint ne doit pas empêcher le partage
+        query = {k: v for k, v in params.items() if k not in self.WINDOW_PARAMS and k not in ('page', 'page_size')}
+        self.window = {k: str(params[k]) for k in self.WINDOW_PARAMS if k in params}
+        digest = hashlib.sha1(json.dumps([url, query], sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+        base = os.path.join(directory, f"{query.get('shop', 'all')}_{digest}")
+        self.meta_path = base + '.json'
+        self.pages_path = base + '.jsonl.gz'
+        self.count = None
+        self.page_size = None
+        self._writer = None
+        self._release = None
+
+    def _purge_expired(self, directory):
+        with self._purge_lock:
+            if PageSnapshot._purged:
+                return
+            PageSnapshot._purged = True
+        now = time.time()
+        for filename in os.listdir(directory):
+            path = os.path.join(directory, filename)
+            try:
+                if now - os.path.getmtime(path) > self.ttl_seconds:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _same_window(self, window):
+        if set(window) != set(self.window):
+            return False
+        for name, value in self.window.items():
+            try:
+                delta = abs((_parse_api_date(value) - _parse_api_date(window[name])).total_seconds())
+            except (TypeError, ValueError):
+                return False
+            if delta > self.ttl_seconds:
+                return False
+        return True
+
+    def load(self):
+        """True si un instantané complet, récent et de même fenêtre est disponible.
+
+        Si une autre extraction du processus enregistre le même instantané, attend
+        qu'elle ait terminé. Sinon (False), cette extraction en devient l'auteur
+        jusqu'à finish() ou release().
+        """
+        with self._writing_cond:
+            while self.pages_path in self._writing:
+                self._writing_cond.wait(timeout=1)
+            if self._load():
+                return True
+            self._writing.add(self.pages_path)
+            # Filet de sécurité: l'instantané est libéré si l'objet disparaît sans finish()
+            self._release = weakref.finalize(self, PageSnapshot._release_path, self.pages_path)
+            return False
+
+    @classmethod
+    def _release_path(cls, path):
+        with cls._writing_cond:
+            cls._writing.discard(path)
+            cls._writing_cond.notify_all()
+
+    def release(self):
+        """Renonce à enregistrer l'instantané: les extractions en attente reprennent"""
+        if self._release is not None:
+            self._release()
+            self._release = None
+
+    def _load(self):
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if time.time() - meta.get('created_at', 0) > self.ttl_seconds:
+            return False
+        if not self._same_window(meta.get('window', {})) or not os.path.exists(self.pages_path):
+            return False
+        self.count = meta.get('count', 0)
+        self.page_size = meta.get('page_size')
+        return True
+
+    def iter_pages(self):
+        """Relit les pages (page, items) de l'instantané"""
+        with gzip.open(self.pages_path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                yield entry['page'], entry['items']
+
+    def start(self, count, page_size):
+        """Commence l'enregistrement d'un nouvel instantané (fichiers temporaires)"""
+        self.count = count
+        self.page_size = page_size
+        fd, tmp_path = tempfile.mkstemp(prefix='snapshot_', suffix='.tmp', dir=os.path.dirname(self.pages_path))
+        self._writer = (gzip.open(os.fdopen(fd, 'wb'), 'wt', encoding='utf-8'), tmp_path)
+
+    def add_page(self, page, items):
+        if self._writer is not None:
+            self._writer[0].write(json.dumps({'page': page, 'items': items}, ensure_ascii=False) + '\n')
+
+    def finish(self, complete):
+        """Publie l'instantané s'il est complet, sinon l'abandonne"""
+        if self._writer is None:
+            self.release()
+            return
+        writer, tmp_path = self._writer
+        self._writer = None
+        try:
+            writer.close()
+            if not complete:
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, self.pages_path)
+            meta_tmp = self.meta_path + '.tmp'
+            with open(meta_tmp, 'w', encoding='utf-8') as f:
+                json.dump({'count': self.count, 'page_size': self.page_size, 'window': self.window,
+                           'created_at': time.time()}, f)
+            os.replace(meta_tmp, self.meta_path)
+        except OSError as e:
+            logger.warning(f"⚠️ Instantané non enregistré: {e}")
+        finally:
+            self.release()
+
+class PageFetcher:
+    """Récupère les pages d'un endpoint paginé Prosuma (format DRF: count/next/results).
+
+    La page 1 est récupérée seule (ou reprise de count_records), puis les pages
+    2..N sont demandées en parallèle par un nombre borné de threads
+    (PAGE_WORKERS dans config.env, 4 par défaut).
+    Les pages sont restituées dans l'ordre, au fur et à mesure de leur arrivée,
+    et jamais plus de max_workers pages ne sont en attente en mémoire.
+
+    Comportement en cas d'erreur (identique aux anciennes boucles while):
+    - page vide: fin de la pagination
+    - erreur 500/502/503: la page est ignorée et on continue
+    - autre erreur HTTP ou exception: arrêt de la pagination
+
+    Avec checkpoint_name (et CHECKPOINT_ENABLED=True), les pages reçues sont
+    conservées dans un PageCheckpoint: une extraction interrompue reprend à la
+    première page manquante au lieu de repartir de la page 1.
 
+    Avec snapshot=True, le résultat complet est partagé avec les autres
+    extractions qui lisent la même requête (voir PageSnapshot).
+    """
+
+    # Erreurs temporaires: la page est remise en file et redemandée après le parcours
+    RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, session, url, params, page_size=1000, timeout=30, max_workers=None,
+                 checkpoint_name=None, snapshot=False, keyset=False, adaptive=True):
+        self.session = session
+        self.url = url
+        # page_size appris lors des exécutions précédentes pour ce serveur et cet endpoint
+        self.tuner = get_page_size_tuner() if adaptive and get_env_bool('ADAPTIVE_PAGE_SIZE', True) else None
+        self.requested_page_size = page_size
+        if self.tuner is not None:
+            page_size = self.tuner.page_size(url, page_size)
+        self.params = dict(params)
+        self.params['page_size'] = page_size
+        self.params.pop('page', None)
+        # Pagination par clé (id > dernier id vu) au lieu de page=N, si activée
+        self.keyset = keyset and get_env_bool('KEYSET_PAGINATION', False)
+        if self.keyset:
+            self.params['ordering'] = 'id'
+        self._keyset_key = (urlparse(url).netloc, urlparse(url).path)
+        self.endpoint = urlparse(url).path
+        self.page_size = page_size
+        self.timeout = timeout
+        self.max_workers = max(1, max_workers or get_env_int('PAGE_WORKERS', 4))
+        self.total_pages = 0
+        self._first_page = None
+        # Statut HTTP de la requête de comptage (None tant qu'elle n'a pas eu lieu)
+        self.count_status = None
+        self.failed_pages = 0
+        # Échéance et magasin en cours, transmis aux threads de pagination
+        self.deadline = current_deadline()
+        self.scope = request_scope()
+        self._timed_out = set()
+        self.retry_queue = []
+        self.recovered_pages = 0
+        self.missing_pages = []
+        self.snapshot = None
+        self._from_snapshot = False
+        if snapshot and get_env_int('SNAPSHOT_TTL_MINUTES', 30) > 0:
+            try:
+                self.snapshot = PageSnapshot(url, self.params)
+            except OSError as e:
+                logger.warning(f"⚠️ Instantané indisponible: {e}")
+        self.checkpoint = None
+        if checkpoint_name and get_env_bool('CHECKPOINT_ENABLED', True):
+            try:
+                self.checkpoint = PageCheckpoint(checkpoint_name, url, self.params)
+            except OSError as e:
+                logger.warning(f"⚠️ Point de reprise indisponible: {e}")
+            else:
+                run = current_shop_run()
+                if run is not None:
+                    run.checkpoints.append(self.checkpoint)
+                if self._can_resume() and self.checkpoint.page_size != self.page_size:
+                    # Reprise: même découpage qu'à l'exécution interrompue, pas le page_size appris depuis
+                    logger.info(f"   ℹ️ page_size de la reprise: {self.checkpoint.page_size} (prévu: {self.page_size})")
+                    self.page_size = self.checkpoint.page_size
+                    self.params['page_size'] = self.page_size
+
+    def _can_resume(self):
+        """Point de reprise utilisable: nombre, page_size et page 1 enregistrés"""
+        checkpoint = self.checkpoint
+        return (checkpoint is not None and checkpoint.count is not None
+                and bool(checkpoint.page_size) and checkpoint.has_page(1))
+
+    def fetch_page(self, page, after_id=None, page_size=None):
+        """Récupère une page. Retourne (status_code, données JSON ou message d'erreur).
+
+        Avec after_id (pagination par clé), demande la première page des
+        enregistrements d'id supérieur à after_id au lieu de la page numéro page.
+        """
+        params = dict(self.params)
+        if after_id is None:
+            params['page'] = page
+        else:
+            params['id__gt'] = after_id
+        if page_size:
+            params['page_size'] = page_size
+        _request_deadline.value = self.deadline
+        _request_scope.value = self.scope
+        started = time.monotonic()
+        status, rows, size = None, 0, 0
+        try:
+            response = self.session.get(self.url, params=params, timeout=self.timeout)
+            status, size = response.status_code, len(response.content)
+            if response.status_code != 200:
+                return response.status_code, response.text[:500]
+            payload = response.json()
+            items = payload.get('results', []) if isinstance(payload, dict) else payload
+            rows = len(items)
+            if self.tuner is not None:
+                self.tuner.record(self.url, len(items), response.elapsed.total_seconds(), len(response.content))
+            return 200, payload
+        except requests.exceptions.Timeout as e:
+            self._timed_out.add(page)
+            if self.tuner is not None:
+                self.tuner.record_timeout(self.url)
+            return None, str(e)
+        except Exception as e:
+            return None, str(e)
+        finally:
+            _request_deadline.value = None
+            _request_scope.value = None
+            manifest = current_manifest()
+            if manifest is not None:
+                manifest.add_page(self.endpoint, page if after_id is None else f"id>{after_id}",
+                                  time.monotonic() - started, status, rows, size)
+
+    def deadline_passed(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def _split_parts(self):
+        """Nombre de sous-pages pour redemander une page (None si impossible).
+
+        Les sous-pages k(N-1)+1..kN de taille page_size/k couvrent exactement la
+        page N seulement si k divise page_size: une taille impaire (plafond du
+        serveur, taille apprise) n'est pas coupée en deux mais en 3, 5...
+        """
+        minimum = get_env_int('PAGE_SIZE_MIN', 100)
+        return next((parts for parts in range(2, 10)
+                     if self.page_size % parts == 0 and self.page_size // parts >= minimum), None)
+
+    def _fetch_split(self, page, parts):
+        """Page N redemandée en `parts` sous-pages de taille page_size/parts:
+        mêmes enregistrements, requêtes plus légères après un timeout"""
+        size = self.page_size // parts
+        results = []
+        for sub_page in range(parts * (page - 1) + 1, parts * page + 1):
+            status, payload = self.fetch_page(sub_page, page_size=size)
+            if status != 200:
+                return status, payload
+            results.extend(payload.get('results', []) if isinstance(payload, dict) else payload)
+        return 200, {'results': results}
+
+    def _retry_page(self, page):
+        """Nouvel essai d'une page: en sous-pages si elle a dépassé le délai"""
+        manifest = current_manifest()
+        if manifest is not None:
+            manifest.add_retry()
+        parts = self._split_parts() if page in self._timed_out else None
+        if parts:
+            self._timed_out.discard(page)
+            logger.info(f"  ✂️ Page {page} redemandée en {parts} sous-pages de {self.page_size // parts} (timeout)")
+            return self._fetch_split(page, parts)
+        return self.fetch_page(page)
+
+    def _is_last_page(self, items):
+        """Dernière page d'une pagination séquentielle: page vide ou incomplète.
+
+        Au-delà du page_size demandé par l'extracteur (page_size appris), une page
+        incomplète peut venir d'une limite du serveur: seule une page vide termine.
+        """
+        if not items:
+            return True
+        return len(items) < self.page_size and self.page_size <= self.requested_page_size
+
+    def count_records(self):
+        """Récupère la page 1 et retourne le nombre total d'enregistrements (champ count).
+
+        La page 1 est conservée: iter_pages la réutilise au lieu de la redemander.
+        Retourne 0 en cas d'erreur. En reprise, le nombre enregistré par
+        l'extraction interrompue est réutilisé sans requête.
+        """
+        with stage('count'):
+            return self._count_records()
+
+    def _count_records(self):
+        if self.snapshot is not None and self.snapshot.load():
+            self._from_snapshot = True
+            self.count_status = 200
+            if self.snapshot.page_size:
+                # Pages relues telles qu'enregistrées: total_pages suit leur taille
+                self.page_size = self.snapshot.page_size
+                self.params['page_size'] = self.page_size
+            logger.info(f"📦 Instantané partagé réutilisé: {self.snapshot.count:,} enregistrements, aucune requête")
+            return self.snapshot.count
+
+        checkpoint = self.checkpoint
+        if self._can_resume():
+            # page_size déjà repris du point de reprise dans __init__ (plafond serveur compris)
+            self.count_status = 200
+            logger.info(f"♻️ Reprise: {len(checkpoint.pages)} page(s) déjà récupérée(s)")
+            return checkpoint.count
+
+        self._first_page = self.fetch_page(1)
+        status, payload = self._first_page
+        self.count_status = status
+        if status != 200:
+            logger.error(f"❌ Erreur lors du comptage: {status if status is not None else payload}")
+            self._first_page = None
+            if self.snapshot is not None:
+                self.snapshot.release()
+            return 0
+        count = payload.get('count', 0) if isinstance(payload, dict) else len(payload)
+        items = payload.get('results', []) if isinstance(payload, dict) else payload
+        # count=0 sur certains endpoints: un lien "next" signale alors aussi une page incomplète
+        has_more = count > len(items) or (not count and isinstance(payload, dict) and bool(payload.get('next')))
+        if 0 < len(items) < self.page_size and has_more:
+            # Le serveur plafonne page_size: les numéros de page suivent sa taille réelle
+            logger.info(f"   ℹ️ page_size limité à {len(items)} par le serveur (demandé: {self.page_size})")
+            self.page_size = len(items)
+            # Pages 2..N demandées à cette taille: numéros de page et décalages concordent
+            self.params['page_size'] = self.page_size
+            if self.tuner is not None:
+                self.tuner.record_cap(self.url, len(items))
+        if checkpoint is not None:
+            checkpoint.clear()
+            checkpoint.save_count(count, self.page_size)
+        return count
+
+    def _get_page(self, page, result=None):
+        """Page depuis le point de reprise si elle y est, sinon depuis le serveur.
+        Retourne (items, arrêter)"""
+        checkpoint = self.checkpoint
+        if checkpoint is not None and checkpoint.has_page(page):
+            return checkpoint.load_page(page), False
+        items, stop = self._handle_page(page, *(result or self.fetch_page(page)))
+        if items and checkpoint is not None:
+            checkpoint.save_page(page, items)
+        return items, stop
+
+    def _handle_page(self, page, status, payload):
+        """Interprète le résultat d'une page. Retourne (items, arrêter)"""
+        if status == 200:
+            items = payload.get('results', []) if isinstance(payload, dict) else payload
+            if not items:
+                logger.info(f"  ✅ Dernière page atteinte (page {page}) - Aucun enregistrement retourné")
+                return [], True
+            return items, False
+        if self.deadline_passed():
+            logger.error(f"⏰ Échéance atteinte: pagination arrêtée à la page {page}, points de reprise conservés")
+            stored = self.checkpoint.pages if self.checkpoint is not None else set()
+            self._record_missing([p for p in range(page, max(page, self.total_pages) + 1) if p not in stored])
+            return [], True
+        if status is None or status in self.RETRYABLE_STATUS:
+            logger.error(f"❌ Erreur lors de la récupération de la page {page}: {status if status is not None else payload}")
+            logger.warning(f"⚠️ Page {page} mise en file pour un nouvel essai, poursuite avec les suivantes...")
+            self.queue_retry(page)
+            return [], False
+        logger.error(f"❌ Erreur lors de la récupération de la page {page}: {status}")
+        logger.error(f"❌ Réponse: {payload}")
+        self._record_missing([page])
+        return [], True
+
+    def queue_retry(self, page):
+        """Met une page en échec temporaire en file: retry_failed_pages la redemandera"""
+        if page not in self.retry_queue:
+            self.retry_queue.append(page)
+
+    def _record_missing(self, pages):
+        """Pages définitivement perdues: magasin incomplet et pages notées pour le bilan"""
+        mark_shop_incomplete()
+        self.failed_pages += len(pages)
+        self.missing_pages.extend(pages)
+        run = current_shop_run()
+        if run is not None:
+            run.missing_pages.append((self.url, list(pages)))
+
+    def retry_failed_pages(self):
+        """Générateur (page, items): redemande les pages de la file d'attente.
+
+        Jusqu'à PAGE_RETRY_ATTEMPTS passes (3 par défaut), précédées d'une attente
+        exponentielle (PAGE_RETRY_DELAY secondes, puis x2 à chaque passe). Les
+        pages encore en échec sont notées comme manquantes (magasin incomplet).
+        """
+        attempts = max(0, get_env_int('PAGE_RETRY_ATTEMPTS', 3))
+        delay = max(0, get_env_int('PAGE_RETRY_DELAY', 5))
+        checkpoint = self.checkpoint
+        for attempt in range(1, attempts + 1):
+            if not self.retry_queue:
+                break
+            wait_seconds = delay * 2 ** (attempt - 1)
+            if self.deadline is not None and time.monotonic() + wait_seconds >= self.deadline:
+                logger.warning(f"⏰ Échéance trop proche: pas de nouvel essai des pages {sorted(self.retry_queue)}")
+                break
+            pages, self.retry_queue = sorted(self.retry_queue), []
+            logger.info(f"🔁 Nouvel essai {attempt}/{attempts} de {len(pages)} page(s) dans {wait_seconds}s: {pages}")
+            time.sleep(wait_seconds)
+            with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(pages)))) as executor:
+                # executor.map garde l'ordre des pages
+                for page, (status, payload) in zip(pages, executor.map(with_current_context(self._retry_page), pages)):
+                    if status != 200:
+                        logger.warning(f"⚠️ Page {page} toujours en échec: {status if status is not None else payload}")
+                        self.retry_queue.append(page)
+                        continue
+                    items = payload.get('results', []) if isinstance(payload, dict) else payload
+                    self.recovered_pages += 1
+                    logger.info(f"  ✅ Page {page} récupérée au nouvel essai {attempt}: {len(items)} éléments")
+                    if items:
+                        if checkpoint is not None:
+                            checkpoint.save_page(page, items)
+                        yield page, items
+
+        if self.retry_queue:
+            missing, self.retry_queue = sorted(self.retry_queue), []
+            logger.error(f"❌ {len(missing)} page(s) non récupérée(s) après {attempts} nouvel(s) essai(s): {missing}")
+            self._record_missing(missing)
+        if self.recovered_pages or self.missing_pages:
+            logger.info(f"📋 Complétude: {self.total_pages - len(self.missing_pages)}/{self.total_pages} pages "
+                        f"({self.recovered_pages} récupérée(s) au nouvel essai, {len(self.missing_pages)} manquante(s))")
+
+    def iter_pages(self, total_records):
+        """Générateur (page, items) sur toutes les pages, dans l'ordre des pages"""
+        self.total_pages = (total_records + self.page_size - 1) // self.page_size if total_records > 0 else 0
+        if self.total_pages == 0:
+            if self.snapshot is not None and not self._from_snapshot:
+                self.snapshot.release()
+            return
+
+        if self._from_snapshot:
+            yield from self.snapshot.iter_pages()
+            return
+        if self.snapshot is None:
+            yield from self._fetch_pages()
+            return
+
+        self.snapshot.start(total_records, self.page_size)
+        complete = False
+        try:
+            for page, items in self._fetch_pages():
+                self.snapshot.add_page(page, items)
+                yield page, items
+            complete = self.failed_pages == 0
+        finally:
+            self.snapshot.finish(complete)
+
+    def _fetch_pages(self):
+        """Parcours complet des pages, puis nouvel essai des pages en échec temporaire"""
+        if self.keyset and _keyset_support.get(self._keyset_key) is not False:
+            yield from self._keyset_pages()
+        else:
+            yield from self._sweep_pages()
+        yield from self.retry_failed_pages()
+        self._learn_page_size()
+
+    def _learn_page_size(self):
+        """Fait apprendre le page_size au tuner, seulement après une pagination complète:
+        le point de reprise d'un magasin incomplet doit garder le même découpage"""
+        run = current_shop_run()
+        if self.tuner is None or self.failed_pages or (run is not None and run.incomplete):
+            return
+        self.tuner.learn(self.url)
+
+    def _sweep_pages(self, first=1):
+        """Pagination par numéro de page: page 1, puis pages first+1..N en parallèle"""
+        if first == 1:
+            first_page, self._first_page = self._first_page, None
+            items, stop = self._get_page(1, first_page)
+            if items:
+                yield 1, items
+            if stop or self.total_pages == 1:
+                return
+
+        # En reprise, seules les pages absentes du point de reprise sont demandées
+        stored = self.checkpoint.pages if self.checkpoint is not None else set()
+        missing = [page for page in range(max(2, first), self.total_pages + 1) if page not in stored]
+        workers = max(1, min(self.max_workers, len(missing)))
+        fetch_page = with_current_context(self.fetch_page)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            to_submit = iter(missing)
+            for page in range(max(2, first), self.total_pages + 1):
+                # Garder au plus `workers` pages en vol (borne la mémoire)
+                while len(pending) < workers:
+                    next_page = next(to_submit, None)
+                    if next_page is None:
+                        break
+                    pending[next_page] = executor.submit(fetch_page, next_page)
+
+                future = pending.pop(page, None)
+                items, stop = self._get_page(page, future.result() if future else None)
+                if items:
+                    yield page, items
+                if stop:
+                    for future in pending.values():
+                        future.cancel()
+                    return
+
+    def _keyset_pages(self):
+        """Pagination par clé: chaque page demande les enregistrements d'id > dernier id reçu.
+
+        Temps de réponse constant quelle que soit la profondeur (pas d'OFFSET côté
+        serveur) et ni doublon ni trou si des données sont insérées pendant
+        l'extraction. Les pages sont forcément séquentielles. Si l'endpoint ne trie
+        pas par id ou ignore le filtre id__gt, c'est mémorisé pour le serveur et la
+        pagination par numéro de page reprend là où elle en était.
+        """
+        first_page, self._first_page = self._first_page, None
+        items, stop = self._get_page(1, first_page)
+        if items:
+            yield 1, items
+        if stop or self._is_last_page(items):
+            return
+
+        ids = [item.get('id') if isinstance(item, dict) else None for item in items]
+        if not all(isinstance(i, int) for i in ids) or ids != sorted(ids):
+            yield from self._keyset_fallback("tri par id non pris en charge")
+            return
+
+        checkpoint = self.checkpoint
+        last_id = ids[-1]
+        page = 2
+        while True:
+            if checkpoint is not None and checkpoint.has_page(page):
+                items = checkpoint.load_page(page)
+            else:
+                status, payload = self._fetch_with_retry(page, after_id=last_id)
+                if status != 200:
+                    logger.error(f"❌ Pagination par clé interrompue à la page {page} (id > {last_id})")
+                    self._record_missing(list(range(page, max(page, self.total_pages) + 1)))
+                    return
+                items = payload.get('results', []) if isinstance(payload, dict) else payload
+                ids = [item.get('id') if isinstance(item, dict) else None for item in items]
+                if not all(isinstance(i, int) and i > last_id for i in ids) or ids != sorted(ids):
+                    if page == 2:
+                        yield from self._keyset_fallback("filtre id__gt ignoré")
+                        return
+                    logger.error(f"❌ Réponse incohérente en pagination par clé (page {page}, id > {last_id})")
+                    self._record_missing(list(range(page, max(page, self.total_pages) + 1)))
+                    return
+                _keyset_support[self._keyset_key] = True
+                if items and checkpoint is not None:
+                    checkpoint.save_page(page, items)
+            if not items:
+                return
+            last_id = max(item['id'] for item in items)
+            yield page, items
+            if self._is_last_page(items):
+                return
+            page += 1
+
+    def _fetch_with_retry(self, page, after_id=None):
+        """fetch_page avec nouveaux essais immédiats, pour les paginations séquentielles
+        où une page manquante bloque la suite (PAGE_RETRY_ATTEMPTS, PAGE_RETRY_DELAY)"""
+        attempts = max(0, get_env_int('PAGE_RETRY_ATTEMPTS', 3))
+        delay = max(0, get_env_int('PAGE_RETRY_DELAY', 5))
+        for attempt in range(attempts + 1):
+            if attempt:
+                if self.deadline is not None and time.monotonic() + delay * 2 ** (attempt - 1) >= self.deadline:
+                    break
+                time.sleep(delay * 2 ** (attempt - 1))
+                manifest = current_manifest()
+                if manifest is not None:
+                    manifest.add_retry()
+            status, payload = self.fetch_page(page, after_id=after_id)
+            if status == 200 or (status is not None and status not in self.RETRYABLE_STATUS):
+                break
+            logger.warning(f"⚠️ Page {page} en échec (essai {attempt + 1}/{attempts + 1}): {status if status is not None else payload}")
+        return status, payload
+
+    def iter_until_empty(self):
+        """Générateur (page, items) sans nombre total: pour les endpoints dont le
+        champ count n'est pas fiable (count=0 alors que des résultats existent).
+
+        Les pages sont lues dans l'ordre jusqu'à la dernière. Un lien "next" non
+        nul est toujours suivi; s'il est nul, il termine quand count est cohérent.
+        Sinon (count=0, ou page relue du point de reprise), seule une page vide
+        ou incomplète termine. La page suivante est demandée en arrière-plan
+        pendant que l'appelant traite la page courante. La page 1 déjà lue par
+        count_records est réutilisée. total_pages suit la progression.
+        """
+        checkpoint = self.checkpoint
+        first_page, self._first_page = self._first_page, None
+
+        def load(page):
+            """Future (status, payload) de la page, ou None si elle est dans le point de reprise"""
+            if checkpoint is not None and checkpoint.has_page(page):
+                return None
+            if page == 1 and first_page is not None:
+                future = Future()
+                future.set_result(first_page)
+                return future
+            return executor.submit(fetch_with_retry, page)
+
+        fetch_with_retry = with_current_context(self._fetch_with_retry)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            page = 1
+            pending = load(page)
+            while True:
+                if pending is None:
+                    items = checkpoint.load_page(page)
+                    has_next = not self._is_last_page(items)
+                else:
+                    status, payload = pending.result()
+                    if status != 200:
+                        logger.error(f"❌ Lecture interrompue à la page {page}: {status if status is not None else payload}")
+                        self._record_missing([page])
+                        return
+                    items = payload.get('results', []) if isinstance(payload, dict) else payload
+                    next_link = payload.get('next') if isinstance(payload, dict) else None
+                    if next_link or (isinstance(payload, dict) and payload.get('count') and 'next' in payload):
+                        has_next = bool(next_link)
+                    else:
+                        has_next = not self._is_last_page(items)
+                    if items and checkpoint is not None:
+                        checkpoint.save_page(page, items)
+                has_next = has_next and bool(items)
+                self.total_pages = page + 1 if has_next else page
+
+                # Préchargement de la page suivante pendant le traitement de celle-ci
+                if has_next:
+                    pending = load(page + 1)
+                if items:
+                    yield page, items
+                if not has_next:
+                    logger.info(f"  ✅ Dernière page atteinte (page {page})")
+                    self._learn_page_size()
+                    return
+                page += 1
+
+    def _keyset_fallback(self, reason):
+        """Endpoint sans pagination par clé: mémorisé, puis pages 2..N par numéro"""
+        if _keyset_support.get(self._keyset_key) is not False:
+            logger.info(f"   ℹ️ Pagination par clé indisponible sur {self.url} ({reason}), pagination par page")
+        _keyset_support[self._keyset_key] = False
+        yield from self._sweep_pages(first=2)
+
+# Endpoints (hôte, chemin) qui acceptent ou non la pagination par clé
+_keyset_support = {}
+
+def get_server_key(shop_info):
+    """Retourne l'hôte du serveur Prosuma d'un magasin (ex: pos16-prod-prosuma.prosuma.pos)"""
+    url = (shop_info or {}).get('url', '')
+    return urlparse(url).netloc or url
+
+class ServerGuard:
+    """Limiteur de débit et disjoncteur pour un serveur posN.
+
+    - Seau à jetons: au plus SERVER_RATE_LIMIT requêtes par seconde (0 = illimité),
+      avec des rafales jusqu'à une seconde de débit.
+    - Au plus SERVER_MAX_IN_FLIGHT requêtes simultanées (0 = taille du pool HTTP).
+    - Disjoncteur: après CIRCUIT_FAILURES erreurs consécutives (5xx, 429, timeout,
+      connexion refusée), le serveur est mis en pause CIRCUIT_COOLDOWN secondes,
+      doublées à chaque nouvel échec jusqu'à CIRCUIT_MAX_COOLDOWN. Une seule
+      requête test passe ensuite; si elle réussit, le trafic reprend.
+
+    Seuls les threads du serveur en pause attendent: les autres serveurs
+    continuent à leur rythme.
+    """
+
+    def __init__(self, host, rate, max_in_flight, failure_threshold, cooldown, max_cooldown):
+        self.host = host
+        self.rate = rate
+        self.failure_threshold = max(1, failure_threshold)
+        self.base_cooldown = cooldown
+        self.max_cooldown = max(cooldown, max_cooldown)
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._cond = threading.Condition()
+        self._tokens = float(max(1, rate))
+        self._refilled_at = time.monotonic()
+        self._failures = 0
+        self._cooldown = cooldown
+        self._open_until = 0.0
+        self._probing = False
+        self.throttled = 0
+        self.trips = 0
+
+    def _wait_circuit(self):
+        """Attend que le disjoncteur laisse passer la requête. Retourne True si c'est la requête test"""
+        with self._cond:
+            while True:
+                if self._failures < self.failure_threshold:
+                    return False
+                remaining = self._open_until - time.monotonic()
+                if remaining <= 0 and not self._probing:
+                    self._probing = True
+                    return True
+                self._cond.wait(timeout=max(0.1, remaining) if remaining > 0 else 1)
+
+    def _take_token(self):
+        if self.rate <= 0:
+            return
+        waited = False
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                self._tokens = min(float(max(1, self.rate)), self._tokens + (now - self._refilled_at) * self.rate)
+                self._refilled_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+                if not waited:
+                    self.throttled += 1
+                    waited = True
+            time.sleep(delay)
+
+    def acquire(self):
+        """Bloque jusqu'à ce qu'une requête puisse partir vers ce serveur"""
+        probe = self._wait_circuit()
+        self._slots.acquire()
+        try:
+            self._take_token()
+        except BaseException:
+            self._slots.release()
+            raise
+        return probe
+
+    def release(self, probe, success, retry_after=None):
+        """Enregistre le résultat d'une requête et libère sa place (success=None: non envoyée)"""
+        self._slots.release()
+        with self._cond:
+            if probe:
+                self._probing = False
+            if success:
+                if self._failures >= self.failure_threshold:
+                    logger.info(f"✅ Serveur {self.host} de nouveau disponible, reprise des requêtes")
+                self._failures = 0
+                self._cooldown = self.base_cooldown
+            elif success is False:
+                self._failures += 1
+                if probe or self._failures == self.failure_threshold:
+                    cooldown = min(max(self._cooldown, retry_after or 0), self.max_cooldown)
+                    self._open_until = time.monotonic() + cooldown
+                    self.trips += 1
+                    logger.warning(f"🔌 Serveur {self.host}: {self._failures} erreurs consécutives, "
+                                   f"pause de {cooldown:.0f}s (les autres serveurs continuent)")
+                    self._cooldown = min(self._cooldown * 2, self.max_cooldown)
+            self._cond.notify_all()
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """Adaptateur HTTP avec un pool de connexions keep-alive par serveur, dimensionné
+    pour le parallélisme configuré, et des statistiques d'utilisation.
+
+    Le pool par défaut de requests (10 connexions par hôte) est plus petit que le
+    nombre de threads qui interrogent un même serveur (magasins x pages,
+    enrichissements à 20 threads de STATS_VENTE): les connexions en trop sont
+    fermées après usage ("Connection pool is full, discarding connection") et
+    chaque nouvelle requête refait une poignée de main TLS.
+    """
+
+    def __init__(self, pool_maxsize, pool_hosts=50):
+        self.pool_maxsize_per_host = pool_maxsize
+        self._stats_lock = threading.Lock()
+        self._requests = defaultdict(int)
+        self._in_flight = defaultdict(int)
+        self._peak = defaultdict(int)
+        self._guards = {}
+        super().__init__(pool_connections=pool_hosts, pool_maxsize=pool_maxsize)
+
+    def guard(self, host):
+        """Limiteur et disjoncteur du serveur (créé au premier appel)"""
+        with self._stats_lock:
+            guard = self._guards.get(host)
+            if guard is None:
+                guard = self._guards[host] = ServerGuard(
+                    host,
+                    rate=get_env_int('SERVER_RATE_LIMIT', 20),
+                    max_in_flight=get_env_int('SERVER_MAX_IN_FLIGHT', 0) or self.pool_maxsize_per_host,
+                    failure_threshold=get_env_int('CIRCUIT_FAILURES', 5),
+                    cooldown=get_env_int('CIRCUIT_COOLDOWN', 30),
+                    max_cooldown=get_env_int('CIRCUIT_MAX_COOLDOWN', 300),
+                )
+            return guard
+
+    def send(self, request, **kwargs):
+        host = urlparse(request.url).netloc
+        check_deadline()
+        fixtures = get_http_fixtures()
+        manifest = current_manifest()
+        if fixtures.mode == 'replay':
+            # Aucun accès réseau: réponse enregistrée (ni limiteur ni disjoncteur)
+            with self._stats_lock:
+                self._requests[host] += 1
+            response = fixtures.replay(request)
+            if manifest is not None:
+                manifest.add_request(len(response.content))
+            return response
+        guard = self.guard(host)
+        probe = guard.acquire()
+        with self._stats_lock:
+            self._requests[host] += 1
+            self._in_flight[host] += 1
+            self._peak[host] = max(self._peak[host], self._in_flight[host])
+        success, retry_after = False, None
+        try:
+            # Délai de la requête: appris des temps de réponse de l'endpoint, borné par les échéances
+            tracker = get_latency_tracker()
+            timeout = tracker.timeout(request.url, kwargs.get('timeout'))
+            try:
+                remaining = check_deadline()
+            except DeadlineExceeded:
+                success = None  # ni succès ni erreur du serveur
+                raise
+            capped = remaining is not None and not isinstance(timeout, tuple) and (not timeout or remaining < timeout)
+            kwargs['timeout'] = remaining if capped else timeout
+            started = time.monotonic()
+            try:
+                response = super().send(request, **kwargs)
+            except requests.exceptions.Timeout:
+                # Un délai raccourci par l'échéance ne dit rien de l'endpoint
+                if not capped and not isinstance(timeout, tuple) and timeout:
+                    tracker.record(request.url, timeout)
+                raise
+            # response.elapsed n'est renseigné par la session qu'après le retour de l'adaptateur
+            elapsed = time.monotonic() - started
+            tracker.record(request.url, elapsed)
+            if fixtures.mode == 'record':
+                fixtures.record(request, response, elapsed)
+            if manifest is not None:
+                # Corps lu ici (la session le lirait juste après), sauf en streaming
+                manifest.add_request(0 if kwargs.get('stream') else len(response.content))
+            success = response.status_code < 500 and response.status_code != 429
+            if response.status_code in (429, 503):
+                retry_after = get_retry_after(response)
+            return response
+        finally:
+            guard.release(probe, success, retry_after)
+            with self._stats_lock:
+                self._in_flight[host] -= 1
+
+    def pool_stats(self):
+        """Retourne {hôte: (requêtes, connexions ouvertes, pic de requêtes simultanées,
+        attentes du limiteur, pauses du disjoncteur)}"""
+        pools = self.poolmanager.pools
+        opened = {}
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                host = f"{key.key_host}:{key.key_port}" if key.key_port not in (None, 80, 443) else key.key_host
+                opened[host] = opened.get(host, 0) + pool.num_connections
+        with self._stats_lock:
+            # Pas de limiteur pour un serveur dont les réponses sont rejouées (HTTP_FIXTURES=replay)
+            guards = {host: self._guards.get(host) for host in self._requests}
+            return {host: (count, opened.get(host, 0), self._peak[host],
+                           guards[host].throttled if guards[host] else 0, guards[host].trips if guards[host] else 0)
+                    for host, count in self._requests.items()}
+
+class DeadlineExceeded(requests.exceptions.RequestException):
+    """Échéance du magasin ou de l'exécution atteinte: la requête n'est pas envoyée"""
+
+# Début de l'exécution (RUN_DEADLINE_MINUTES est compté à partir de là)
+_process_started = time.monotonic()
+# Échéance du magasin dont le thread envoie la requête (les threads de pagination
+# ne reçoivent pas le contexte du magasin: PageFetcher la transmet ici)
+_request_deadline = threading.local()
+# (API, magasin) de la requête, pour le classement des enregistrements HTTP (HTTP_FIXTURES)
+_request_scope = threading.local()
+
+def run_deadline():
+    """Échéance de l'exécution (time.monotonic), None si RUN_DEADLINE_MINUTES=0"""
+    minutes = get_env_int('RUN_DEADLINE_MINUTES', 0)
+    return _process_started + minutes * 60 if minutes > 0 else None
+
+def current_deadline():
+    """Échéance la plus proche entre l'exécution et le magasin en cours (None si aucune)"""
+    run = current_shop_run()
+    deadlines = [d for d in (run_deadline(), run.deadline if run else None,
+                             getattr(_request_deadline, 'value', None)) if d]
+    return min(deadlines) if deadlines else None
+
+def check_deadline():
+    """Retourne le temps restant avant l'échéance (None si aucune), lève DeadlineExceeded si dépassée"""
+    deadline = current_deadline()
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("échéance atteinte (SHOP_DEADLINE_MINUTES / RUN_DEADLINE_MINUTES)")
+    return remaining
+
+def request_scope():
+    """(API, magasin) de la requête en cours: ceux transmis par PageFetcher dans
+    les threads de pagination, sinon ceux du contexte (orchestrateur, run_shops_parallel)"""
+    scope = getattr(_request_scope, 'value', None)
+    if scope:
+        return scope
+    run = current_shop_run()
+    return current_api_name(), run.shop_code if run else '_'
+
+def get_retry_after(response):
+    """Délai Retry-After (secondes) d'une réponse 429/503, None si absent ou illisible"""
+    try:
+        return float(response.headers.get('Retry-After', ''))
+    except ValueError:
+        return None
+
+def get_http_pool_size():
+    """Taille du pool de connexions par serveur (HTTP_POOL_SIZE, 0 = automatique).
+
+    En automatique: SHOPS_PER_SERVER magasins simultanés par serveur, chacun avec
+    au plus max(PAGE_WORKERS, ENRICH_WORKERS, 20 threads d'enrichissement) requêtes.
+    """
+    size = get_env_int('HTTP_POOL_SIZE', 0)
+    if size > 0:
+        return size
+    per_shop = max(get_env_int('PAGE_WORKERS', 4), get_env_int('ENRICH_WORKERS', 4), 20)
+    return max(1, get_env_int('SHOPS_PER_SERVER', 2)) * per_shop
+
+# Sessions HTTP partagées par identifiants: magasins et APIs d'un même processus
+# réutilisent les mêmes connexions vers chaque serveur posN
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+def get_http_session(username, password):
+    """Retourne la session HTTP partagée pour ces identifiants (créée au premier appel).
+
+    Une session contient un pool de connexions keep-alive par serveur
+    (PooledHTTPAdapter), sûr entre threads pour les requêtes de ce projet.
+    """
+    with _http_sessions_lock:
+        session = _http_sessions.get((username, password))
+        if session is None:
+            session = requests.Session()
+            session.auth = (username, password)
+            session.verify = False
+            adapter = PooledHTTPAdapter(get_http_pool_size())
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_sessions[(username, password)] = session
+        return session
+
+def log_http_pool_stats():
+    """Affiche l'utilisation des pools de connexions de toutes les sessions partagées"""
+    with _http_sessions_lock:
+        adapters = {id(a): a for s in _http_sessions.values() for a in s.adapters.values()
+                    if isinstance(a, PooledHTTPAdapter)}
+    for adapter in adapters.values():
+        stats = adapter.pool_stats()
+        if not stats:
+            continue
+        logger.info(f"📡 Pool HTTP ({adapter.pool_maxsize_per_host} connexions max par serveur):")
+        for host, (count, opened, peak, throttled, trips) in sorted(stats.items()):
+            reuse = (count - opened) * 100 // count if count else 0
+            logger.info(f"   {host}: {count:,} requêtes, {opened} connexions ouvertes "
+                        f"({reuse}% réutilisées), pic {peak} simultanées, "
+                        f"{throttled} attentes du limiteur, {trips} pause(s) du disjoncteur")
+            if peak > adapter.pool_maxsize_per_host:
+                logger.warning(f"   ⚠️ {host}: pic supérieur au pool, augmenter HTTP_POOL_SIZE")
+    get_latency_tracker().log_summary()
+    get_http_fixtures().log_summary()
+
+def _run_shop(process_shop, run):
+    """Exécute process_shop(shop_code) avec son ShopRun comme contexte courant"""
+    token = _current_shop_run.set(run)
+    success = False
+    try:
+        success = process_shop(run.shop_code)
+        if success and not run.incomplete:
+            # Export terminé et complet: les points de reprise du magasin ne servent plus.
+            # S'il manque des pages, ils sont gardés pour ne redemander que celles-ci.
+            for checkpoint in run.checkpoints:
+                checkpoint.clear()
+        return success
+    finally:
+        _current_shop_run.reset(token)
+        if run.manifest is not None:
+            run.manifest.finish(success, run.incomplete)
+            get_run_manifests().write_shop(run.manifest)
+
+# Magasins en cours par serveur, pour tout le processus: quand plusieurs APIs
+# tournent en même temps (orchestrateur), SHOPS_PER_SERVER reste une limite globale
+_active_per_server = defaultdict(int)
+_active_per_server_cond = threading.Condition()
+
+def run_shops_parallel(shop_codes, shop_config, process_shop, max_workers=None, per_server=None):
+    """Exécute process_shop(shop_code) pour tous les magasins, en parallèle.
+
+    Les magasins de serveurs différents tournent en même temps (SHOP_WORKERS
+    dans config.env, 8 par défaut), mais jamais plus de SHOPS_PER_SERVER
+    magasins (2 par défaut) ne sollicitent le même serveur simultanément,
+    toutes APIs confondues si plusieurs extractions tournent dans le processus.
+    Un magasin n'occupe un thread que lorsqu'il peut réellement démarrer:
+    un serveur saturé ne bloque pas les magasins des autres serveurs.
+
+    Retourne un dict {shop_code: Future}. future.result() renvoie le résultat
+    de process_shop ou relève l'exception qu'il a levée.
+    SHOP_WORKERS=1 restaure l'exécution séquentielle d'origine.
+    """
+    max_workers = max(1, max_workers or get_env_int('SHOP_WORKERS', 8))
+    per_server = max(1, per_server or get_env_int('SHOPS_PER_SERVER', 2))
 
+    waiting = list(shop_codes)
+    running = {}
+    results = {}
+    runs = {}
+    started = time.monotonic()
 
+    logger.info(f"🚀 Lancement de {len(waiting)} magasins: {max_workers} en parallèle, {per_server} max par serveur")
 
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='shop') as executor:
+        while waiting or running:
+            # Démarrer tous les magasins dont le serveur a encore de la capacité
+            with _active_per_server_cond:
+                deadline = run_deadline()
+                if waiting and deadline is not None and time.monotonic() >= deadline:
+                    # Échéance de l'exécution: les magasins pas encore démarrés sont abandonnés
+                    for shop_code in waiting:
+                        logger.error(f"⏰ Magasin {shop_code} non démarré: échéance de l'exécution atteinte")
+                        runs[shop_code] = ShopRun(shop_code)
+                        runs[shop_code].incomplete = True
+                        if runs[shop_code].manifest is not None:
+                            runs[shop_code].manifest.finish(False, True)
+                        results[shop_code] = Future()
+                        results[shop_code].set_result(False)
+                    waiting = []
+                for shop_code in list(waiting):
+                    if len(running) >= max_workers:
+                        break
+                    server = get_server_key(shop_config.get(shop_code))
+                    if _active_per_server[server] >= per_server:
+                        continue
+                    waiting.remove(shop_code)
+                    _active_per_server[server] += 1
+                    # Le contexte (API en cours...) suit le magasin dans son thread
+                    context = contextvars.copy_context()
+                    runs[shop_code] = ShopRun(shop_code)
+                    future = executor.submit(context.run, _run_shop, process_shop, runs[shop_code])
+                    running[future] = (shop_code, server)
+                    results[shop_code] = future
+                if not running:
+                    # Serveurs occupés par une autre extraction: attendre qu'une place se libère
+                    _active_per_server_cond.wait(timeout=1)
+                    continue
 
+            done, _ = wait(running, timeout=1, return_when=FIRST_COMPLETED)
+            for future in done:
+                shop_code, server = running.pop(future)
+                with _active_per_server_cond:
+                    _active_per_server[server] -= 1
+                    _active_per_server_cond.notify_all()
+                logger.info(f"🏪 Magasin {shop_code} terminé ({len(results) - len(running)}/{len(shop_codes)})")
+
+    log_completeness_summary(runs.values())
+    log_manifest_summary(runs.values(), time.monotonic() - started)
+    get_latency_tracker().save()
+    if not _current_api.get():
+        # Extraction seule: bilan des connexions en fin d'exécution
+        # (avec l'orchestrateur, il est affiché une fois toutes les APIs terminées)
+        log_http_pool_stats()
+    return results
+
+def log_completeness_summary(runs):
+    """Bilan de complétude: magasins dont des pages n'ont pas pu être récupérées"""
+    runs = list(runs)
+    incomplete = [run for run in runs if run.incomplete]
+    if not incomplete:
+        logger.info(f"📋 Complétude: {len(runs)}/{len(runs)} magasins complets, aucune page manquante")
+        return
+    logger.warning(f"📋 Complétude: {len(runs) - len(incomplete)}/{len(runs)} magasins complets")
+    for run in incomplete:
+        if not run.missing_pages:
+            logger.warning(f"   ❌ Magasin {run.shop_code}: extraction incomplète")
+        for url, pages in run.missing_pages:
+            logger.warning(f"   ❌ Magasin {run.shop_code}: {len(pages)} page(s) manquante(s) de {url}: {pages}")
+
+def log_manifest_summary(runs, wall_seconds):
+    """Bilan des durées par étape et magasins les plus longs, écrit dans le manifeste de l'API"""
+    manifests = [run.manifest for run in runs if run.manifest is not None]
+    if not manifests:
+        return
+    summary = get_run_manifests().write_summary(current_api_name(), manifests, wall_seconds)
+    stages = ", ".join(f"{name} {stats['seconds']:.1f}s" for name, stats in
+                       sorted(summary['stages'].items(), key=lambda item: -item[1]['seconds']))
+    logger.info(f"⏱️ Étapes (cumul des {summary['shops']} magasins, {summary['shop_seconds']:.1f}s): "
+                f"{stages or 'aucune'}, autres {summary['other_seconds']:.1f}s")
+    logger.info(f"   {summary['requests']:,} requêtes, {summary['bytes_received'] / 1_048_576:.1f} Mo reçus, "
+                f"{summary['rows_in']:,} lignes reçues, {summary['rows_out']:,} exportées, "
+                f"{summary['retries']} nouvel(s) essai(s)")
+    slowest = ", ".join(f"{shop['shop']} {shop['duration_seconds']:.1f}s ({shop['main_stage']})"
+                        for shop in summary['slowest_shops'][:5])
+    logger.info(f"🐢 Magasins les plus longs: {slowest}")
+    logger.info(f"🧾 Manifestes: {os.path.join(get_run_manifests().directory, summary['api'])}")
+
+def extract_object_id(value):
+    """Retourne l'ID (str) d'un objet Prosuma imbriqué: dict avec 'id' ou URL .../<id>/"""
+    if isinstance(value, dict):
+        object_id = value.get('id')
+        return str(object_id) if object_id else None
+    if isinstance(value, str):
+        object_id = value.rstrip('/').split('/')[-1]
+        return object_id or None
+    return None
+
+class SingleFlight:
+    """Un seul appel en cours par clé: les appels concurrents attendent son résultat.
+
+    Les résultats sont conservés pour la durée de l'exécution (les magasins d'un
+    même serveur partagent ainsi fournisseurs, commandes...). Un résultat None
+    (échec) n'est pas conservé: l'appel suivant réessaiera.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = Future()
+        if owner:
+            try:
+                result = fn(*args)
+            except Exception as e:
+                with self._lock:
+                    del self._futures[key]
+                future.set_exception(e)
+                raise
+            if result is None:
+                with self._lock:
+                    del self._futures[key]
+            future.set_result(result)
+        return future.result()
+
+_batch_filter_support = {}
+
+def fetch_objects_by_ids(session, base_url, endpoint, ids, fetch_one, timeout=30,
+                         batch_size=None, max_workers=None):
+    """Récupère les objets /api/<endpoint>/ d'un ensemble d'IDs.
+
+    Les IDs sont demandés par lots sur l'endpoint liste (?id__in=1,2,3,
+    ENRICH_BATCH_SIZE IDs par lot, 100 par défaut), plusieurs lots en parallèle
+    (ENRICH_WORKERS, 4 par défaut). Si le serveur ignore ce filtre (il renvoie
+    d'autres objets que ceux demandés), il est mémorisé comme tel et les IDs
+    sont récupérés un par un avec fetch_one(id), toujours en parallèle. Les
+    IDs absents d'un lot pourtant reçu sont eux aussi redemandés un par un.
+
+    Retourne {id (str): objet} pour les objets trouvés.
+    """
+    ids = sorted({str(i) for i in ids if i})
+    if not ids:
+        return {}
+    batch_size = max(1, batch_size or get_env_int('ENRICH_BATCH_SIZE', 100))
+    max_workers = max(1, max_workers or get_env_int('ENRICH_WORKERS', 4))
+    url = f"{base_url.rstrip('/')}/api/{endpoint}/"
+    support_key = (base_url.rstrip('/'), endpoint)
+
+    def fetch_batch(chunk):
+        """Retourne {id: objet} ou None si le filtre par lot n'est pas utilisable"""
+        if _batch_filter_support.get(support_key) is False:
+            return None
+        try:
+            response = session.get(url, params={'id__in': ','.join(chunk), 'page_size': len(chunk)},
+                                   timeout=timeout)
+            if response.status_code != 200:
+                return None
+            data = response.json()
+        except Exception as e:
+            logger.debug(f"⚠️ Lot /api/{endpoint}/ indisponible: {e}")
+            return None
+        items = data.get('results', []) if isinstance(data, dict) else data
+        found = {str(item.get('id')): item for item in items if isinstance(item, dict)}
+        total = data.get('count', len(items)) if isinstance(data, dict) else len(items)
+        if total > len(chunk) or not set(found) <= set(chunk):
+            if _batch_filter_support.get(support_key) is not False:
+                logger.info(f"   ℹ️ Filtre id__in ignoré par {url}, récupération unitaire")
+            _batch_filter_support[support_key] = False
+            return None
+        _batch_filter_support[support_key] = True
+        return found
+
+    results = {}
+    remaining = []
+    chunks = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+    with stage('enrichment'):
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+            for chunk, found in zip(chunks, executor.map(with_current_context(fetch_batch), chunks)):
+                if found is None:
+                    remaining.extend(chunk)
+                else:
+                    results.update(found)
+                    # IDs absents de la réponse (filtre partiel, page tronquée): un par un
+                    remaining.extend(object_id for object_id in chunk if object_id not in found)
+
+        if remaining:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(remaining))) as executor:
+                for object_id, obj in zip(remaining, executor.map(with_current_context(fetch_one), remaining)):
+                    if obj:
+                        results[object_id] = obj
+    return results
+
+class JsonFileCache:
+    """Cache clé/valeur persistant dans un fichier JSON, avec durée de vie (TTL).
+
+    Chaque entrée est stockée avec sa date d'enregistrement et ignorée une fois
+    expirée. Les accès sont protégés par un verrou (magasins en parallèle) et
+    l'écriture est atomique (fichier temporaire puis remplacement). À la
+    sauvegarde, les entrées déjà présentes sur disque sont fusionnées, pour ne
+    pas écraser ce qu'un autre script a enregistré entre-temps.
+    """
+
+    def __init__(self, path, ttl_seconds):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = self._load()
+        self._dirty = False
+
+    def _load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if isinstance(data, dict):
+                    return data
+        except Exception as e:
+            logger.warning(f"⚠️ Cache illisible, ignoré: {self.path} ({e})")
+        return {}
+
+    def _is_fresh(self, entry):
+        return (
+            isinstance(entry, dict)
+            and time.time() - entry.get('cached_at', 0) < self.ttl_seconds
+        )
+
+    def get(self, key):
+        """Retourne la valeur associée à la clé, ou None si absente ou expirée"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry['value'] if self._is_fresh(entry) else None
+
+    def set_many(self, items):
+        """Enregistre plusieurs valeurs (dict clé -> valeur) en mémoire"""
+        now = time.time()
+        with self._lock:
+            for key, value in items.items():
+                self._entries[key] = {'value': value, 'cached_at': now}
+            self._dirty = True
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def save(self):
+        """Écrit le cache sur disque (si modifié), sans les entrées expirées"""
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = self._load()
+            for key, entry in self._entries.items():
+                if entry.get('cached_at', 0) >= entries.get(key, {}).get('cached_at', 0):
+                    entries[key] = entry
+            entries = {key: entry for key, entry in entries.items() if self._is_fresh(entry)}
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(entries, f, ensure_ascii=False, indent=1)
+                os.replace(tmp_path, self.path)
+                self._entries = entries
+                self._dirty = False
+            except Exception as e:
+                logger.warning(f"⚠️ Impossible d'enregistrer le cache {self.path}: {e}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+def iter_list_endpoint(session, url, page_size=1000, timeout=30):
+    """Parcourt tous les objets d'un endpoint liste Prosuma en suivant les liens "next".
+
+    Lève une exception si une page ne peut pas être lue.
+    """
+    params = {'page_size': page_size}
+    while url:
+        response = session.get(url, params=params, timeout=timeout)
+        if response.status_code != 200:
+            raise RuntimeError(f"{url}: HTTP {response.status_code}")
+        data = response.json()
+        yield from (data.get('results', []) if isinstance(data, dict) else data)
+        # L'URL "next" contient déjà les paramètres de la page suivante
+        url = data.get('next') if isinstance(data, dict) else None
+        params = None
+
+class ShopIdCache:
+    """Résolution code magasin -> ID Prosuma, mise en cache par (serveur, code magasin).
+
+    Le cache est stocké à côté de magasins.json (shop_id_cache.json) et ses
+    entrées expirent après SHOP_CACHE_TTL_HOURS heures (168 par défaut).
+    Au premier magasin manquant d'un serveur, la liste /api/shop/ de ce
+    serveur est lue une seule fois et tous ses magasins sont mis en cache:
+    les autres magasins du même serveur sont ensuite résolus sans requête.
+    """
+
+    FILENAME = 'shop_id_cache.json'
+
+    def __init__(self, path=None, ttl_hours=None):
+        if path is None:
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), self.FILENAME)
+        if ttl_hours is None:
+            ttl_hours = get_env_int('SHOP_CACHE_TTL_HOURS', 168)
+        self.cache = JsonFileCache(path, ttl_hours * 3600)
+        self._server_locks = defaultdict(threading.Lock)
+        self._warmed_servers = set()
+
+    @staticmethod
+    def _key(base_url, shop_code):
+        return f"{base_url.rstrip('/')}|{shop_code}"
+
+    @staticmethod
+    def _shop_entry(shop):
+        return {'id': shop.get('id'), 'name': shop.get('name'), 'reference': shop.get('reference')}
+
+    def warm_up(self, session, base_url):
+        """Met en cache tous les magasins d'un serveur (une seule fois par serveur)"""
+        base_url = base_url.rstrip('/')
+        with self._server_locks[base_url]:
+            if base_url in self._warmed_servers:
+                return
+            self._warmed_servers.add(base_url)
+
+            entries = {}
+            try:
+                for shop in iter_list_endpoint(session, f"{base_url}/api/shop/"):
+                    if shop.get('reference') is not None and shop.get('id') is not None:
+                        entries[self._key(base_url, shop['reference'])] = self._shop_entry(shop)
+            except Exception as e:
+                logger.warning(f"⚠️ Erreur lors du préchargement des magasins de {base_url}: {e}")
+
+            if entries:
+                self.cache.set_many(entries)
+                self.cache.save()
+                logger.info(f"📋 {len(entries)} magasins mis en cache pour {base_url}")
+
+    def resolve(self, session, base_url, shop_code, lookup):
+        """Retourne {'id', 'name', 'reference'} du magasin, ou None.
+
+        Ordre: cache disque, préchargement du serveur, puis lookup(base_url, shop_code)
+        (la méthode get_shop_info de l'extracteur) en dernier recours.
+        """
+        key = self._key(base_url, shop_code)
+        shop = self.cache.get(key)
+        if shop:
+            logger.info(f"✅ Magasin {shop_code} trouvé (cache): {shop.get('name', 'N/A')}")
+            return shop
+
+        self.warm_up(session, base_url)
+        shop = self.cache.get(key)
+        if shop:
+            logger.info(f"✅ Magasin {shop_code} trouvé: {shop.get('name', 'N/A')}")
+            return shop
+
+        shop_data = lookup(base_url, shop_code)
+        if shop_data and shop_data.get('id') is not None:
+            self.cache.set(key, self._shop_entry(shop_data))
+            self.cache.save()
+        return shop_data
+
+_shop_id_cache = None
+_shop_id_cache_lock = threading.Lock()
+
+def get_cached_shop_info(session, base_url, shop_code, lookup):
+    """Résout un magasin via le cache partagé ShopIdCache (SHOP_CACHE_TTL_HOURS=0 le désactive)"""
+    global _shop_id_cache
+    with stage('shop_resolution'):
+        if get_env_int('SHOP_CACHE_TTL_HOURS', 168) <= 0:
+            return lookup(base_url, shop_code)
+        with _shop_id_cache_lock:
+            if _shop_id_cache is None:
+                _shop_id_cache = ShopIdCache()
+        return _shop_id_cache.resolve(session, base_url, shop_code, lookup)
+
+class SupplierCache:
+    """Fournisseurs Prosuma mis en cache par (serveur, ID fournisseur).
+
+    Les fournisseurs sont communs à tous les magasins d'un serveur posN et
+    changent rarement (is_central). Le cache est stocké à côté de
+    magasins.json (supplier_cache.json) et ses entrées expirent après
+    SUPPLIER_CACHE_TTL_HOURS heures (24 par défaut). Au premier fournisseur
+    manquant d'un serveur, la liste /api/supplier/ complète est chargée une
+    seule fois; les fournisseurs encore absents sont ensuite demandés
+    individuellement.
+    """
+
+    FILENAME = 'supplier_cache.json'
+
+    def __init__(self, path=None, ttl_hours=None):
+        if path is None:
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), self.FILENAME)
+        if ttl_hours is None:
+            ttl_hours = get_env_int('SUPPLIER_CACHE_TTL_HOURS', 24)
+        self.cache = JsonFileCache(path, ttl_hours * 3600)
+        self._server_locks = defaultdict(threading.Lock)
+        self._preloaded_servers = set()
+        self._flight = SingleFlight()
+
+    @staticmethod
+    def _key(base_url, supplier_id):
+        return f"{base_url.rstrip('/')}|{supplier_id}"
+
+    def _from_cache(self, base_url, supplier_ids):
+        suppliers = {}
+        for supplier_id in supplier_ids:
+            supplier = self.cache.get(self._key(base_url, supplier_id))
+            if supplier:
+                suppliers[supplier_id] = supplier
+        return suppliers
+
+    def preload(self, session, base_url):
+        """Met en cache tous les fournisseurs d'un serveur (une seule fois par serveur)"""
+        base_url = base_url.rstrip('/')
+        with self._server_locks[base_url]:
+            if base_url in self._preloaded_servers:
+                return
+            self._preloaded_servers.add(base_url)
+
+            entries = {}
+            try:
+                for supplier in iter_list_endpoint(session, f"{base_url}/api/supplier/"):
+                    if supplier.get('id') is not None:
+                        entries[self._key(base_url, supplier['id'])] = supplier
+            except Exception as e:
+                logger.warning(f"⚠️ Erreur lors du préchargement des fournisseurs de {base_url}: {e}")
+
+            if entries:
+                self.cache.set_many(entries)
+                self.cache.save()
+                logger.info(f"📋 {len(entries)} fournisseurs mis en cache pour {base_url}")
+
+    def get_many(self, session, base_url, supplier_ids, lookup):
+        """Retourne {id (str): fournisseur} pour les IDs demandés.
+
+        Ordre: cache disque, préchargement du serveur, puis lookup(base_url, id)
+        (la méthode get_supplier_info de l'extracteur) pour les derniers absents.
+        """
+        supplier_ids = {str(i) for i in supplier_ids if i}
+        suppliers = self._from_cache(base_url, supplier_ids)
+        if len(suppliers) < len(supplier_ids):
+            self.preload(session, base_url)
+            suppliers.update(self._from_cache(base_url, supplier_ids - set(suppliers)))
+
+        missing = supplier_ids - set(suppliers)
+        if not missing:
+            return suppliers
+        fetched = fetch_objects_by_ids(
+            session, base_url, 'supplier', missing,
+            lambda supplier_id: self._flight.do((base_url, supplier_id), lookup, base_url, supplier_id)
+        )
+        if fetched:
+            self.cache.set_many({self._key(base_url, i): supplier for i, supplier in fetched.items()})
+            self.cache.save()
+            suppliers.update(fetched)
+        return suppliers
+
+_supplier_cache = None
+_supplier_cache_lock = threading.Lock()
+
+def get_cached_suppliers(session, base_url, supplier_ids, lookup):
+    """Fournisseurs via le cache partagé SupplierCache (SUPPLIER_CACHE_TTL_HOURS=0 le désactive)"""
+    global _supplier_cache
+    with stage('enrichment'):
+        if get_env_int('SUPPLIER_CACHE_TTL_HOURS', 24) <= 0:
+            return fetch_objects_by_ids(session, base_url, 'supplier', supplier_ids,
+                                        lambda supplier_id: lookup(base_url, supplier_id))
+        with _supplier_cache_lock:
+            if _supplier_cache is None:
+                _supplier_cache = SupplierCache()
+        return _supplier_cache.get_many(session, base_url, supplier_ids, lookup)
+
+class LookupCache:
+    """Cache persistant (SQLite) des objets de référence consultés un par un.
+
+    Utilisé pour les produits et tickets de STATS_VENTE: les noms et codes-barres
+    changent rarement, inutile de les redemander à chaque exécution. Les entrées
+    sont rangées par espace de noms (ex: 'product|<serveur>'), expirent après
+    LOOKUP_CACHE_TTL_HOURS heures (168 par défaut) et, au-delà de
+    LOOKUP_CACHE_MAX_ENTRIES entrées (200000 par défaut), les moins récemment
+    utilisées sont supprimées (LRU). Le fichier lookup_cache.sqlite est stocké
+    à côté de magasins.json.
+    """
+
+    FILENAME = 'lookup_cache.sqlite'
+
+    def __init__(self, path=None, ttl_hours=None, max_entries=None):
+        if path is None:
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), self.FILENAME)
+        if ttl_hours is None:
+            ttl_hours = get_env_int('LOOKUP_CACHE_TTL_HOURS', 168)
+        if max_entries is None:
+            max_entries = get_env_int('LOOKUP_CACHE_MAX_ENTRIES', 200000)
+        self.path = path
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # Plusieurs scripts peuvent utiliser le même fichier: attendre le verrou SQLite
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS lookup ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+                " cached_at REAL NOT NULL, accessed_at REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS lookup_accessed ON lookup (accessed_at)")
+
+    def get_many(self, namespace, keys):
+        """Retourne {clé: valeur} pour les clés présentes et non expirées"""
+        keys = [str(k) for k in keys]
+        found = {}
+        now = time.time()
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM lookup WHERE namespace = ? AND cached_at >= ?"
+                    f" AND key IN ({','.join('?' * len(chunk))})",
+                    [namespace, now - self.ttl_seconds, *chunk]
+                ).fetchall()
+                found.update((key, json.loads(value)) for key, value in rows)
+            if found:
+                with self._conn:
+                    self._conn.executemany(
+                        "UPDATE lookup SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                        [(now, namespace, key) for key in found]
+                    )
+        return found
+
+    def set_many(self, namespace, values):
+        """Enregistre {clé: valeur} puis applique l'expiration et la limite LRU"""
+        if not values:
+            return
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO lookup (namespace, key, value, cached_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [(namespace, str(key), json.dumps(value, ensure_ascii=False), now, now)
+                 for key, value in values.items()]
+            )
+            self._conn.execute("DELETE FROM lookup WHERE cached_at < ?", (now - self.ttl_seconds,))
+            excess = self._conn.execute("SELECT COUNT(*) FROM lookup").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._conn.execute(
+                    "DELETE FROM lookup WHERE rowid IN"
+                    " (SELECT rowid FROM lookup ORDER BY accessed_at LIMIT ?)", (excess,)
+                )
+
+    def lookup(self, namespace, keys, fetch_one, max_workers=20):
+        """Retourne {clé: valeur}: depuis le cache, et fetch_one(clé) en parallèle pour les absentes.
+
+        Les valeurs récupérées sont ajoutées au cache; un échec (None) n'est pas mis en cache.
+        """
+        keys = {str(k) for k in keys if k is not None and k != ''}
+        found = self.get_many(namespace, keys)
+        missing = sorted(keys - set(found))
+        if missing:
+            fetched = {}
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(missing)))) as executor:
+                for key, value in zip(missing, executor.map(with_current_context(fetch_one), missing)):
+                    if value is not None:
+                        fetched[key] = value
+            self.set_many(namespace, fetched)
+            found.update(fetched)
+        return found
+
+_lookup_cache = None
+_lookup_cache_lock = threading.Lock()
+
+def cached_lookup(namespace, keys, fetch_one, max_workers=20):
+    """Résout des clés via le cache partagé LookupCache (LOOKUP_CACHE_TTL_HOURS=0 le désactive).
+
+    Retourne {clé (str): valeur} pour les clés trouvées.
+    """
+    global _lookup_cache
+    with stage('enrichment'):
+        if get_env_int('LOOKUP_CACHE_TTL_HOURS', 168) <= 0:
+            keys = sorted({str(k) for k in keys if k is not None and k != ''})
+            if not keys:
+                return {}
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(keys)))) as executor:
+                return {key: value for key, value in zip(keys, executor.map(with_current_context(fetch_one), keys))
+                        if value is not None}
+        with _lookup_cache_lock:
+            if _lookup_cache is None:
+                _lookup_cache = LookupCache()
+        return _lookup_cache.lookup(namespace, keys, fetch_one, max_workers)
+
+class RecordSpool:
+    """Liste d'enregistrements stockée sur disque au fil des pages (format JSON lines).
+
+    Remplace la liste all_data des extracteurs: chaque page est écrite dans un
+    fichier temporaire dès sa réception, et la mémoire reste bornée à une page.
+    L'objet se comporte comme une liste en lecture séquentielle (len, bool,
+    itérations multiples), ce qui permet aux export_to_csv existants, y compris
+    ceux qui détectent les colonnes en parcourant toutes les lignes, de
+    l'utiliser tel quel.
+
+    STREAM_EXPORT=False dans config.env conserve les enregistrements en mémoire.
+    Le fichier temporaire est supprimé par close() ou quand l'objet est libéré.
+    """
+
+    def __init__(self, records=None):
+        self.count = 0
+        self._memory = None
+        self._file = None
+        if get_env_bool('STREAM_EXPORT', True):
+            self._file = tempfile.NamedTemporaryFile(
+                mode='w+', encoding='utf-8', prefix='prosuma_', suffix='.jsonl', delete=False
+            )
+            self._finalizer = weakref.finalize(self, RecordSpool._cleanup, self._file)
+        else:
+            self._memory = []
+        if records:
+            self.extend(records)
+
+    @staticmethod
+    def _cleanup(spool_file):
+        try:
+            spool_file.close()
+            os.remove(spool_file.name)
+        except OSError:
+            pass
+
+    def extend(self, records):
+        """Ajoute les enregistrements d'une page"""
+        if self._memory is not None:
+            self._memory.extend(records)
+            self.count = len(self._memory)
+            return
+        for record in records:
+            self._file.write(json.dumps(record, ensure_ascii=False, default=str))
+            self._file.write('\n')
+            self.count += 1
+
+    def append(self, record):
+        self.extend([record])
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+    def __iter__(self):
+        if self._memory is not None:
+            yield from self._memory
+            return
+        self._file.flush()
+        with open(self._file.name, 'r', encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def close(self):
+        """Supprime le fichier temporaire"""
+        if self._file is not None:
+            self._finalizer()
+
+class HighWaterMarks:
+    """Points de reprise de l'extraction incrémentale, par (API, serveur, magasin).
+
+    Le point de reprise est la date la plus récente (champ 'date') des
+    enregistrements exportés. Il est stocké dans high_water_marks.json, à côté
+    de magasins.json, et n'avance qu'après un export réussi et complet.
+    """
+
+    FILENAME = 'high_water_marks.json'
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), self.FILENAME)
+        # Pas d'expiration: un point de reprise reste valable jusqu'au suivant
+        self.store = JsonFileCache(path, float('inf'))
+
+    @staticmethod
+    def _key(api_name, base_url, shop_id):
+        return f"{api_name}|{base_url.rstrip('/')}|{shop_id}"
+
+    def get(self, api_name, base_url, shop_id):
+        value = self.store.get(self._key(api_name, base_url, shop_id))
+        return datetime.fromisoformat(value) if value else None
+
+    def update(self, api_name, base_url, shop_id, value):
+        current = self.get(api_name, base_url, shop_id)
+        if current is None or value > current:
+            self.store.set(self._key(api_name, base_url, shop_id), value.isoformat())
+            self.store.save()
+            return True
+        return False
+
+class PageSizeTuner:
+    """page_size appris par (serveur, endpoint), d'une exécution à la suivante.
+
+    Chaque page reçue est mesurée (temps de réponse du serveur, octets, nombre
+    d'enregistrements). En fin de pagination, le page_size qui donnerait des
+    pages d'environ PAGE_TARGET_SECONDS secondes et d'au plus PAGE_MAX_MB Mo
+    est calculé, borné entre PAGE_SIZE_MIN et PAGE_SIZE_MAX, et au plus doublé
+    ou divisé par deux à chaque exécution. Après un timeout, il est divisé par
+    deux. Une limite imposée par le serveur n'est jamais dépassée.
+
+    La valeur est enregistrée dans page_size_tuning.json (à côté de
+    magasins.json) et utilisée par l'exécution suivante: pendant une exécution,
+    le page_size d'un endpoint ne change pas (les numéros de page en dépendent).
+    """
+
+    FILENAME = 'page_size_tuning.json'
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), self.FILENAME)
+        self.store = JsonFileCache(path, float('inf'))
+        self.min_size = max(1, get_env_int('PAGE_SIZE_MIN', 100))
+        self.max_size = max(self.min_size, get_env_int('PAGE_SIZE_MAX', 5000))
+        self.target_seconds = max(1, get_env_int('PAGE_TARGET_SECONDS', 10))
+        self.max_bytes = max(1, get_env_int('PAGE_MAX_MB', 10)) * 1024 * 1024
+        self._lock = threading.Lock()
+        self._run_sizes = {}
+        self._samples = defaultdict(list)
+        self._timeouts = defaultdict(int)
+        self._caps = {}
+
+    @staticmethod
+    def _key(url):
+        parsed = urlparse(url)
+        return f"{parsed.netloc}{parsed.path.rstrip('/')}"
+
+    def page_size(self, url, default):
+        """page_size à utiliser pour cet endpoint pendant toute l'exécution"""
+        key = self._key(url)
+        with self._lock:
+            if key not in self._run_sizes:
+                learned = self.store.get(key) or {}
+                size = learned.get('page_size') or default
+                cap = learned.get('cap')
+                self._run_sizes[key] = min(size, cap) if cap else size
+            return self._run_sizes[key]
+
+    def record(self, url, items, seconds, size_bytes):
+        """Mesure d'une page reçue"""
+        if items > 0:
+            with self._lock:
+                self._samples[self._key(url)].append((seconds / items, size_bytes / items))
+
+    def record_timeout(self, url):
+        with self._lock:
+            self._timeouts[self._key(url)] += 1
+
+    def record_cap(self, url, cap):
+        """page_size maximum accepté par le serveur pour cet endpoint"""
+        with self._lock:
+            key = self._key(url)
+            self._caps[key] = min(cap, self._caps.get(key, cap))
+
+    def learn(self, url):
+        """Calcule et enregistre le page_size de la prochaine exécution"""
+        key = self._key(url)
+        with self._lock:
+            current = self._run_sizes.get(key)
+            samples = list(self._samples[key])
+            timeouts = self._timeouts[key]
+            learned = self.store.get(key) or {}
+            cap = min(filter(None, (self._caps.get(key), learned.get('cap'))), default=None)
+        if current is None or (not samples and not timeouts):
+            return
+
+        if timeouts:
+            size = current // 2
+        else:
+            seconds_per_item = sorted(sample[0] for sample in samples)[len(samples) // 2]
+            bytes_per_item = sorted(sample[1] for sample in samples)[len(samples) // 2]
+            size = min(self.target_seconds / max(seconds_per_item, 1e-6),
+                       self.max_bytes / max(bytes_per_item, 1))
+            size = max(current / 2, min(current * 2, size))
+        size = max(self.min_size, min(self.max_size, int(size) // 100 * 100 or self.min_size))
+        if cap:
+            size = min(size, cap)
+
+        if size != learned.get('page_size') or cap != learned.get('cap'):
+            self.store.set(key, {'page_size': size, 'cap': cap})
+            self.store.save()
+            if size != current:
+                reason = f"{timeouts} timeout(s)" if timeouts else f"{len(samples)} page(s) mesurée(s)"
+                logger.info(f"📐 page_size {key}: {current} -> {size} à la prochaine exécution ({reason})")
+
+_page_size_tuner = None
+_page_size_tuner_lock = threading.Lock()
+
+def get_page_size_tuner():
+    global _page_size_tuner
+    with _page_size_tuner_lock:
+        if _page_size_tuner is None:
+            _page_size_tuner = PageSizeTuner()
+    return _page_size_tuner
+
+class LatencyTracker:
+    """Temps de réponse par (serveur, endpoint) et délai des requêtes qui en découle.
+
+    Les derniers LATENCY_SAMPLES temps de réponse de chaque endpoint (les IDs
+    du chemin sont remplacés par {id}) sont conservés d'une exécution à l'autre
+    dans latency_stats.json, à côté de magasins.json. Dès LATENCY_MIN_SAMPLES
+    mesures, le délai d'une requête vaut p95 x TIMEOUT_P95_FACTOR, borné entre
+    TIMEOUT_MIN et TIMEOUT_MAX secondes; avant, le délai fixé par l'appelant
+    s'applique. Un timeout compte comme une mesure égale au délai accordé, ce
+    qui allonge le délai suivant. PooledHTTPAdapter réduit encore ce délai
+    pour ne pas dépasser l'échéance du magasin ou de l'exécution.
+    """
+
+    FILENAME = 'latency_stats.json'
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), self.FILENAME)
+        self.store = JsonFileCache(path, float('inf'))
+        self.enabled = get_env_bool('ADAPTIVE_TIMEOUT', True)
+        self.max_samples = max(10, get_env_int('LATENCY_SAMPLES', 200))
+        self.min_samples = max(1, get_env_int('LATENCY_MIN_SAMPLES', 20))
+        self.factor = max(1, get_env_int('TIMEOUT_P95_FACTOR', 3))
+        self.min_timeout = max(1, get_env_int('TIMEOUT_MIN', 10))
+        self.max_timeout = max(self.min_timeout, get_env_int('TIMEOUT_MAX', 300))
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    @staticmethod
+    def _key(url):
+        parsed = urlparse(url)
+        path = '/'.join('{id}' if part.isdigit() else part for part in parsed.path.rstrip('/').split('/'))
+        return f"{parsed.netloc}{path}"
+
+    def _get_samples(self, key):
+        if key not in self._samples:
+            self._samples[key] = list(self.store.get(key) or [])
+        return self._samples[key]
+
+    def percentiles(self, url):
+        """Retourne (p50, p95, nombre de mesures) de l'endpoint"""
+        with self._lock:
+            samples = sorted(self._get_samples(self._key(url)))
+        if not samples:
+            return None, None, 0
+        return samples[len(samples) // 2], samples[min(len(samples) - 1, len(samples) * 95 // 100)], len(samples)
+
+    def timeout(self, url, default):
+        """Délai à accorder à une requête (default: délai prévu par l'appelant)"""
+        timeout = default
+        if self.enabled and not isinstance(default, tuple):
+            _, p95, count = self.percentiles(url)
+            if count >= self.min_samples:
+                timeout = max(self.min_timeout, min(self.max_timeout, p95 * self.factor))
+        return timeout
+
+    def record(self, url, seconds):
+        with self._lock:
+            samples = self._get_samples(self._key(url))
+            samples.append(round(seconds, 3))
+            del samples[:-self.max_samples]
+
+    def save(self):
+        """Enregistre les mesures pour les exécutions suivantes"""
+        with self._lock:
+            if not self._samples:
+                return
+            self.store.set_many({key: list(samples) for key, samples in self._samples.items()})
+        self.store.save()
+
+    def log_summary(self):
+        """Affiche p50/p95 et le délai appliqué des endpoints mesurés"""
+        with self._lock:
+            keys = sorted(self._samples)
+        for key in keys:
+            p50, p95, count = self.percentiles(f"//{key}")
+            if count:
+                logger.info(f"   ⏱️ {key}: p50 {p50:.2f}s, p95 {p95:.2f}s sur {count} mesures")
+
+class HttpFixtures:
+    """Enregistrement et rejeu des réponses de l'API (HTTP_FIXTURES=record ou replay).
+
+    En enregistrement, chaque réponse /api/... reçue par la session partagée
+    est écrite, compressée, dans fixtures/<API>/<magasin>/<endpoint>_<page>_<empreinte>.json.gz
+    (à côté de magasins.json, ou dans HTTP_FIXTURES_DIR). Les identifiants ne sont
+    pas conservés: ni en-têtes de requête ni cookies, les paramètres d'URL
+    sensibles (SENSITIVE_PARAMS) sont masqués par leur nom, et toute occurrence
+    de PROSUMA_USER, PROSUMA_PASSWORD ou des identifiants de l'en-tête
+    Authorization (Basic décodé ou jeton), quelle que soit leur longueur, est
+    masquée dans l'URL et la réponse.
+
+    En rejeu, PooledHTTPAdapter sert ces réponses sans accès réseau, avec leur
+    temps de réponse d'origine (HTTP_REPLAY_LATENCY=original) ou sans attente
+    (zero). L'empreinte dépend du serveur, du chemin et des paramètres hors
+    période (date_0/date_1): un enregistrement se rejoue les jours suivants.
+    Une réponse absente lève une ConnectionError, traitée comme une panne réseau.
+    """
+
+    DIRNAME = 'fixtures'
+    IGNORED_PARAMS = ('date_0', 'date_1')
+    SENSITIVE_PARAMS = ('username', 'password', 'token', 'access_token', 'api_key', 'apikey', 'secret',
+                        'auth', 'authorization')
+    KEPT_HEADERS = ('Content-Type', 'Retry-After')
+    MASK = '***'
+
+    def __init__(self, mode='', directory=None, latency='original'):
+        if directory is None:
+            directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), self.DIRNAME)
+        self.mode = mode
+        self.directory = directory
+        self.zero_latency = latency == 'zero'
+        self.recorded = 0
+        self.replayed = 0
+        self.missing = 0
+        self._index = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _digest(cls, url):
+        parsed = urlparse(url)
+        query = sorted((k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+                       if k not in cls.IGNORED_PARAMS and k.lower() not in cls.SENSITIVE_PARAMS)
+        return hashlib.sha1(json.dumps([parsed.netloc, parsed.path, query]).encode('utf-8')).hexdigest()[:16]
+
+    @classmethod
+    def _filename(cls, url):
+        parsed = urlparse(url)
+        query = dict(parse_qsl(parsed.query))
+        path = parsed.path.strip('/')
+        endpoint = (path[4:] if path.startswith('api/') else path).replace('/', '_') or 'api'
+        if 'id__gt' in query:
+            page = f"after{query['id__gt']}"
+        else:
+            page = f"p{query.get('page', 1)}"
+        return f"{endpoint}_{page}_{cls._digest(url)}.json.gz"
+
+    @staticmethod
+    def _secrets(request):
+        """Valeurs à masquer: identifiants configurés et ceux de l'en-tête Authorization"""
+        secrets = {os.getenv('PROSUMA_USER', ''), os.getenv('PROSUMA_PASSWORD', '')}
+        scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+        secrets.add(credentials)
+        if scheme.lower() == 'basic':
+            try:
+                username, _, password = base64.b64decode(credentials).decode('utf-8').partition(':')
+            except ValueError:
+                pass
+            else:
+                secrets.update((username, password))
+        # Les plus longs d'abord: un secret contenu dans un autre ne laisse pas de reste en clair
+        return sorted(filter(None, secrets), key=len, reverse=True)
+
+    def _scrub(self, text, secrets):
+        for secret in secrets:
+            text = text.replace(secret, self.MASK)
+        return text
+
+    def _scrub_url(self, url, secrets):
+        """URL sans identifiants: user:password@ retiré, paramètres sensibles masqués par leur
+        nom, secrets masqués dans le chemin et les autres valeurs"""
+        parsed = urlparse(url)
+        query = [(k, self.MASK if k.lower() in self.SENSITIVE_PARAMS else self._scrub(v, secrets))
+                 for k, v in parse_qsl(parsed.query, keep_blank_values=True)]
+        return parsed._replace(netloc=parsed.netloc.rpartition('@')[2], path=self._scrub(parsed.path, secrets),
+                               query=urlencode(query, safe='*')).geturl()
+
+    def record(self, request, response, elapsed):
+        """Écrit la réponse (identifiants masqués). Sans effet hors /api/"""
+        if not urlparse(request.url).path.startswith('/api/'):
+            return
+        secrets = self._secrets(request)
+        api, shop = request_scope()
+        folder = os.path.join(self.directory, *(''.join(c if c.isalnum() or c in '-_' else '_' for c in part)
+                                                 for part in (api, shop)))
+        fixture = {
+            'method': request.method,
+            'url': self._scrub_url(request.url, secrets),
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': {name: response.headers[name] for name in self.KEPT_HEADERS if name in response.headers},
+            'elapsed': round(elapsed, 3),
+            'body': self._scrub(response.content.decode(response.encoding or 'utf-8', errors='replace'), secrets),
+        }
+        filename = self._filename(request.url)
+        try:
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, filename)
+            with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as f:
+                json.dump(fixture, f, ensure_ascii=False)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            logger.warning(f"⚠️ Enregistrement HTTP impossible ({filename}): {e}")
+            return
+        with self._lock:
+            self.recorded += 1
+            if self._index is not None:
+                self._index[filename] = path
+
+    def _find(self, filename):
+        with self._lock:
+            if self._index is None:
+                # Index construit une fois: une même requête peut avoir été enregistrée
+                # sous une autre API ou hors magasin (ex: extracteur lancé seul)
+                self._index = {}
+                for root, _, files in os.walk(self.directory):
+                    for name in files:
+                        if name.endswith('.json.gz'):
+                            self._index.setdefault(name, os.path.join(root, name))
+            return self._index.get(filename)
+
+    def replay(self, request):
+        """Réponse enregistrée pour cette requête (ConnectionError si absente)"""
+        filename = self._filename(request.url)
+        path = self._find(filename)
+        if path is None:
+            with self._lock:
+                self.missing += 1
+            raise requests.exceptions.ConnectionError(f"Réponse non enregistrée pour {request.url} ({filename})",
+                                                      request=request)
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            fixture = json.load(f)
+        if not self.zero_latency:
+            time.sleep(fixture.get('elapsed', 0))
+        response = requests.Response()
+        response.status_code = fixture['status']
+        response.reason = fixture.get('reason', '')
+        response.headers = CaseInsensitiveDict(fixture.get('headers', {}))
+        response._content = fixture['body'].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        with self._lock:
+            self.replayed += 1
+        return response
+
+    def log_summary(self):
+        if self.mode == 'record':
+            logger.info(f"🎞️ {self.recorded} réponses HTTP enregistrées dans {self.directory}")
+        elif self.mode == 'replay':
+            logger.info(f"🎞️ {self.replayed} réponses HTTP rejouées depuis {self.directory}"
+                        + (f", {self.missing} absentes" if self.missing else ""))
+
+_http_fixtures = None
+_http_fixtures_lock = threading.Lock()
+
+def get_http_fixtures():
+    """Enregistrement / rejeu HTTP configuré par HTTP_FIXTURES (créé au premier appel)"""
+    global _http_fixtures
+    with _http_fixtures_lock:
+        if _http_fixtures is None:
+            mode = os.getenv('HTTP_FIXTURES', '').strip().lower()
+            if mode not in ('', 'record', 'replay'):
+                logger.warning(f"⚠️ Valeur invalide pour HTTP_FIXTURES: '{mode}' - enregistrement désactivé")
+                mode = ''
+            _http_fixtures = HttpFixtures(mode, os.getenv('HTTP_FIXTURES_DIR') or None,
+                                          os.getenv('HTTP_REPLAY_LATENCY', 'original').strip().lower())
+    return _http_fixtures
+
+def _main_stage(shop):
+    """Étape la plus longue d'un manifeste de magasin ('other': pagination et traitement)"""
+    durations = {name: stats['seconds'] for name, stats in shop['stages'].items()}
+    durations['other'] = shop['other_seconds'] or 0.0
+    return max(durations, key=durations.get)
+
+class RunManifests:
+    """Manifestes JSON de l'exécution (RUN_MANIFEST=True), pour repérer les magasins
+    et APIs qui occupent la fenêtre de nuit.
+
+    manifests/<début de l'exécution>/ (à côté de magasins.json, ou dans RUN_MANIFEST_DIR):
+    - <API>/<magasin>.json: ShopManifest du magasin (étapes, pages, compteurs)
+    - <API>/summary.json: bilan de l'API, écrit à la fin de son extract_all
+    - run.json: bilan de toutes les APIs terminées, et les couples API / magasin les plus longs
+
+    Les exécutions de plus de RUN_MANIFEST_KEEP_DAYS jours sont supprimées.
+    """
+
+    DIRNAME = 'manifests'
+    RUN_FILENAME = 'run.json'
+
+    def __init__(self, directory=None, keep_days=30):
+        if directory is None:
+            directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), self.DIRNAME)
+        self.started_at = datetime.now()
+        self.base_directory = directory
+        self.directory = os.path.join(directory, self.started_at.strftime('%Y%m%d_%H%M%S'))
+        self.summaries = {}
+        self._shops = {}
+        self._lock = threading.Lock()
+        self._purge_expired(keep_days)
+
+    def _purge_expired(self, keep_days):
+        if keep_days <= 0 or not os.path.isdir(self.base_directory):
+            return
+        limit = time.time() - keep_days * 86400
+        for name in os.listdir(self.base_directory):
+            path = os.path.join(self.base_directory, name)
+            try:
+                if os.path.isdir(path) and os.path.getmtime(path) < limit:
+                    shutil.rmtree(path)
+            except OSError:
+                pass
+
+    def _write(self, path, data):
+        """Écriture atomique: un manifeste lu pendant l'exécution est toujours complet"""
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"⚠️ Manifeste non écrit ({path}): {e}")
+
+    def write_shop(self, manifest):
+        data = manifest.to_dict()
+        with self._lock:
+            self._shops[(manifest.api, manifest.shop_code)] = data
+        self._write(os.path.join(self.directory, manifest.api, f"{manifest.shop_code}.json"), data)
+
+    def write_summary(self, api, manifests, wall_seconds):
+        """Agrège les manifestes des magasins d'une API. Retourne le bilan écrit"""
+        shops = [manifest.to_dict() for manifest in manifests]
+        stages = {}
+        for shop in shops:
+            for name, stats in shop['stages'].items():
+                total = stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+                total['seconds'] = round(total['seconds'] + stats['seconds'], 3)
+                total['calls'] += stats['calls']
+        ranked = sorted(shops, key=lambda shop: -(shop['duration_seconds'] or 0))
+        summary = {
+            'api': api,
+            'wall_seconds': round(wall_seconds, 3),
+            'shops': len(shops),
+            'successful': sum(1 for shop in shops if shop['success']),
+            'incomplete': sum(1 for shop in shops if shop['incomplete']),
+            'shop_seconds': round(sum(shop['duration_seconds'] or 0 for shop in shops), 3),
+            'stages': stages,
+            'other_seconds': round(sum(shop['other_seconds'] or 0 for shop in shops), 3),
+        }
+        for counter in ('requests', 'bytes_received', 'rows_in', 'rows_out', 'retries'):
+            summary[counter] = sum(shop[counter] for shop in shops)
+        summary['slowest_shops'] = [
+            {'shop': shop['shop'], 'duration_seconds': shop['duration_seconds'] or 0,
+             'main_stage': _main_stage(shop), 'requests': shop['requests'], 'rows_out': shop['rows_out']}
+            for shop in ranked
+        ]
+        self._write(os.path.join(self.directory, api, 'summary.json'), summary)
+        with self._lock:
+            self.summaries[api] = summary
+        self.write_run()
+        return summary
+
+    def slowest(self, limit=20):
+        """Couples (API, magasin) les plus longs de l'exécution"""
+        with self._lock:
+            shops = list(self._shops.values())
+        ranked = sorted(shops, key=lambda shop: -(shop['duration_seconds'] or 0))[:limit]
+        return [{'api': shop['api'], 'shop': shop['shop'], 'duration_seconds': shop['duration_seconds'],
+                 'main_stage': _main_stage(shop)} for shop in ranked]
+
+    def write_run(self):
+        with self._lock:
+            apis = {api: {key: value for key, value in summary.items() if key != 'slowest_shops'}
+                    for api, summary in self.summaries.items()}
+        self._write(os.path.join(self.directory, self.RUN_FILENAME), {
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'apis': apis,
+            'slowest': self.slowest(),
+        })
+
+_run_manifests = None
+_run_manifests_lock = threading.Lock()
+
+def get_run_manifests():
+    """Manifestes de l'exécution en cours (créés au premier appel)"""
+    global _run_manifests
+    with _run_manifests_lock:
+        if _run_manifests is None:
+            _run_manifests = RunManifests(os.getenv('RUN_MANIFEST_DIR') or None,
+                                          get_env_int('RUN_MANIFEST_KEEP_DAYS', 30))
+    return _run_manifests
+
+def log_run_manifest(limit=10):
+    """Bilan de l'orchestrateur: couples API / magasin les plus longs de l'exécution"""
+    if _run_manifests is None:
+        return
+    slowest = _run_manifests.slowest(limit)
+    if not slowest:
+        return
+    logger.info(f"🐢 APIs / magasins les plus longs (manifestes: {_run_manifests.directory}):")
+    for shop in slowest:
+        logger.info(f"   {shop['api']} / {shop['shop']}: {shop['duration_seconds']:.1f}s ({shop['main_stage']})")
+
+_latency_tracker = None
+_latency_tracker_lock = threading.Lock()
+
+def get_latency_tracker():
+    global _latency_tracker
+    with _latency_tracker_lock:
+        if _latency_tracker is None:
+            _latency_tracker = LatencyTracker()
+    return _latency_tracker
+
+_high_water_marks = None
+_high_water_marks_lock = threading.Lock()
+
+def _get_high_water_marks():
+    global _high_water_marks
+    with _high_water_marks_lock:
+        if _high_water_marks is None:
+            _high_water_marks = HighWaterMarks()
+    return _high_water_marks
+
+def incremental_mode_enabled():
+    """Mode incrémental actif (INCREMENTAL_MODE=True) et aucune période personnalisée demandée"""
+    if not get_env_bool('INCREMENTAL_MODE', False):
+        return False
+    if os.getenv('DATE_START') and os.getenv('DATE_END'):
+        return False
+    if not get_env_bool('USE_DEFAULT_DATES', True) and os.getenv('CUSTOM_START_DATE'):
+        return False
+    return True
+
+def _parse_api_date(value):
+    """Convertit une date de l'API (ISO 8601, avec ou sans fuseau) en datetime sans fuseau"""
+    try:
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00')).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return None
+
+def apply_high_water_mark(params, api_name, base_url, shop_id):
+    """En mode incrémental, fait démarrer params['date_0'] au point de reprise du magasin.
+
+    Le point de reprise est inclus (date_0 est une borne inclusive): un
+    enregistrement peut être ré-extrait, mais aucun n'est perdu. Si les
+    exécutions précédentes ont été manquées, date_0 peut reculer pour
+    rattraper le retard, dans la limite de INCREMENTAL_MAX_DAYS jours (7 par défaut).
+    """
+    if not incremental_mode_enabled() or 'date_0' not in params:
+        return params
+    high_water_mark = _get_high_water_marks().get(api_name, base_url, shop_id)
+    if high_water_mark is None:
+        logger.info(f"📅 Mode incrémental: aucun point de reprise pour {api_name} magasin {shop_id}, période complète")
+        return params
+
+    # Conserver le format de la date d'origine (ex: suffixe +00:00)
+    original = params['date_0']
+    suffix = original[19:]
+    date_1 = _parse_api_date(params.get('date_1', ''))
+    if date_1 is not None:
+        oldest = date_1 - timedelta(days=get_env_int('INCREMENTAL_MAX_DAYS', 7))
+        high_water_mark = max(high_water_mark, oldest)
+    params['date_0'] = high_water_mark.strftime('%Y-%m-%dT%H:%M:%S') + suffix
+    logger.info(f"📅 Mode incrémental: reprise à partir de {params['date_0']} (au lieu de {original})")
+    return params
+
+def is_since(record, date_0, field='date'):
+    """Faux si record[field] est antérieur à date_0 (borne incluse, format de l'API).
+    Un enregistrement sans date lisible est conservé"""
+    since = _parse_api_date(date_0)
+    value = _parse_api_date(record.get(field)) if isinstance(record, dict) else None
+    return since is None or value is None or value >= since
+
+def save_high_water_mark(api_name, base_url, shop_id, records, field='date'):
+    """Enregistre le point de reprise après un export réussi (mode incrémental uniquement).
+
+    Le point de reprise n'avance pas si des pages ont échoué pendant
+    l'extraction du magasin: la prochaine exécution les redemandera.
+    """
+    if not incremental_mode_enabled():
+        return
+    run = current_shop_run()
+    if run is not None and run.incomplete:
+        logger.warning(f"⚠️ Extraction incomplète: point de reprise {api_name} du magasin {shop_id} non avancé")
+        return
+    latest = None
+    for record in records:
+        value = _parse_api_date(record.get(field)) if isinstance(record, dict) else None
+        if value is not None and (latest is None or value > latest):
+            latest = value
+    if latest is not None and _get_high_water_marks().update(api_name, base_url, shop_id, latest):
+        logger.info(f"📅 Point de reprise {api_name} magasin {shop_id}: {latest.isoformat()}")